@@ -1,7 +1,14 @@
+import hashlib
 import pandas as pd
-import json
+import orjson
 import os
 
+try:
+    import python_calamine  # noqa: F401 - pandas (>= 2.2) chỉ cần package python-calamine để dùng engine="calamine"
+    EXCEL_ENGINE = "calamine"
+except ImportError:  # Optional: không có python-calamine thì pandas đọc bằng openpyxl (chậm hơn)
+    EXCEL_ENGINE = None
+
 class ExcelToStructuredJSON:
     """
     Lớp chuyển đổi Excel framework thành JSON có cấu trúc
@@ -24,9 +31,42 @@ class ExcelToStructuredJSON:
         Returns:
             bool: True nếu thành công, False nếu lỗi
         """
+        result = self.convert_excel_to_data(excel_path, custom_purpose)
+        if result is None:
+            return False
+        
+        self.save_json(result, json_path)
+        return True
+    
+    def save_json(self, result, json_path):
+        """Lưu dữ liệu có cấu trúc ra file JSON"""
+        # Đảm bảo folder output tồn tại
+        os.makedirs(os.path.dirname(json_path) or '.', exist_ok=True)
+        
+        # Lưu kết quả ra file JSON
+        # OPT_SERIALIZE_NUMPY: giá trị đọc từ pandas có thể là numpy scalar
+        with open(json_path, 'wb') as f:
+            f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY))
+        
+        print(f"📁 File output: {json_path}")
+    
+    def convert_excel_to_data(self, excel_path, custom_purpose=None, df=None):
+        """
+        Chuyển đổi Excel framework thành dict có cấu trúc (không ghi file)
+        
+        Args:
+            excel_path (str): Đường dẫn tới file Excel
+            custom_purpose (str): Mục đích custom (nếu có)
+            df (DataFrame): Sheet 'template' đã parse sẵn (nếu có) - bỏ qua việc đọc lại excel_path
+            
+        Returns:
+            dict: Dữ liệu có cấu trúc (purpose + layers), None nếu lỗi
+        """
         try:
             # Đọc sheet template (updated from "Market Research")
-            df = pd.read_excel(excel_path, sheet_name="template")
+            if df is None:
+                # dtype=object: template toàn text - giữ nguyên giá trị ô, bỏ bước suy luận dtype từng cột
+                df = pd.read_excel(excel_path, sheet_name="template", engine=EXCEL_ENGINE, dtype=object)
             
             print("✅ Đã đọc file Excel thành công!")
             print(f"📊 Kích thước dữ liệu: {df.shape}")
@@ -35,16 +75,18 @@ class ExcelToStructuredJSON:
             purpose_row = None
             purpose_content = None
             
-            for idx, row in df.iterrows():
-                if any("Mục đích của Market Research" in str(cell) for cell in row if pd.notna(cell)):
-                    purpose_row = idx
-                    # Tìm nội dung purpose trong các cột
-                    for col in df.columns:
-                        if pd.notna(row[col]) and "Mục đích của Market Research" not in str(row[col]):
-                            if str(row[col]).strip():
-                                purpose_content = str(row[col])
-                                break
-                    break
+            # Quét cả bảng một lượt (vectorized) thay vì pd.notna + str() từng ô
+            purpose_hits = df.apply(
+                lambda col: col.astype(str).str.contains("Mục đích của Market Research", regex=False)
+            ).to_numpy().any(axis=1)
+            if purpose_hits.any():
+                pos = int(purpose_hits.argmax())
+                purpose_row = pos
+                # Tìm nội dung purpose trong các cột
+                for value in df.iloc[pos].dropna().astype(str):
+                    if "Mục đích của Market Research" not in value and value.strip():
+                        purpose_content = value
+                        break
             
             # Sử dụng custom purpose nếu có, ngược lại dùng purpose từ Excel
             final_purpose = custom_purpose if custom_purpose else (purpose_content if purpose_content else "Nghiên cứu và phân tích thị trường")
@@ -59,8 +101,9 @@ class ExcelToStructuredJSON:
             if purpose_row is not None:
                 # Tìm header của layers (Layer 1, Layer 2, etc.)
                 layer_header_row = None
-                for idx in range(purpose_row + 1, len(df)):
-                    row = df.iloc[idx]
+                # itertuples(name=None) trả về tuple thường - không dựng Series cho từng dòng như df.iloc[idx]
+                rows = df.iloc[purpose_row + 1:].itertuples(index=False, name=None)
+                for idx, row in enumerate(rows, start=purpose_row + 1):
                     if any("Layer" in str(cell) for cell in row if pd.notna(cell)):
                         layer_header_row = idx
                         break
@@ -81,27 +124,19 @@ class ExcelToStructuredJSON:
                     
                     if len(layer_columns) < 3:
                         print("⚠️ Warning: Need at least 3 layers (Layer 1, Layer 2, Layer 3) for proper structure")
-                        return False
+                        return None
                     
                     # Dynamic layer tracking
                     layer_stack = [None] * len(layer_columns)  # Track current value at each layer level
                     
                     # Phân tích dữ liệu từ dòng tiếp theo
-                    for idx in range(layer_header_row + 1, len(df)):
-                        row = df.iloc[idx]
-                        
-                        # Bỏ qua dòng trống
-                        if row.isna().all():
-                            continue
-                        
+                    # Chỉ lấy các cột layer; dòng trống cho toàn None nên tự bị bỏ qua (deepest_level = -1)
+                    for row in df.iloc[layer_header_row + 1:, layer_columns].itertuples(index=False, name=None):
                         # Get values for all layer columns
-                        layer_values = []
-                        for col_idx in layer_columns:
-                            if col_idx < len(row):
-                                val = row.iloc[col_idx]
-                                layer_values.append(str(val) if pd.notna(val) and str(val) != 'None' and str(val).strip() else None)
-                            else:
-                                layer_values.append(None)
+                        layer_values = [
+                            str(val) if pd.notna(val) and str(val) != 'None' and str(val).strip() else None
+                            for val in row
+                        ]
                         
                         # Process layers dynamically - find the deepest non-empty level
                         deepest_level = -1
@@ -170,47 +205,56 @@ class ExcelToStructuredJSON:
                             for level in range(deepest_level + 1, len(layer_stack)):
                                 layer_stack[level] = None
             
-            # Đảm bảo folder output tồn tại
-            os.makedirs(os.path.dirname(json_path), exist_ok=True)
-            
-            # Lưu kết quả ra file JSON
-            with open(json_path, 'w', encoding='utf-8') as f:
-                json.dump(result, f, ensure_ascii=False, indent=2)
-            
             print(f"✅ Đã chuyển đổi thành công!")
-            print(f"📁 File output: {json_path}")
             print(f"📊 Số lượng layers: {len(result['layers'])}")
             
-            return True
+            return result
             
         except FileNotFoundError:
             print(f"❌ Không tìm thấy file: {excel_path}")
-            return False
+            return None
         except Exception as e:
             print(f"❌ Lỗi: {e}")
-            return False
+            return None
 
-def convert_market_research_to_json():
+def convert_market_research_to_json(excel_file="input/market research template.xlsx"):
     """
     Hàm legacy để tương thích với CLI
-    Chuyển đổi sheet 'template' từ market research template.xlsx 
+    Chuyển đổi sheet 'template' từ excel_file (mặc định market research template.xlsx)
     thành JSON có cấu trúc với purpose và layers
     """
     
     # Sử dụng class mới - updated to use new file name
     converter = ExcelToStructuredJSON()
-    excel_file = "input/market research template.xlsx"
     json_file = "output/market_research_structured.json"
     
-    success = converter.convert_excel_to_json(excel_file, json_file)
+    # Excel không đổi so với lần convert trước (cùng sha256 nội dung) thì dùng lại JSON đã lưu
+    hash_file = json_file + ".source_sha256"
+    source_hash = file_sha256(excel_file) if os.path.exists(excel_file) else None
+    if source_hash and os.path.exists(json_file) and os.path.exists(hash_file):
+        with open(hash_file, 'r') as f:
+            if f.read().strip() == source_hash:
+                with open(json_file, 'rb') as f:
+                    print(f"✅ Excel không thay đổi - dùng lại structured JSON: {json_file}")
+                    return orjson.loads(f.read())
+    
+    result = converter.convert_excel_to_data(excel_file)
     
-    if success:
-        # Load và return kết quả để tương thích với code cũ
-        with open(json_file, 'r', encoding='utf-8') as f:
-            result = json.load(f)
-        return result
-    else:
-        return None
+    if result is not None:
+        # Vẫn lưu file JSON để tương thích với code cũ, trả về dict đã có sẵn trong memory
+        converter.save_json(result, json_file)
+        if source_hash:
+            with open(hash_file, 'w') as f:
+                f.write(source_hash)
+    return result
+
+def file_sha256(path, chunk_size=1 << 20):
+    """sha256 nội dung file (đọc theo chunk)"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 if __name__ == "__main__":
     result = convert_market_research_to_json()
@@ -6,7 +6,7 @@ Hỗ trợ xuất báo cáo với Layer 3 và comprehensive Layer 4
 Enhanced with tables and executive summary
 """
 
-import json
+import orjson
 import os
 from datetime import datetime
 from docx import Document
@@ -16,74 +16,32 @@ from docx.enum.table import WD_TABLE_ALIGNMENT
 from docx.oxml.shared import OxmlElement, qn
 import re
 
+from research_constants import FILENAME_UNSAFE_RE, MARKET_TRANSLATIONS, WHITESPACE_RE, max_tokens_for_words
+
+# clean_comprehensive_content: (pattern, replacement) áp dụng tuần tự - compile một lần ở module thay vì mỗi lần gọi
+CLEAN_CONTENT_PATTERNS = [
+    # Remove intro sentences like "Để trả lời chuyên sâu câu hỏi về..."
+    (re.compile(r'^Để trả lời[^,]*,\s*', re.MULTILINE), ''),
+    (re.compile(r'^Để trả lời[^.]*\.\s*', re.MULTILINE), ''),
+    (re.compile(r'^Nhằm trả lời[^,]*,\s*', re.MULTILINE), ''),
+    (re.compile(r'^Nhằm phân tích[^,]*,\s*', re.MULTILINE), ''),
+    # Remove section headers like "📊 PHÂN TÍCH HIỆN TRẠNG:", "⚡ DRIVERS & IMPACTS:", etc.
+    (re.compile(r'\n*[📊⚡📈⚠️🚀]\s*[A-ZÁÀẢÃẠĂẮẰẲẴẶÂẤẦẨẪẬĐÉÈẺẼẸÊẾỀỂỄỆÍÌỈĨỊÓÒỎÕỌÔỐỒỔỖỘƠỚỜỞỠỢÚÙỦŨỤƯỨỪỬỮỰÝỲỶỸỴ\s&]+:\s*'), '\n\n'),
+    # Remove numbered sections like "1. SECTION:", "2. ANALYSIS:", etc.
+    (re.compile(r'\n*\d+\.\s+[A-ZÁÀẢÃẠĂẮẰẲẴẶÂẤẦẨẪẬĐÉÈẺẼẸÊẾỀỂỄỆÍÌỈĨỊÓÒỎÕỌÔỐỒỔỖỘƠỚỜỞỠỢÚÙỦŨỤƯỨỪỬỮỰÝỲỶỸỴ\s]+:\s*'), '\n\n'),
+    # Remove **bold headers** at start of lines
+    (re.compile(r'\n\*\*[^*]+\*\*\s*\(\d+-\d+\s+từ\)\s*\n'), '\n\n'),
+    # Remove intro phrases at the beginning
+    (re.compile(r'^Trong bối cảnh này,\s*', re.MULTILINE), ''),
+    (re.compile(r'^Chúng ta cần xem xét[^.]*\.\s*', re.MULTILINE), ''),
+    (re.compile(r'^Việc phân tích[^.]*\.\s*', re.MULTILINE), ''),
+    # Clean up extra newlines
+    (re.compile(r'\n{3,}'), '\n\n'),
+]
+
 def get_vietnamese_market_name(market: str) -> str:
     """Translate market name to Vietnamese for consistent Vietnamese reports"""
-    market_translations = {
-        "🇺🇸 United States": "🇺🇸 Hoa Kỳ",
-        "🇨🇳 China": "🇨🇳 Trung Quốc", 
-        "🇯🇵 Japan": "🇯🇵 Nhật Bản",
-        "🇰🇷 South Korea": "🇰🇷 Hàn Quốc",
-        "🇹🇭 Thailand": "🇹🇭 Thái Lan",
-        "🇸🇬 Singapore": "🇸🇬 Singapore",
-        "🇲🇾 Malaysia": "🇲🇾 Malaysia",
-        "🇮🇩 Indonesia": "🇮🇩 Indonesia",
-        "🇵🇭 Philippines": "🇵🇭 Philippines",
-        "🇬🇧 United Kingdom": "🇬🇧 Vương quốc Anh",
-        "🇩🇪 Germany": "🇩🇪 Đức",
-        "🇫🇷 France": "🇫🇷 Pháp",
-        "🇮🇹 Italy": "🇮🇹 Ý",
-        "🇪🇸 Spain": "🇪🇸 Tây Ban Nha",
-        "🇨🇦 Canada": "🇨🇦 Canada",
-        "🇦🇺 Australia": "🇦🇺 Úc",
-        "🇳🇿 New Zealand": "🇳🇿 New Zealand",
-        "🇧🇷 Brazil": "🇧🇷 Brazil",
-        "🇲🇽 Mexico": "🇲🇽 Mexico",
-        "🇮🇳 India": "🇮🇳 Ấn Độ",
-        "🇷🇺 Russia": "🇷🇺 Nga",
-        "🇿🇦 South Africa": "🇿🇦 Nam Phi",
-        "🇪🇬 Egypt": "🇪🇬 Ai Cập",
-        "🇦🇪 UAE": "🇦🇪 UAE",
-        "🇸🇦 Saudi Arabia": "🇸🇦 Ả Rập Saudi",
-        "🇹🇷 Turkey": "🇹🇷 Thổ Nhĩ Kỳ",
-        "🇳🇱 Netherlands": "🇳🇱 Hà Lan",
-        "🇸🇪 Sweden": "🇸🇪 Thụy Điển",
-        "🇳🇴 Norway": "🇳🇴 Na Uy",
-        "🇩🇰 Denmark": "🇩🇰 Đan Mạch",
-        "🇫🇮 Finland": "🇫🇮 Phần Lan",
-        "🇨🇭 Switzerland": "🇨🇭 Thụy Sĩ",
-        "🇦🇹 Austria": "🇦🇹 Áo",
-        "🇧🇪 Belgium": "🇧🇪 Bỉ",
-        "🇵🇱 Poland": "🇵🇱 Ba Lan",
-        "🇨🇿 Czech Republic": "🇨🇿 Cộng hòa Séc",
-        "🇭🇺 Hungary": "🇭🇺 Hungary",
-        "🇬🇷 Greece": "🇬🇷 Hy Lạp",
-        "🇵🇹 Portugal": "🇵🇹 Bồ Đào Nha",
-        "🇮🇪 Ireland": "🇮🇪 Ireland",
-        "🇮🇱 Israel": "🇮🇱 Israel",
-        "🇭🇰 Hong Kong": "🇭🇰 Hồng Kông",
-        "🇹🇼 Taiwan": "🇹🇼 Đài Loan",
-        "🇦🇷 Argentina": "🇦🇷 Argentina",
-        "🇨🇱 Chile": "🇨🇱 Chile",
-        "🇨🇴 Colombia": "🇨🇴 Colombia",
-        "🇵🇪 Peru": "🇵🇪 Peru",
-        "🇻🇪 Venezuela": "🇻🇪 Venezuela",
-        "🇪🇨 Ecuador": "🇪🇨 Ecuador",
-        "🇺🇾 Uruguay": "🇺🇾 Uruguay",
-        "🇧🇴 Bolivia": "🇧🇴 Bolivia",
-        "🇵🇾 Paraguay": "🇵🇾 Paraguay",
-        "🇳🇬 Nigeria": "🇳🇬 Nigeria",
-        "🇰🇪 Kenya": "🇰🇪 Kenya",
-        "🇬🇭 Ghana": "🇬🇭 Ghana",
-        "🇪🇹 Ethiopia": "🇪🇹 Ethiopia",
-        "🇺🇬 Uganda": "🇺🇬 Uganda",
-        "🇹🇿 Tanzania": "🇹🇿 Tanzania",
-        "🇿🇼 Zimbabwe": "🇿🇼 Zimbabwe",
-        "🌏 Southeast Asia": "🌏 Đông Nam Á",
-        "🌍 Asia-Pacific": "🌍 Châu Á - Thái Bình Dương",
-        "🌎 Global Market": "🌎 Thị trường Toàn cầu"
-    }
-    
-    return market_translations.get(market, market)
+    return MARKET_TRANSLATIONS.get(market, market)
 
 def add_custom_styles(doc):
     """Thêm custom styles cho document"""
@@ -186,7 +144,7 @@ def create_summary_table(doc, data):
             questions = category.get('questions', [])
             
             layer3_count = len(questions)
-            layer4_count = sum(1 for q in questions if q.get('layer4_comprehensive_report'))
+            layer4_count = sum('layer4_comprehensive_report' in q for q in questions)
             
             row = table.add_row()
             row.cells[0].text = f"{layer_name} / {category_name}"
@@ -493,7 +451,10 @@ Lợi ích và impact khi áp dụng các đề xuất
 **CHỈ TRẢ VỀ NỘI DUNG 5 PHẦN, KHÔNG CÓ GIẢI THÍCH HAY INTRO**"""
 
         # Get AI-generated summary
-        ai_summary = researcher.call_openai_api(prompt)
+        try:
+            ai_summary = researcher.call_openai_api(prompt, max_tokens=max_tokens_for_words(620))  # 5 phần, tổng 500-620 từ
+        finally:
+            researcher.close()
         
         return ai_summary
         
@@ -757,40 +718,16 @@ def clean_comprehensive_content(content):
     if not content:
         return content
     
-    # Remove intro sentences like "Để trả lời chuyên sâu câu hỏi về..."
-    cleaned_content = re.sub(r'^Để trả lời[^,]*,\s*', '', content, flags=re.MULTILINE)
-    cleaned_content = re.sub(r'^Để trả lời[^.]*\.\s*', '', cleaned_content, flags=re.MULTILINE)
-    cleaned_content = re.sub(r'^Nhằm trả lời[^,]*,\s*', '', cleaned_content, flags=re.MULTILINE)
-    cleaned_content = re.sub(r'^Nhằm phân tích[^,]*,\s*', '', cleaned_content, flags=re.MULTILINE)
-    
-    # Remove section headers like "📊 PHÂN TÍCH HIỆN TRẠNG:", "⚡ DRIVERS & IMPACTS:", etc.
-    cleaned_content = re.sub(r'\n*[📊⚡📈⚠️🚀]\s*[A-ZÁÀẢÃẠĂẮẰẲẴẶÂẤẦẨẪẬĐÉÈẺẼẸÊẾỀỂỄỆÍÌỈĨỊÓÒỎÕỌÔỐỒỔỖỘƠỚỜỞỠỢÚÙỦŨỤƯỨỪỬỮỰÝỲỶỸỴ\s&]+:\s*', '\n\n', cleaned_content)
-    
-    # Remove numbered sections like "1. SECTION:", "2. ANALYSIS:", etc.
-    cleaned_content = re.sub(r'\n*\d+\.\s+[A-ZÁÀẢÃẠĂẮẰẲẴẶÂẤẦẨẪẬĐÉÈẺẼẸÊẾỀỂỄỆÍÌỈĨỊÓÒỎÕỌÔỐỒỔỖỘƠỚỜỞỠỢÚÙỦŨỤƯỨỪỬỮỰÝỲỶỸỴ\s]+:\s*', '\n\n', cleaned_content)
-    
-    # Remove **bold headers** at start of lines
-    cleaned_content = re.sub(r'\n\*\*[^*]+\*\*\s*\(\d+-\d+\s+từ\)\s*\n', '\n\n', cleaned_content)
-    
-    # Remove intro phrases at the beginning
-    intro_patterns = [
-        r'^Trong bối cảnh này,\s*',
-        r'^Chúng ta cần xem xét[^.]*\.\s*',
-        r'^Việc phân tích[^.]*\.\s*'
-    ]
-    
-    for pattern in intro_patterns:
-        cleaned_content = re.sub(pattern, '', cleaned_content, flags=re.MULTILINE)
-    
-    # Clean up extra newlines
-    cleaned_content = re.sub(r'\n{3,}', '\n\n', cleaned_content)
+    cleaned_content = content
+    for pattern, replacement in CLEAN_CONTENT_PATTERNS:
+        cleaned_content = pattern.sub(replacement, cleaned_content)
     
     # Remove leading/trailing whitespace
     cleaned_content = cleaned_content.strip()
     
     return cleaned_content
 
-def create_comprehensive_word_report(json_file: str, output_file: str = None, use_vietnamese_filename: bool = True) -> str:
+def create_comprehensive_word_report(json_file: str, output_file: str = None, use_vietnamese_filename: bool = True, data: dict = None) -> str:
     """
     Tạo báo cáo Word toàn diện từ kết quả nghiên cứu JSON
     
@@ -798,12 +735,14 @@ def create_comprehensive_word_report(json_file: str, output_file: str = None, us
         json_file: Đường dẫn file JSON
         output_file: Đường dẫn file output (optional)
         use_vietnamese_filename: Sử dụng tên file tiếng Việt thân thiện hay technical name
+        data: Kết quả nghiên cứu đã có trong memory (optional) - bỏ qua bước đọc lại json_file vừa ghi
     """
     
     print("📄 Tạo trang bìa...")
     # Đọc dữ liệu
-    with open(json_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    if data is None:
+        with open(json_file, 'rb') as f:
+            data = orjson.loads(f.read())
     
     if not output_file:
         # Extract base info for filename
@@ -817,8 +756,8 @@ def create_comprehensive_word_report(json_file: str, output_file: str = None, us
             timestamp = metadata.get('research_timestamp', '').replace(':', '').replace(' ', '_').replace('-', '')
             
             # Clean industry name for filename
-            industry_clean = re.sub(r'[^\w\s-]', '', industry)
-            industry_clean = re.sub(r'\s+', '_', industry_clean)
+            industry_clean = FILENAME_UNSAFE_RE.sub('', industry)
+            industry_clean = WHITESPACE_RE.sub('_', industry_clean)
             
             # Create friendly Vietnamese filename
             output_file = f"Báo_cáo_nghiên_cứu_thị_trường_{industry_clean}_{timestamp[:8]}.docx"
@@ -1067,27 +1006,33 @@ def calculate_statistics(data):
     
     return stats
 
+def latest_research_file_in(directory):
+    """File layer3_research_*.json mới nhất (theo mtime) trong directory, None nếu không có - quét thư mục một lần"""
+    latest_path, latest_mtime = None, None
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.startswith('layer3_research_') and name.endswith('.json'):
+                mtime = entry.stat().st_mtime
+                if latest_mtime is None or mtime > latest_mtime:
+                    latest_path, latest_mtime = entry.path, mtime
+    return latest_path
+
 def find_latest_research_file():
     """Tìm file research mới nhất trong thư mục output"""
     output_dir = 'output'
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-        
-    files = []
-    for file in os.listdir(output_dir):
-        if file.startswith('layer3_research_') and file.endswith('.json'):
-            files.append(os.path.join(output_dir, file))
-    
-    if not files:
-        # Fallback: tìm trong thư mục gốc
-        files = [f for f in os.listdir('.') if f.startswith('layer3_research_') and f.endswith('.json')]
-        
-    if not files:
-        return None
     
-    # Sắp xếp theo thời gian modification
-    files.sort(key=lambda x: os.path.getmtime(x), reverse=True)
-    return files[0]
+    # Fallback: tìm trong thư mục gốc
+    return latest_research_file_in(output_dir) or latest_research_file_in('.')
+
+def export_report(json_file: str, output_dir: str = 'output') -> str:
+    """Export file research JSON thành báo cáo Word trong output_dir - entry point cho CLI gọi trực tiếp (không qua subprocess)"""
+    # Tạo output filename trong thư mục output
+    base_name = os.path.basename(json_file).replace('layer3_research_', '').replace('.json', '')
+    output_file = os.path.join(output_dir, f"Báo_cáo_nghiên_cứu_thị_trường_{base_name}.docx")
+    return create_comprehensive_word_report(json_file, output_file)
 
 def main():
     """Main function"""
@@ -1110,12 +1055,8 @@ def main():
     
     print(f"📁 Sử dụng file: {json_file}")
     
-    # Tạo output filename trong thư mục output
-    base_name = os.path.basename(json_file).replace('layer3_research_', '').replace('.json', '')
-    output_file = os.path.join(output_dir, f"Báo_cáo_nghiên_cứu_thị_trường_{base_name}.docx")
-    
     # Export
-    result = create_comprehensive_word_report(json_file, output_file)
+    result = export_report(json_file, output_dir)
     
     if result:
         print(f"\n🎉 HOÀN THÀNH!")
@@ -6,181 +6,154 @@ Tác giả: AI Assistant
 Ngày: 2024
 """
 
-import json
-import requests
+import asyncio
+import atexit
+import functools
+import hashlib
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sqlite3
+import sys
+import threading
 import time
-from typing import Dict, List, Any
+from collections import Counter, defaultdict, deque
+from itertools import groupby
+from typing import Any, Callable, Dict
+import httpx
 import openai
+import orjson
 
-class OpenAIMarketResearch:
-    def __init__(self, api_key: str, industry: str = "Technology", market: str = "Việt Nam", model: str = "gpt-3.5-turbo"):
-        """
-        Khởi tạo class nghiên cứu thị trường với OpenAI GPT
-        
-        Args:
-            api_key (str): API key của OpenAI
-            industry (str): Ngành công nghiệp nghiên cứu
-            market (str): Thị trường nghiên cứu
-            model (str): Model GPT sử dụng
-        """
-        self.client = openai.OpenAI(api_key=api_key)
-        self.industry = industry
-        self.market = market
-        self.model = model
-        self.base_url = "https://api.openai.com/v1/chat/completions"
-        self.delay_seconds = 3  # Increased delay from 1 to 3 seconds
-        
-        # Reference tracking system
-        self.reference_tracker = {}
-        self.tracked_sources = set()
-        
-        print(f"🤖 Initialized OpenAI Market Research for {industry} in {market}")
-        print(f"📊 API Provider: OpenAI")
-        print(f"🔧 Model: {model}")
-        
-    def call_openai_api(self, prompt: str, max_retries: int = 3) -> str:
-        """Gửi request tới OpenAI API với retry logic và track references"""
-        
-        for attempt in range(max_retries):
-            try:
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ],
-                    max_tokens=2000,
-                    temperature=0.7
-                )
-                
-                if response.choices and response.choices[0].message:
-                    content = response.choices[0].message.content
-                    
-                    # Track references from the response
-                    self.track_references_from_response(content)
-                    
-                    return content
-                else:
-                    return "Không có nội dung trong phản hồi API"
-                    
-            except Exception as e:
-                if "429" in str(e) or "rate_limit" in str(e).lower():  # Rate limit error
-                    wait_time = (2 ** attempt) * 5  # Exponential backoff: 5, 10, 20 seconds
-                    print(f"⚠️ Rate limit hit - Waiting {wait_time}s before retry {attempt + 1}/{max_retries}")
-                    time.sleep(wait_time)
-                    if attempt == max_retries - 1:
-                        print(f"❌ Max retries reached. Error: {e}")
-                        return f"Rate limit error after {max_retries} retries: {e}"
-                else:
-                    print(f"❌ API Error: {e}")
-                    return f"API Error: {e}"
-        
-        return "Failed after all retries"
-    
-    def track_references_from_response(self, content: str):
-        """Extract and track references from AI response"""
-        import re
-        
-        # Patterns to detect references and sources in AI responses
-        reference_patterns = [
-            # Organizations and institutions
-            r'\b(?:Tổng cục Thống kê|General Statistics Office|GSO)\b',
-            r'\b(?:Ngân hàng Thế giới|World Bank)\b',
-            r'\b(?:IMF|International Monetary Fund)\b',
-            r'\b(?:ADB|Asian Development Bank)\b',
-            r'\b(?:McKinsey|Deloitte|PwC|KPMG|BCG)\b',
-            r'\b(?:Nielsen|Euromonitor|Statista)\b',
-            r'\b(?:VCCI|Vietnam Chamber of Commerce)\b',
-            r'\b(?:Bộ (?:Kế hoạch|Tài chính|Công Thương|Y tế|Giáo dục))\b',
-            
-            # Vietnam specific
-            r'\b(?:VAMA|Vietnam Automobile)\b',
-            r'\b(?:VINASA|Vietnam Software)\b',
-            r'\b(?:VFA|Vietnam Food Association)\b',
-            r'\b(?:FPT|Viettel|VNPT)\b',
-            r'\b(?:Ngân hàng Nhà nước|State Bank of Vietnam)\b',
-            
-            # Global sources
-            r'\b(?:Bloomberg|Reuters|Financial Times)\b',
-            r'\b(?:Forbes|Harvard Business Review|MIT)\b',
-            r'\b(?:Gartner|IDC|Forrester)\b',
-            
-            # Government and regulatory
-            r'\b(?:Ministry of|Bộ)\s+[A-Za-zÀ-ỹ\s]+\b',
-            r'\b(?:Government of|Chính phủ)\s+[A-Za-zÀ-ỹ\s]+\b',
-        ]
-        
-        # Extract references
-        for pattern in reference_patterns:
-            matches = re.finditer(pattern, content, re.IGNORECASE)
-            for match in matches:
-                source = match.group().strip()
-                if source and len(source) > 3:  # Avoid very short matches
-                    # Normalize source name
-                    normalized_source = self.normalize_source_name(source)
-                    
-                    # Track frequency
-                    if normalized_source in self.reference_tracker:
-                        self.reference_tracker[normalized_source] += 1
-                    else:
-                        self.reference_tracker[normalized_source] = 1
-                    
-                    self.tracked_sources.add(normalized_source)
+from research_constants import MARKET_TRANSLATIONS, max_tokens_for_words
+
+try:
+    import tiktoken
+except ImportError:  # Optional: không có tiktoken thì ước lượng token theo độ dài ký tự
+    tiktoken = None
+
+try:
+    import h2  # noqa: F401 - httpx chỉ cần package h2 để bật HTTP/2
+    HTTP2_AVAILABLE = True
+except ImportError:  # Optional: không có h2 thì httpx dùng HTTP/1.1 keep-alive
+    HTTP2_AVAILABLE = False
+
+# Ngưỡng throttle: chỉ tạm dừng khi capacity còn lại dưới 10% limit (tối thiểu 2)
+RATE_LIMIT_HEADROOM = 0.1
+RATE_LIMIT_MIN_REMAINING = 2
+RATE_LIMIT_WINDOW_SECONDS = 60
+
+# Các status code lỗi tạm thời đáng retry (rate limit + lỗi server)
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Hedged request (async): request chưa xong sau HEDGE_DELAY_SECONDS (~p95 latency) thì gửi thêm một bản,
+# lấy kết quả về trước. Tự tắt khi tỉ lệ hedge > HEDGE_MAX_RATE (timeout đặt sai, không phải tail latency)
+HEDGE_DELAY_SECONDS = 12.0
+HEDGE_MAX_RATE = 0.2
+HEDGE_MIN_SAMPLES = 20
+
+# Patterns to detect references and sources in AI responses
+REFERENCE_PATTERNS = [
+    # Organizations and institutions
+    r'\b(?:Tổng cục Thống kê|General Statistics Office|GSO)\b',
+    r'\b(?:Ngân hàng Thế giới|World Bank)\b',
+    r'\b(?:IMF|International Monetary Fund)\b',
+    r'\b(?:ADB|Asian Development Bank)\b',
+    r'\b(?:McKinsey|Deloitte|PwC|KPMG|BCG)\b',
+    r'\b(?:Nielsen|Euromonitor|Statista)\b',
+    r'\b(?:VCCI|Vietnam Chamber of Commerce)\b',
+    r'\b(?:Bộ (?:Kế hoạch|Tài chính|Công Thương|Y tế|Giáo dục))\b',
     
-    def normalize_source_name(self, source: str) -> str:
-        """Normalize source names for consistent tracking"""
-        source = source.strip()
-        
-        # Mapping for common variations
-        mappings = {
-            'Tổng cục Thống kê': 'General Statistics Office (GSO)',
-            'General Statistics Office': 'General Statistics Office (GSO)',
-            'GSO': 'General Statistics Office (GSO)',
-            'Ngân hàng Thế giới': 'World Bank',
-            'World Bank': 'World Bank',
-            'IMF': 'International Monetary Fund (IMF)',
-            'International Monetary Fund': 'International Monetary Fund (IMF)',
-            'McKinsey': 'McKinsey & Company',
-            'Deloitte': 'Deloitte Consulting',
-            'PwC': 'PricewaterhouseCoopers (PwC)',
-            'KPMG': 'KPMG International',
-            'Nielsen': 'Nielsen Holdings',
-            'Euromonitor': 'Euromonitor International',
-            'Statista': 'Statista GmbH',
-            'VCCI': 'Vietnam Chamber of Commerce and Industry (VCCI)',
-            'Vietnam Chamber of Commerce': 'Vietnam Chamber of Commerce and Industry (VCCI)',
-        }
-        
-        return mappings.get(source, source)
+    # Vietnam specific
+    r'\b(?:VAMA|Vietnam Automobile)\b',
+    r'\b(?:VINASA|Vietnam Software)\b',
+    r'\b(?:VFA|Vietnam Food Association)\b',
+    r'\b(?:FPT|Viettel|VNPT)\b',
+    r'\b(?:Ngân hàng Nhà nước|State Bank of Vietnam)\b',
     
-    def get_top_references(self, limit: int = 10) -> list:
-        """Get top references sorted by frequency"""
-        sorted_refs = sorted(
-            self.reference_tracker.items(), 
-            key=lambda x: x[1], 
-            reverse=True
-        )
-        return sorted_refs[:limit]
+    # Global sources
+    r'\b(?:Bloomberg|Reuters|Financial Times)\b',
+    r'\b(?:Forbes|Harvard Business Review|MIT)\b',
+    r'\b(?:Gartner|IDC|Forrester)\b',
+]
+
+# Government and regulatory - greedy, match cả phần còn lại của mệnh đề (kể cả tên nguồn phía sau)
+GENERIC_REFERENCE_PATTERNS = [
+    r'\b(?:Ministry of|Bộ)\s+[A-Za-zÀ-ỹ\s]+\b',
+    r'\b(?:Government of|Chính phủ)\s+[A-Za-zÀ-ỹ\s]+\b',
+]
+
+# Các pattern tên cụ thể không chồng lên nhau nên gộp được thành một alternation, compile một lần lúc import.
+# Pattern tổng quát phải quét riêng: trong cùng alternation, finditer chỉ trả về match không chồng lấn
+# nên "Bộ ... và Ngân hàng Thế giới" sẽ nuốt mất các nguồn cụ thể phía sau.
+_COMBINED_REF_RE = re.compile("|".join(f"(?:{pattern})" for pattern in REFERENCE_PATTERNS), re.IGNORECASE)
+_GENERIC_REF_RES = [re.compile(pattern, re.IGNORECASE) for pattern in GENERIC_REFERENCE_PATTERNS]
 
-    def create_layer3_prompt_request(self, layer1: str, layer2: str, main_question: str, purpose: str) -> str:
-        """Tạo request để lấy prompt Layer 3 (main question level) - DIRECT ANSWER FOCUSED"""
-        template = f'''Bạn là chuyên gia phân tích thị trường cho ngành "{self.industry}" tại thị trường "{self.market}".
 
-MỤC ĐÍCH NGHIÊN CỨU: {purpose}
+def scan_references(content: str) -> list:
+    """Các đoạn text match REFERENCE_PATTERNS và GENERIC_REFERENCE_PATTERNS (cùng kết quả với finditer từng pattern)"""
+    sources = [match.group() for match in _COMBINED_REF_RE.finditer(content)]
+    for pattern in _GENERIC_REF_RES:
+        sources.extend(match.group() for match in pattern.finditer(content))
+    return sources
 
-NGỮ CẢNH PHÂN TÍCH:
-- Chủ đề chính: {layer1}
-- Lĩnh vực: {layer2}
 
-CÂU HỎI CẦN TRẢ LỜI: "{main_question}"
+# Budget output theo số từ mục tiêu của prompt (max_tokens_for_words: tiếng Việt ~2-3 token/từ)
+LAYER4_REPORT_MAX_TOKENS = max_tokens_for_words(700)  # LAYER4_REPORT_RULES_TEMPLATE: "Total: 550-700 từ"
+LAYER3_CATEGORY_MAX_TOKENS = max_tokens_for_words(800)  # LAYER3_CATEGORY_RULES_TEMPLATE: 4 phần, tổng 600-800 từ
 
-🎯 **YÊU CẦU BẮT BUỘC:**
+# Context window (tokens) theo model prefix - prefix dài hơn được ưu tiên khi match
+MODEL_CONTEXT_WINDOWS = {
+    'gpt-3.5-turbo': 16385,
+    'gpt-4': 8192,
+    'gpt-4-turbo': 128000,
+    'gpt-4o': 128000,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+# Số token output tối đa một response được sinh ra theo model prefix - giới hạn tổng budget của request gộp nhiều item
+MODEL_MAX_OUTPUT_TOKENS = {
+    'gpt-3.5-turbo': 4096,
+    'gpt-4': 4096,
+    'gpt-4-turbo': 4096,
+    'gpt-4o': 16384,
+}
+DEFAULT_MAX_OUTPUT_TOKENS = 4096
+# Model context lớn dùng khi prompt + max_tokens vượt context của model đang chọn
+LARGE_CONTEXT_MODEL = 'gpt-4o-mini'
+# Overhead token cho mỗi chat message (role, delimiter)
+MESSAGE_TOKEN_OVERHEAD = 8
+
+# Semantic cache (opt-in): embedding model, ngưỡng cosine để dùng lại response và số ký tự cuối
+# của prompt được embed - phần biến đổi (câu hỏi, nội dung) nằm cuối prompt nên giữ phần đuôi
+SEMANTIC_CACHE_EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_CACHE_THRESHOLD = 0.97
+SEMANTIC_CACHE_MAX_CHARS = 12000
+
+# Các chuỗi call_openai_api trả về khi lỗi - không được đưa vào cache
+API_ERROR_PREFIXES = ("API Error:", "Rate limit error", "Failed after all retries", "Không có nội dung trong phản hồi API")
+
+# Connection pool cho sync và async client: giữ kết nối keep-alive tới api.openai.com,
+# HTTP/2 (nếu có h2) multiplex nhiều request trên một kết nối TCP
+HTTP_LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=100, keepalive_expiry=300)
+HTTP_TIMEOUT = httpx.Timeout(180.0, connect=10.0)
+
+_RESET_DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+
+# Delimiter tách các câu trả lời trong một batch prompt Layer 3
+BATCH_ANSWER_RE = re.compile(r'^\s*#{3}\s*ANSWER\s+(\d+)\s*#{3}\s*$', re.MULTILINE)
+
+# Phần tĩnh của prompt: chỉ phụ thuộc vào industry/market nên render một lần cho mỗi instance.
+# Phần tĩnh luôn đứng TRƯỚC nội dung biến đổi (câu hỏi, layer3_content) để prefix giữa các request
+# giống hệt nhau từng byte - OpenAI prompt caching chỉ áp dụng cho prefix trùng khớp.
+SYSTEM_PREAMBLE_TEMPLATE = 'Bạn là chuyên gia phân tích thị trường cho ngành "{industry}" tại thị trường "{market}".'
+
+LAYER3_RULES_TEMPLATE = '''🎯 **YÊU CẦU BẮT BUỘC:**
 1. **TRẢ LỜI TRỰC TIẾP** câu hỏi ngay từ câu đầu tiên
 2. **BẮT ĐẦU** bằng: "Để trả lời câu hỏi về [tóm tắt ngắn câu hỏi]..."
 3. **FOCUS 100%** vào nội dung mà câu hỏi đang hỏi - không drift sang chủ đề khác
-4. **SỬ DỤNG** số liệu và ví dụ cụ thể từ thị trường {self.market}
+4. **SỬ DỤNG** số liệu và ví dụ cụ thể từ thị trường {market}
 5. **KẾT THÚC** bằng conclusion trả lời rõ ràng câu hỏi
 
 **CẤU TRÚC:**
@@ -193,43 +166,27 @@ CÂU HỎI CẦN TRẢ LỜI: "{main_question}"
 - Đặt câu hỏi thêm
 - Phân tích những gì không được hỏi
 
-**CHỈ TẬP TRUNG:** Trả lời chính xác và đầy đủ câu hỏi "{main_question}"'''
-        
-        return template
-
-    def create_layer3_comprehensive_category_prompt(self, layer1: str, layer2: str, all_questions: list, purpose: str) -> str:
-        """Tạo prompt để phân tích comprehensive cho toàn bộ category (Layer 3 mode)"""
-        
-        # Get Vietnamese market name for Vietnamese reports
-        vietnamese_market = self.get_vietnamese_market_name(self.market)
-        
-        questions_text = "\n".join([f"- {q}" for q in all_questions])
-        
-        template = f'''Bạn là chuyên gia phân tích thị trường cho ngành "{self.industry}" tại thị trường "{vietnamese_market}".
-
-NGỮ CẢNH: {layer1} > {layer2}
-MỤC ĐÍCH NGHIÊN CỨU: "{purpose}"
+**CHỈ TẬP TRUNG:** Trả lời chính xác và đầy đủ câu hỏi được nêu ở cuối.
 
-CÁC CÂU HỎI CẦN TRẢ LỜI TOÀN DIỆN:
-{questions_text}
+'''
 
-🎯 **NHIỆM VỤ:** Viết phân tích comprehensive cho toàn bộ category "{layer2}" bằng cách trả lời tích hợp TẤT CẢ câu hỏi trên.
+LAYER3_CATEGORY_RULES_TEMPLATE = '''🎯 **NHIỆM VỤ:** Viết phân tích comprehensive cho toàn bộ category (lĩnh vực) được nêu ở cuối bằng cách trả lời tích hợp TẤT CẢ câu hỏi được liệt kê.
 
 **BẮT ĐẦU NGAY VỚI PHÂN TÍCH** - KHÔNG có câu giới thiệu hay mở đầu, đi thẳng vào tình hình hiện tại.
 
 **CÁCH VIẾT - FLOW TỰ NHIÊN:**
 
 Viết một phân tích dạng văn xuôi, liền mạch theo logic:
-1. **Tình hình hiện tại** (150-200 từ): Bắt đầu ngay với overview về {layer2} trong ngành {self.industry}
+1. **Tình hình hiện tại** (150-200 từ): Bắt đầu ngay với overview về lĩnh vực này trong ngành {industry}
 2. **Phân tích chi tiết** (200-250 từ): Deep dive các factors chính, data cụ thể 
 3. **Tác động và xu hướng** (150-200 từ): Impacts, trends, opportunities 
 4. **Khuyến nghị chiến lược** (100-150 từ): Actionable insights và recommendations
 
 **YÊU CẦU:**
-- BẮT ĐẦU NGAY với phân tích (VD: "Tình hình {layer2} hiện tại...", "Trong bối cảnh {layer2}...")
+- BẮT ĐẦU NGAY với phân tích (VD: "Tình hình [lĩnh vực] hiện tại...", "Trong bối cảnh [lĩnh vực]...")
 - TRẢ LỜI HẾT TẤT CẢ các câu hỏi được liệt kê
 - VIẾT liền mạch như một bài phân tích chuyên nghiệp
-- SỬ DỤNG data và examples cụ thể từ {vietnamese_market}
+- SỬ DỤNG data và examples cụ thể từ {market}
 - TRÁNH section headers, viết dạng essay flow tự nhiên
 - KẾT HỢP insights từ tất cả câu hỏi thành một comprehensive view
 
@@ -240,51 +197,21 @@ Viết một phân tích dạng văn xuôi, liền mạch theo logic:
 - Forward-looking perspective
 
 **VÍ DỤ BẮT ĐẦU TỐT:**
-"Tình hình {layer2} trong ngành {self.industry} tại {vietnamese_market} hiện đang..."
-"Bối cảnh {layer2} cho thấy..."
-"Môi trường {layer2} đang trải qua..."
-
-Tạo một phân tích comprehensive trả lời hết các câu hỏi trên để hiểu toàn diện về {layer2} impact lên ngành {self.industry}.'''
-        
-        return template
-
-    def create_layer4_enhancement_prompt(self, layer1: str, layer2: str, main_question: str, sub_question: str, layer3_content: str, purpose: str) -> str:
-        """Tạo prompt để enhance specific section từ Layer 3 lên Layer 4"""
-        template = f'''As a master prompt engineer, I need to enhance a specific section of an existing market research report from Layer 3 to Layer 4 standard for: "{self.industry}" in market: "{self.market}". 
+"Tình hình [lĩnh vực] trong ngành {industry} tại {market} hiện đang..."
+"Bối cảnh [lĩnh vực] cho thấy..."
+"Môi trường [lĩnh vực] đang trải qua..."
 
-The research purpose is: "{purpose}"
-Structure: layer 1: {layer1} | layer 2: {layer2} | layer 3: {main_question}
+Tạo một phân tích comprehensive trả lời hết các câu hỏi bên dưới để hiểu toàn diện về tác động của lĩnh vực này lên ngành {industry}.
 
-EXISTING LAYER 3 CONTENT TO ENHANCE:
-{layer3_content}
+'''
 
-SPECIFIC ENHANCEMENT REQUEST (Layer 4):
-{sub_question}
+LAYER4_ENHANCEMENT_REQUEST_TEMPLATE = '''As a master prompt engineer, I need to enhance a specific section of an existing market research report from Layer 3 to Layer 4 standard for: "{industry}" in market: "{market}".
 
-Create a prompt for GPT to provide deep, detailed analysis specifically for the enhancement request above, while building upon the existing Layer 3 content. The result should be much more detailed, with specific data, examples, and actionable insights. Vietnamese answer only.'''
-        
-        return template
-
-    def create_layer4_comprehensive_report_prompt(self, layer1: str, layer2: str, main_question: str, sub_questions: list, layer3_content: str, purpose: str) -> str:
-        """Tạo prompt để tạo báo cáo Layer 4 tổng hợp - DIRECT CONTENT, NO INTRO"""
-        
-        # Get Vietnamese market name for Vietnamese reports
-        vietnamese_market = self.get_vietnamese_market_name(self.market)
-        
-        sub_questions_text = "\n".join([f"- {sq}" for sq in sub_questions])
-        
-        template = f'''Bạn là chuyên gia phân tích thị trường cho ngành "{self.industry}" tại thị trường "{vietnamese_market}".
-
-NGỮ CẢNH: {layer1} > {layer2}
-CÂU HỎI CHÍNH CẦN TRẢ LỜI: "{main_question}"
-
-PHÂN TÍCH SẴN CÓ (Layer 3):
-{layer3_content}
+Create a prompt for GPT to provide deep, detailed analysis specifically for the enhancement request below, while building upon the existing Layer 3 content. The result should be much more detailed, with specific data, examples, and actionable insights. Vietnamese answer only.
 
-CÁC KHÍA CẠNH CHI TIẾT CẦN PHÂN TÍCH:
-{sub_questions_text}
+'''
 
-🎯 **NHIỆM VỤ:** Viết phân tích chuyên sâu trả lời câu hỏi chính "{main_question}" bằng cách tích hợp tất cả khía cạnh chi tiết.
+LAYER4_REPORT_RULES_TEMPLATE = '''🎯 **NHIỆM VỤ:** Viết phân tích chuyên sâu trả lời CÂU HỎI CHÍNH (nêu ở cuối) bằng cách tích hợp tất cả khía cạnh chi tiết.
 
 **BẮT ĐẦU NGAY VỚI NỘI DUNG PHÂN TÍCH** - KHÔNG có câu giới thiệu, không có "Để trả lời câu hỏi...", đi thẳng vào tình hình hiện tại.
 
@@ -302,7 +229,7 @@ Viết một phân tích dạng văn xuôi, liền mạch theo logic:
 - KHÔNG sử dụng section headers hay bullet points
 - KHÔNG có câu giới thiệu hay mở đầu
 - VIẾT liền mạch như một bài phân tích chuyên nghiệp
-- Use real {vietnamese_market} market data và case studies
+- Use real {market} market data và case studies
 - BE SPECIFIC - tránh generalities
 - Total: 550-700 từ
 
@@ -312,161 +239,1546 @@ Viết một phân tích dạng văn xuôi, liền mạch theo logic:
 - Bắt đầu ngay với facts và analysis
 - Flow như một essay analysis, không intro
 
-**VÍ DỤ BẮT ĐẦU TỐT:**
-"Hiện tại ngành [X] đang trải qua..."
-"Trong bối cảnh thị trường [Y]..."
-"Tình trạng hiện tại cho thấy..."
-"Thị trường [Z] đang chứng kiến..."
+**VÍ DỤ BẮT ĐẦU TỐT:**
+"Hiện tại ngành [X] đang trải qua..."
+"Trong bối cảnh thị trường [Y]..."
+"Tình trạng hiện tại cho thấy..."
+"Thị trường [Z] đang chứng kiến..."
+
+**KẾT THÚC** với conclusion trả lời hoàn chỉnh câu hỏi chính.
+
+'''
+
+
+# Log tiến độ từng question: ghi vào queue, thread nền của QueueListener mới in ra stdout
+# nên vòng lặp per-question / event loop không bị chặn bởi stdout
+logger = logging.getLogger("mktresearch")
+_log_listener = None
+
+
+def setup_progress_logging():
+    """Gắn QueueHandler cho logger "mktresearch" và chạy QueueListener (chỉ một lần mỗi process)"""
+    global _log_listener
+    if _log_listener is not None:
+        return
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(message)s"))
+    _log_listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def flush_progress_logging():
+    """In hết log còn trong queue trước khi print tổng kết, giữ đúng thứ tự output"""
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener.start()
+
+
+@functools.lru_cache(maxsize=1)
+def _format_timestamp(second: int) -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+
+
+def current_timestamp() -> str:
+    """Timestamp "YYYY-mm-dd HH:MM:SS" (giờ local); các enhancement trong cùng một giây dùng lại chuỗi đã format"""
+    return _format_timestamp(int(time.time()))
+
+
+def parse_reset_seconds(value: str) -> float:
+    """Chuyển header reset của OpenAI (VD: "1s", "6m0s", "20ms") thành số giây"""
+    if not value:
+        return 0.0
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    seconds = sum(float(amount) * units[unit] for amount, unit in _RESET_DURATION_RE.findall(value))
+    if seconds == 0:
+        try:
+            seconds = float(value)
+        except ValueError:
+            return 0.0
+    return seconds
+
+
+def flatten_questions(structured_data: Dict[str, Any]) -> list:
+    """Flatten structured data một lần thành [(layer_name, category_name, question)] theo đúng thứ tự"""
+    return [
+        (layer.get('name', ''), category.get('name', ''), question)
+        for layer in structured_data.get('layers', [])
+        for category in layer.get('categories', [])
+        for question in category.get('questions', [])
+    ]
+
+
+def index_research_results(results: Dict[str, Any]) -> Dict[tuple, Dict[str, Any]]:
+    """Map (layer_name, category_name, main_question) -> question dict (cùng object trong results)"""
+    return {
+        (layer.get('layer_name'), category.get('category_name'), question.get('main_question')): question
+        for layer in results.get('research_results', [])
+        for category in layer.get('categories', [])
+        for question in category.get('questions', [])
+    }
+
+
+class Layer3Store:
+    """
+    Giữ file kết quả Layer 3 trong memory để thêm nhiều Layer 4 enhancement mà chỉ ghi file một lần.
+    Mỗi enhancement được append ngay vào sidecar JSONL (layer4_deltas) nên không mất khi bị gián đoạn;
+    flush() ghi file kết quả đầy đủ và xóa sidecar. Lần load sau sẽ replay các delta chưa flush.
+    Truyền results (kết quả vừa tạo, đang có trong memory) để không phải đọc lại file: đây là lần chạy mới nên
+    sidecar cũ (của lần chạy trước bị ngắt) bị xóa, không replay. Chỉ replay khi resume từ results_file trên disk.
+    """
+    
+    def __init__(self, results_file: str, output_file: str = None, results: Dict[str, Any] = None):
+        self.results_file = results_file
+        self.output_file = output_file or results_file
+        self.deltas_file = os.path.splitext(self.output_file)[0] + ".layer4_deltas.jsonl"
+        self._results = None
+        self._index = None
+        if results is not None:
+            if os.path.exists(self.deltas_file):
+                os.remove(self.deltas_file)  # Delta của lần chạy trước - không áp lên kết quả mới
+            self._load(results, replay=False)
+    
+    @property
+    def results(self) -> Dict[str, Any]:
+        if self._results is None:
+            with open(self.results_file, 'rb') as f:
+                self._load(orjson.loads(f.read()))
+        return self._results
+    
+    def _load(self, results: Dict[str, Any], replay: bool = True):
+        self._results = results
+        self._index = index_research_results(results)
+        if replay:
+            self._replay_deltas()
+    
+    @property
+    def index(self) -> Dict[tuple, Dict[str, Any]]:
+        self.results  # Đảm bảo đã load
+        return self._index
+    
+    def add_enhancement(self, layer_name: str, category_name: str, main_question: str, sub_question: str, content: str) -> bool:
+        return self._add({
+            "layer_name": layer_name,
+            "category_name": category_name,
+            "main_question": main_question,
+            "sub_question": sub_question,
+            "value": {
+                "enhanced_content": content,
+                "enhancement_timestamp": current_timestamp()
+            }
+        })
+    
+    def add_comprehensive(self, layer_name: str, category_name: str, main_question: str, content: str) -> bool:
+        question = self.index.get((layer_name, category_name, main_question), {})
+        return self._add({
+            "layer_name": layer_name,
+            "category_name": category_name,
+            "main_question": main_question,
+            "value": {
+                "comprehensive_content": content,
+                "enhancement_timestamp": current_timestamp(),
+                "sub_questions_integrated": question.get('sub_questions', [])
+            }
+        })
+    
+    def flush(self) -> str:
+        """Ghi toàn bộ kết quả ra output_file (một lần) và xóa sidecar delta"""
+        with open(self.output_file, 'wb') as f:
+            f.write(orjson.dumps(self.results, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        if os.path.exists(self.deltas_file):
+            os.remove(self.deltas_file)
+        return self.output_file
+    
+    def _add(self, delta: Dict[str, Any]) -> bool:
+        if not self._apply(delta):
+            return False
+        with open(self.deltas_file, 'ab') as f:
+            f.write(orjson.dumps(delta) + b"\n")
+        return True
+    
+    def _apply(self, delta: Dict[str, Any]) -> bool:
+        question = self.index.get((delta['layer_name'], delta['category_name'], delta['main_question']))
+        if question is None:
+            return False
+        if 'sub_question' in delta:
+            question.setdefault('layer4_enhancements', {})[delta['sub_question']] = delta['value']
+        else:
+            question['layer4_comprehensive_report'] = delta['value']
+        return True
+    
+    def _replay_deltas(self):
+        if not os.path.exists(self.deltas_file):
+            return
+        replayed = 0
+        with open(self.deltas_file, 'rb') as f:
+            for line in f:
+                try:
+                    delta = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    continue  # Dòng ghi dở do bị ngắt giữa chừng
+                replayed += self._apply(delta)
+        if replayed:
+            print(f"♻️ Replay {replayed} Layer 4 enhancement chưa flush từ {self.deltas_file}")
+
+
+class PromptCache:
+    """
+    Key-value cache trên SQLite (WAL) cho các prompt đã generate và response API, dùng lại giữa các lần chạy.
+    Connection mở lazy và dùng chung có lock nên an toàn khi gọi từ nhiều thread.
+    """
+    
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._conn = None
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(*parts: str) -> str:
+        return hashlib.sha256("|".join(parts).encode('utf-8')).hexdigest()
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS prompts (key TEXT PRIMARY KEY, value TEXT)")
+        return self._conn
+    
+    def get(self, key: str) -> str:
+        with self._lock:
+            row = self._connect().execute("SELECT value FROM prompts WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+    
+    def set(self, key: str, value: str):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO prompts (key, value) VALUES (?, ?)", (key, value))
+            conn.commit()
+    
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class SemanticPromptCache:
+    """
+    Cache response theo độ tương đồng ngữ nghĩa của prompt: trả về response đã lưu khi cosine
+    giữa embedding của prompt mới và một prompt cũ (cùng scope) ≥ threshold.
+    Embedding lưu trong SQLite; mỗi scope giữ một ma trận vector đã chuẩn hóa trong memory nên
+    tìm nearest neighbor chỉ là một phép nhân ma trận. numpy được import khi dùng lần đầu.
+    """
+    
+    def __init__(self, db_path: str, threshold: float = SEMANTIC_CACHE_THRESHOLD):
+        self.db_path = db_path
+        self.threshold = threshold
+        self._conn = None
+        self._lock = threading.Lock()
+        self._scopes = {}  # scope -> (ma trận embedding đã chuẩn hóa, list content)
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS semantic_cache (scope TEXT, embedding BLOB, content TEXT)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_semantic_scope ON semantic_cache (scope)")
+        return self._conn
+    
+    @staticmethod
+    def _normalize(embedding):
+        import numpy as np
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+    
+    def _load_scope(self, scope: str) -> tuple:
+        if scope not in self._scopes:
+            import numpy as np
+            rows = self._connect().execute("SELECT embedding, content FROM semantic_cache WHERE scope = ?", (scope,)).fetchall()
+            matrix = np.array([np.frombuffer(row[0], dtype=np.float32) for row in rows]) if rows else None
+            self._scopes[scope] = (matrix, [row[1] for row in rows])
+        return self._scopes[scope]
+    
+    def get(self, scope: str, embedding) -> str:
+        """Content của prompt gần nhất trong scope nếu cosine ≥ threshold, ngược lại None"""
+        vector = self._normalize(embedding)
+        with self._lock:
+            matrix, contents = self._load_scope(scope)
+            if matrix is None or matrix.shape[1] != vector.shape[0]:
+                return None
+            scores = matrix @ vector
+            best = int(scores.argmax())
+            return contents[best] if scores[best] >= self.threshold else None
+    
+    def put(self, scope: str, embedding, content: str):
+        import numpy as np
+        vector = self._normalize(embedding)
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT INTO semantic_cache (scope, embedding, content) VALUES (?, ?, ?)", (scope, vector.tobytes(), content))
+            conn.commit()
+            matrix, contents = self._load_scope(scope)
+            if matrix is None or matrix.shape[1] == vector.shape[0]:
+                matrix = vector[None, :] if matrix is None else np.vstack([matrix, vector])
+                self._scopes[scope] = (matrix, contents + [content])
+    
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class AIMDController:
+    """
+    Điều chỉnh số request đồng thời theo kiểu TCP AIMD:
+    tăng cộng (alpha) khi latency trung bình dưới target, giảm nhân (beta) khi gặp 429/5xx
+    """
+    
+    def __init__(self, initial: int = 4, min_concurrency: int = 1, max_concurrency: int = 32,
+                 alpha: float = 0.5, beta: float = 0.5, target_latency: float = 8.0, smoothing: float = 0.2):
+        self.limit = float(initial)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.alpha = alpha
+        self.beta = beta
+        self.target_latency = target_latency
+        self.smoothing = smoothing
+        self.avg_latency = None
+        self.in_flight = 0
+        self._condition = None
+        self._loop = None
+    
+    def _get_condition(self) -> asyncio.Condition:
+        # Condition gắn với event loop, tạo lại nếu chạy trong loop mới (mỗi lần asyncio.run)
+        loop = asyncio.get_running_loop()
+        if self._condition is None or self._loop is not loop:
+            self._condition = asyncio.Condition()
+            self._loop = loop
+        return self._condition
+    
+    async def acquire(self):
+        """Chờ đến khi số request đang chạy nhỏ hơn concurrency hiện tại"""
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+    
+    async def release(self):
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            condition.notify_all()
+    
+    def on_success(self, latency: float):
+        """Cập nhật moving average latency, tăng concurrency nếu còn dưới target"""
+        if self.avg_latency is None:
+            self.avg_latency = latency
+        else:
+            self.avg_latency = self.smoothing * latency + (1 - self.smoothing) * self.avg_latency
+        if self.avg_latency <= self.target_latency:
+            self.limit = min(self.max_concurrency, self.limit + self.alpha)
+    
+    def on_error(self):
+        """Giảm một nửa concurrency khi bị rate limit hoặc server lỗi"""
+        self.limit = max(self.min_concurrency, self.limit * self.beta)
+
+
+class TokenBucket:
+    """
+    Token bucket refill đều theo phút (RPM/TPM). reserve() trừ ngay capacity và trả về số giây
+    cần chờ trước khi gửi, nên dùng được cho cả code sync (time.sleep) lẫn async (asyncio.sleep)
+    """
+    
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.level = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _refill(self) -> float:
+        """Cộng phần capacity đã hồi từ lần cập nhật trước (gọi khi đang giữ lock); trả về rate mỗi giây"""
+        now = time.monotonic()
+        rate = self.capacity / RATE_LIMIT_WINDOW_SECONDS
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * rate)
+        self.updated_at = now
+        return rate
+    
+    def reserve(self, amount: float) -> float:
+        with self._lock:
+            rate = self._refill()
+            # Request lớn hơn cả bucket vẫn được gửi sau khi bucket đầy, không chờ mãi
+            self.level -= min(amount, self.capacity)
+            return max(0.0, -self.level / rate)
+    
+    def try_reserve(self, amount: float) -> bool:
+        """Chỉ trừ capacity khi đủ để gửi ngay (không phải chờ); False thì bucket giữ nguyên"""
+        with self._lock:
+            self._refill()
+            amount = min(amount, self.capacity)
+            if self.level < amount:
+                return False
+            self.level -= amount
+            return True
+    
+    def refund(self, amount: float):
+        """Trả lại capacity đã reserve nhưng không dùng đến"""
+        with self._lock:
+            self._refill()
+            self.level = min(self.capacity, self.level + min(amount, self.capacity))
+
+
+class OpenAIMarketResearch:
+    def __init__(self, api_key: str, industry: str = "Technology", market: str = "Việt Nam", model: str = "gpt-3.5-turbo", max_concurrency: int = 10, cache_enabled: bool = False,
+                 requests_per_minute: int = None, tokens_per_minute: int = None, semantic_cache: bool = False,
+                 hedge_delay: float = HEDGE_DELAY_SECONDS):
+        """
+        Khởi tạo class nghiên cứu thị trường với OpenAI GPT
+        
+        Args:
+            api_key (str): API key của OpenAI
+            industry (str): Ngành công nghiệp nghiên cứu
+            market (str): Thị trường nghiên cứu
+            model (str): Model GPT sử dụng
+            max_concurrency (int): Số request đồng thời tối đa của async call pool
+            cache_enabled (bool): Dùng lại response đã lưu (không hết hạn) cho request trùng khớp (model + messages + max_tokens);
+                mặc định tắt vì response temperature 0.7 sẽ bị lặp lại mãi, mỗi lần hit đều được log
+            requests_per_minute (int): RPM limit của account; None = lấy từ x-ratelimit-limit-requests
+            tokens_per_minute (int): TPM limit của account; None = lấy từ x-ratelimit-limit-tokens
+            semantic_cache (bool): Dùng lại response của prompt gần giống (cosine embedding ≥ SEMANTIC_CACHE_THRESHOLD)
+            hedge_delay (float): Số giây chờ trước khi gửi hedged request cho async call; None = tắt hedging
+        """
+        self.api_key = api_key
+        self.client = openai.OpenAI(
+            api_key=api_key,
+            http_client=openai.DefaultHttpxClient(http2=HTTP2_AVAILABLE, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+        )
+        # Một AsyncClient (connection pool) dùng chung cho mọi async call, đóng bằng aclose()
+        self.aclient = self._create_async_client()
+        self.industry = industry
+        self.market = market
+        self.model = model
+        
+        # Header-driven throttle: trạng thái rate limit lấy từ response headers
+        self.rate_limit_state = {}
+        self.request_timestamps = deque()  # Sliding window các request trong 60s gần nhất
+        # Token bucket RPM/TPM: chờ chủ động trước khi gửi thay vì đợi 429 rồi backoff
+        self.rpm_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tpm_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        
+        # AIMD concurrency cho async call pool
+        self.concurrency = AIMDController(initial=min(4, max_concurrency), max_concurrency=max_concurrency)
+        self.hedge_delay = hedge_delay
+        self.hedge_stats = {'requests': 0, 'hedged': 0, 'hedge_won': 0}
+        
+        # Encoder tiktoken cho token-budget guard (load lazy, None nếu không dùng được)
+        self._encoder = None
+        self._encoder_loaded = False
+        # Mỗi request đếm token nhiều lần (token bucket, chọn model, retry, hedge) và system preamble
+        # lặp lại ở mọi request - nhớ số token theo nội dung để chỉ encode một lần
+        self._count_tokens = functools.lru_cache(maxsize=1024)(self._count_tokens_uncached)
+        
+        # Cache các đoạn prompt tĩnh (render theo industry/market)
+        self._prompt_fragments_key = None
+        
+        # Cache generated_prompt Layer 3 và response API giữa các lần chạy (SQLite)
+        self.prompt_cache = PromptCache(os.path.join("output", "prompt_cache.sqlite"))
+        self.cache_enabled = cache_enabled
+        self._inflight_requests = {}  # cache key → asyncio.Task của request async đang chạy
+        # Semantic cache (opt-in): tốn thêm một embedding call cho mỗi cache miss
+        self.semantic_cache = SemanticPromptCache(os.path.join("output", "semantic_cache.sqlite")) if semantic_cache else None
+        # Thống kê prompt cache phía OpenAI (usage.prompt_tokens_details.cached_tokens)
+        self.prompt_cache_stats = {'prompt_tokens': 0, 'cached_tokens': 0}
+        
+        # Reference tracking system
+        self.reference_tracker = Counter()
+        
+        setup_progress_logging()
+        
+        print(f"🤖 Initialized OpenAI Market Research for {industry} in {market}")
+        print(f"📊 API Provider: OpenAI")
+        print(f"🔧 Model: {model}")
+        
+    def call_openai_api(self, prompt: str, max_tokens: int = 1200, max_retries: int = 3, system: str = None, on_delta: Callable[[str], Any] = None) -> str:
+        """
+        Gửi request tới OpenAI API với retry logic và track references
+        
+        max_tokens nên sát với độ dài output mong đợi: OpenAI tính TPM reservation
+        theo max_tokens, đặt dư sẽ dễ bị 429 sớm hơn cần thiết.
+        system (nếu có) được gửi thành message role "system" đứng đầu để server cache prefix.
+        Khi cache_enabled, request trùng khớp với lần gọi trước trả về response đã lưu, không gọi API.
+        on_delta (nếu có) bật streaming: được gọi với từng đoạn text ngay khi nhận, trả về False để dừng sớm.
+        """
+        messages = self._build_messages(prompt, system)
+        cache_key = self._cached_response_key(messages, max_tokens)
+        cached = self._cached_response(cache_key)
+        if cached is not None:
+            return cached
+        
+        embedding = None
+        if self.semantic_cache is not None:
+            embedding = self._embed_for_cache(messages)
+            cached = self._semantic_cache_get(messages, max_tokens, embedding)
+            if cached is not None:
+                return cached
+        
+        for attempt in range(max_retries):
+            try:
+                wait_time = self._reserve_rate_capacity(messages, max_tokens)
+                if wait_time > 0:
+                    time.sleep(wait_time)
+                self._throttle()
+                if on_delta is not None:
+                    content, complete = self._stream_content(messages, max_tokens, on_delta)
+                else:
+                    raw_response = self.client.chat.completions.with_raw_response.create(
+                        model=self._model_for(messages, max_tokens),
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=0.7
+                    )
+                    self._update_rate_limit_state(raw_response.headers)
+                    content, complete = self._extract_content(raw_response), True
+                
+                if content is None:
+                    return "Không có nội dung trong phản hồi API"
+                
+                # Track references from the response
+                self.track_references_from_response(content)
+                if complete:
+                    self._cache_response(cache_key, messages, max_tokens, embedding, content)
+                
+                return content
+                    
+            except (openai.APIStatusError, openai.APIConnectionError) as e:
+                status = getattr(e, 'status_code', None)  # APIConnectionError/timeout không có status
+                if status is not None and status not in RETRYABLE_STATUS_CODES:
+                    print(f"❌ API Error: {e}")
+                    return f"API Error: {e}"
+                if attempt == max_retries - 1:
+                    print(f"❌ Max retries reached. Error: {e}")
+                    return f"Rate limit error after {max_retries} retries: {e}"
+                wait_time = self._backoff_seconds(e, attempt)
+                print(f"⚠️ API {status or 'connection error'} - Waiting {wait_time:.1f}s before retry {attempt + 1}/{max_retries}")
+                time.sleep(wait_time)
+            except Exception as e:
+                print(f"❌ API Error: {e}")
+                return f"API Error: {e}"
+        
+        return "Failed after all retries"
+    
+    async def call_openai_api_async(self, prompt: str, max_tokens: int = 1200, max_retries: int = 3, system: str = None, on_delta: Callable[[str], Any] = None) -> str:
+        """
+        Phiên bản async của call_openai_api, số request đồng thời do AIMDController điều chỉnh
+        
+        on_delta (nếu có) bật streaming như bản sync; task bị cancel sẽ đóng stream ngay ở chunk đang nhận.
+        Các request trùng khớp đang chạy song song (cùng cache key) chỉ gửi một lần và dùng chung kết quả.
+        """
+        messages = self._build_messages(prompt, system)
+        cache_key = self._cached_response_key(messages, max_tokens)
+        cached = self._cached_response(cache_key)
+        if cached is not None:
+            return cached
+        
+        if on_delta is not None:
+            return await self._call_openai_api_async_uncached(messages, cache_key, max_tokens, max_retries, on_delta)
+        
+        # Category/question trùng prompt giữa các layer: request sau chờ request đang chạy thay vì gọi API lần nữa
+        task = self._inflight_requests.get(cache_key)
+        if task is not None:
+            content = await asyncio.shield(task)
+            self.track_references_from_response(content)
+            return content
+        
+        task = asyncio.ensure_future(self._call_openai_api_async_uncached(messages, cache_key, max_tokens, max_retries, None))
+        self._inflight_requests[cache_key] = task
+        task.add_done_callback(lambda _: self._inflight_requests.pop(cache_key, None))
+        return await asyncio.shield(task)
+    
+    async def _call_openai_api_async_uncached(self, messages: list, cache_key: str, max_tokens: int, max_retries: int, on_delta: Callable[[str], Any]) -> str:
+        embedding = None
+        if self.semantic_cache is not None:
+            embedding = await self._embed_for_cache_async(messages)
+            cached = self._semantic_cache_get(messages, max_tokens, embedding)
+            if cached is not None:
+                return cached
+        
+        for attempt in range(max_retries):
+            wait_time = self._reserve_rate_capacity(messages, max_tokens)
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+            wait_time = 0
+            await self.concurrency.acquire()
+            start = time.monotonic()
+            try:
+                if on_delta is not None:
+                    content, complete = await self._stream_content_async(messages, max_tokens, on_delta)
+                else:
+                    raw_response = await self._create_hedged_async(messages, max_tokens)
+                    self._update_rate_limit_state(raw_response.headers)
+                    content, complete = self._extract_content(raw_response), True
+                self.concurrency.on_success(time.monotonic() - start)
+                
+                if content is None:
+                    return "Không có nội dung trong phản hồi API"
+                self.track_references_from_response(content)
+                if complete:
+                    self._cache_response(cache_key, messages, max_tokens, embedding, content)
+                return content
+                    
+            except (openai.APIStatusError, openai.APIConnectionError) as e:
+                status = getattr(e, 'status_code', None)
+                if status is not None and status not in RETRYABLE_STATUS_CODES:
+                    print(f"❌ API Error: {e}")
+                    return f"API Error: {e}"
+                self.concurrency.on_error()
+                if attempt == max_retries - 1:
+                    print(f"❌ Max retries reached. Error: {e}")
+                    return f"Rate limit error after {max_retries} retries: {e}"
+                wait_time = self._backoff_seconds(e, attempt)
+                print(f"⚠️ API {status or 'connection error'} - concurrency giảm còn {int(self.concurrency.limit)}, chờ {wait_time:.1f}s (retry {attempt + 1}/{max_retries})")
+            except Exception as e:
+                print(f"❌ API Error: {e}")
+                return f"API Error: {e}"
+            finally:
+                await self.concurrency.release()
+            
+            # Backoff sau khi trả slot để không giữ concurrency trong lúc chờ
+            await asyncio.sleep(wait_time)
+        
+        return "Failed after all retries"
+    
+    async def _create_hedged_async(self, messages: list, max_tokens: int):
+        """
+        Gửi chat completion (raw response); nếu sau hedge_delay giây chưa xong thì gửi thêm một request
+        giống hệt và lấy kết quả về trước, request còn lại bị cancel. Hedge dùng chung concurrency slot
+        với request gốc và bỏ qua khi token bucket đã cạn để không tự gây 429.
+        """
+        def create():
+            return asyncio.ensure_future(self.aclient.chat.completions.with_raw_response.create(
+                model=self._model_for(messages, max_tokens),
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=0.7
+            ))
+        
+        stats = self.hedge_stats
+        stats['requests'] += 1
+        first = create()
+        pending = {first}
+        try:
+            if self.hedge_delay is None:
+                return await first
+            done, pending = await asyncio.wait(pending, timeout=self.hedge_delay)
+            if done or not self._try_reserve_rate_capacity(messages, max_tokens):
+                return await first
+            
+            stats['hedged'] += 1
+            second = create()
+            pending.add(second)
+            errors = []
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            stats['hedge_won'] += 1
+                        return task.result()
+                    errors.append(task.exception())
+            raise errors[0]
+        finally:
+            for task in pending:
+                task.cancel()
+            self._check_hedge_rate()
+    
+    def _check_hedge_rate(self):
+        """Tắt hedging khi quá HEDGE_MAX_RATE request phải hedge - tăng hedge_delay thay vì đốt thêm token"""
+        stats = self.hedge_stats
+        if self.hedge_delay is not None and stats['requests'] >= HEDGE_MIN_SAMPLES and stats['hedged'] / stats['requests'] > HEDGE_MAX_RATE:
+            print(f"⚠️ Hedged {stats['hedged']}/{stats['requests']} requests (> {HEDGE_MAX_RATE:.0%}) - tắt hedging, hedge_delay {self.hedge_delay}s quá thấp so với latency hiện tại")
+            self.hedge_delay = None
+    
+    def _get_encoder(self):
+        """tiktoken encoder cho model hiện tại; None nếu chưa cài tiktoken hoặc không tải được encoding"""
+        if not self._encoder_loaded:
+            self._encoder_loaded = True
+            if tiktoken is not None:
+                try:
+                    try:
+                        self._encoder = tiktoken.encoding_for_model(self.model)
+                    except KeyError:  # Model mới chưa có trong bảng của tiktoken
+                        self._encoder = tiktoken.get_encoding("cl100k_base")
+                except Exception as e:
+                    print(f"⚠️ Không load được tiktoken encoding ({e}) - dùng ước lượng theo ký tự")
+        return self._encoder
+    
+    def _estimate_tokens(self, messages: list) -> int:
+        """Đếm token của messages; fallback ước lượng bảo thủ ~2 ký tự/token (tiếng Việt) khi không có tiktoken"""
+        return sum(self._count_tokens(message.get("content") or "") + MESSAGE_TOKEN_OVERHEAD for message in messages)
+    
+    def _count_tokens_uncached(self, text: str) -> int:
+        encoder = self._get_encoder()
+        return len(encoder.encode(text)) if encoder else len(text) // 2
+    
+    def _context_window(self, model: str) -> int:
+        matches = [prefix for prefix in MODEL_CONTEXT_WINDOWS if model.startswith(prefix)]
+        return MODEL_CONTEXT_WINDOWS[max(matches, key=len)] if matches else DEFAULT_CONTEXT_WINDOW
+    
+    def _max_output_tokens(self, model: str) -> int:
+        matches = [prefix for prefix in MODEL_MAX_OUTPUT_TOKENS if model.startswith(prefix)]
+        return MODEL_MAX_OUTPUT_TOKENS[max(matches, key=len)] if matches else DEFAULT_MAX_OUTPUT_TOKENS
+    
+    def _batch_limit(self, batch_size: int, per_item_tokens: int) -> int:
+        """
+        Số item tối đa gộp vào một request sao cho tổng budget (per_item_tokens × số item) không vượt output limit
+        của model - cắt budget thay vì cắt batch sẽ làm response bị truncate, tách thất bại và phải gọi lại từng item
+        """
+        limit = max(1, min(batch_size, self._max_output_tokens(self.model) // per_item_tokens))
+        if limit < batch_size:
+            print(f"⚠️ Giảm batch size {batch_size} → {limit}: {self.model} chỉ sinh tối đa {self._max_output_tokens(self.model)} tokens output mỗi request")
+        return limit
+    
+    def _cached_response_key(self, messages: list, max_tokens: int) -> str:
+        """Key của request (dùng cho response cache và gộp request async trùng nhau đang chạy)"""
+        return PromptCache.make_key("response", self.model, str(max_tokens), *(f'{m["role"]}:{m["content"]}' for m in messages))
+    
+    def _cached_response(self, cache_key: str) -> str:
+        """Response đã lưu cho request trùng khớp; None nếu cache_enabled=False hoặc chưa có"""
+        if not self.cache_enabled:
+            return None
+        cached = self.prompt_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"    💾 Response cache hit - dùng lại response đã lưu (cache_enabled=True)")
+            self.track_references_from_response(cached)
+        return cached
+    
+    def _cache_response(self, cache_key: str, messages: list, max_tokens: int, embedding, content: str):
+        """Lưu response vào exact-match cache (nếu cache_enabled) và semantic cache (nếu có embedding)"""
+        if self.cache_enabled:
+            self.prompt_cache.set(cache_key, content)
+        if embedding is not None:
+            self.semantic_cache.put(self._semantic_cache_scope(messages, max_tokens), embedding, content)
+    
+    def _semantic_cache_scope(self, messages: list, max_tokens: int) -> str:
+        # Chỉ so sánh trong cùng model / max_tokens / system preamble (industry, market)
+        system = messages[0]["content"] if messages[0]["role"] == "system" else ""
+        return PromptCache.make_key(self.model, str(max_tokens), system)
+    
+    def _semantic_cache_get(self, messages: list, max_tokens: int, embedding) -> str:
+        if embedding is None:
+            return None
+        cached = self.semantic_cache.get(self._semantic_cache_scope(messages, max_tokens), embedding)
+        if cached is not None:
+            logger.info(f"    🧠 Semantic cache hit - dùng lại response của prompt tương tự")
+            self.track_references_from_response(cached)
+        return cached
+    
+    def _embed_for_cache(self, messages: list) -> list:
+        """Embedding phần đuôi của user prompt; None nếu embedding call lỗi (bỏ qua semantic cache)"""
+        try:
+            response = self.client.embeddings.create(model=SEMANTIC_CACHE_EMBEDDING_MODEL, input=messages[-1]["content"][-SEMANTIC_CACHE_MAX_CHARS:])
+            return response.data[0].embedding
+        except (openai.APIStatusError, openai.APIConnectionError) as e:
+            print(f"⚠️ Không tạo được embedding cho semantic cache: {e}")
+            return None
+    
+    async def _embed_for_cache_async(self, messages: list) -> list:
+        try:
+            response = await self.aclient.embeddings.create(model=SEMANTIC_CACHE_EMBEDDING_MODEL, input=messages[-1]["content"][-SEMANTIC_CACHE_MAX_CHARS:])
+            return response.data[0].embedding
+        except (openai.APIStatusError, openai.APIConnectionError) as e:
+            print(f"⚠️ Không tạo được embedding cho semantic cache: {e}")
+            return None
+    
+    def _build_messages(self, prompt: str, system: str = None) -> list:
+        messages = [{"role": "system", "content": system}] if system else []
+        messages.append({"role": "user", "content": prompt})
+        return messages
+    
+    def _model_for(self, messages: list, max_tokens: int) -> str:
+        """Giữ self.model nếu messages + max_tokens vừa context window, nếu không chuyển sang LARGE_CONTEXT_MODEL"""
+        needed = self._estimate_tokens(messages) + max_tokens
+        if needed <= self._context_window(self.model):
+            return self.model
+        print(f"⚠️ Prompt ~{needed} tokens vượt context của {self.model} - dùng {LARGE_CONTEXT_MODEL}")
+        return LARGE_CONTEXT_MODEL
+    
+    def _record_prompt_cache_usage(self, usage: Dict[str, Any]):
+        """Cộng dồn prompt_tokens / cached_tokens (prompt cache phía server) từ usage của response"""
+        cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        self.prompt_cache_stats['prompt_tokens'] += usage.get("prompt_tokens") or 0
+        self.prompt_cache_stats['cached_tokens'] += cached
+        if cached:
+            logger.info(f"    🧊 Prompt cache hit: {cached}/{usage.get('prompt_tokens')} tokens")
+    
+    def _stream_content(self, messages: list, max_tokens: int, on_delta: Callable[[str], Any]) -> tuple:
+        """
+        Stream completion, gọi on_delta(delta) cho từng đoạn text; on_delta trả về False thì đóng stream.
+        Trả về (content, complete) - content bị dừng sớm không được đưa vào response cache.
+        """
+        stream = self.client.chat.completions.create(
+            model=self._model_for(messages, max_tokens),
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=0.7,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        self._update_rate_limit_state(stream.response.headers)
+        parts = []
+        with stream:
+            for chunk in stream:
+                if chunk.usage is not None:
+                    self._record_prompt_cache_usage(chunk.usage.model_dump())
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    if on_delta(delta) is False:
+                        return "".join(parts), False
+        return ("".join(parts) if parts else None), True
+    
+    async def _stream_content_async(self, messages: list, max_tokens: int, on_delta: Callable[[str], Any]) -> tuple:
+        """Bản async của _stream_content"""
+        stream = await self.aclient.chat.completions.create(
+            model=self._model_for(messages, max_tokens),
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=0.7,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        self._update_rate_limit_state(stream.response.headers)
+        parts = []
+        async with stream:
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    self._record_prompt_cache_usage(chunk.usage.model_dump())
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    if on_delta(delta) is False:
+                        return "".join(parts), False
+        return ("".join(parts) if parts else None), True
+    
+    def _extract_content(self, raw_response) -> str:
+        """Parse body bằng orjson và lấy thẳng message content, bỏ qua bước dựng pydantic model của SDK"""
+        payload = orjson.loads(raw_response.http_response.content)
+        self._record_prompt_cache_usage(payload.get("usage") or {})
+        try:
+            return payload["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError):
+            return None
+    
+    def _create_async_client(self) -> openai.AsyncOpenAI:
+        return openai.AsyncOpenAI(
+            api_key=self.api_key,
+            http_client=openai.DefaultAsyncHttpxClient(http2=HTTP2_AVAILABLE, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+        )
+    
+    async def aclose(self):
+        """Đóng connection pool của async client sau khi chạy xong"""
+        await self.aclient.close()
+    
+    def close(self):
+        """Đóng connection pool của sync và async client và các SQLite cache"""
+        self.client.close()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            asyncio.run(self.aclose())
+        else:
+            # Gọi từ trong event loop (nên dùng await aclose()): không chặn loop, đóng async client ở task riêng
+            self._aclose_task = loop.create_task(self.aclose())
+        self.prompt_cache.close()
+        if self.semantic_cache is not None:
+            self.semantic_cache.close()
+    
+    def _run_async(self, coro):
+        """
+        Chạy coroutine từ code sync (CLI/Streamlit). Connection pool gắn với event loop nên
+        được đóng khi loop kết thúc và tạo mới cho lần chạy sau.
+        """
+        async def runner():
+            try:
+                return await coro
+            finally:
+                await self.aclose()
+        
+        try:
+            return asyncio.run(runner())
+        finally:
+            self.aclient = self._create_async_client()
+    
+    def _update_rate_limit_state(self, headers):
+        """Lưu remaining/limit/reset từ x-ratelimit-* headers của response gần nhất"""
+        state = {'updated_at': time.monotonic()}
+        for kind in ('requests', 'tokens'):
+            remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+            limit = headers.get(f'x-ratelimit-limit-{kind}')
+            if remaining is not None and remaining.isdigit():
+                state[f'remaining_{kind}'] = int(remaining)
+            if limit is not None and limit.isdigit():
+                state[f'limit_{kind}'] = int(limit)
+            state[f'reset_{kind}'] = parse_reset_seconds(headers.get(f'x-ratelimit-reset-{kind}', ''))
+        self.rate_limit_state = state
+        
+        # Chưa cấu hình RPM/TPM thì lấy limit của account từ headers cho token bucket
+        if self.rpm_bucket is None and state.get('limit_requests'):
+            self.rpm_bucket = TokenBucket(state['limit_requests'])
+        if self.tpm_bucket is None and state.get('limit_tokens'):
+            self.tpm_bucket = TokenBucket(state['limit_tokens'])
+    
+    def _reserve_rate_capacity(self, messages: list, max_tokens: int) -> float:
+        """Lấy 1 request + (prompt tokens + max_tokens) từ các token bucket; trả về số giây cần chờ"""
+        wait_time = 0.0
+        if self.rpm_bucket is not None:
+            wait_time = self.rpm_bucket.reserve(1)
+        if self.tpm_bucket is not None:
+            # OpenAI tính TPM theo prompt tokens + max_tokens tại thời điểm nhận request
+            wait_time = max(wait_time, self.tpm_bucket.reserve(self._estimate_tokens(messages) + max_tokens))
+        return wait_time
+    
+    def _try_reserve_rate_capacity(self, messages: list, max_tokens: int) -> bool:
+        """
+        Giống _reserve_rate_capacity nhưng chỉ lấy capacity khi gửi được ngay; trả về False (không bucket
+        nào bị trừ) nếu phải chờ - dùng cho request tùy chọn như hedge để không chiếm quota của request thật
+        """
+        if self.rpm_bucket is not None and not self.rpm_bucket.try_reserve(1):
+            return False
+        if self.tpm_bucket is not None and not self.tpm_bucket.try_reserve(self._estimate_tokens(messages) + max_tokens):
+            if self.rpm_bucket is not None:
+                self.rpm_bucket.refund(1)
+            return False
+        return True
+    
+    def _throttle(self):
+        """Chỉ tạm dừng khi capacity còn lại (theo headers hoặc sliding window) sắp cạn"""
+        now = time.monotonic()
+        while self.request_timestamps and now - self.request_timestamps[0] > RATE_LIMIT_WINDOW_SECONDS:
+            self.request_timestamps.popleft()
+        
+        wait_time = 0.0
+        state = self.rate_limit_state
+        for kind in ('requests', 'tokens'):
+            remaining = state.get(f'remaining_{kind}')
+            if remaining is None:
+                continue
+            limit = state.get(f'limit_{kind}', 0)
+            if remaining < max(limit * RATE_LIMIT_HEADROOM, RATE_LIMIT_MIN_REMAINING):
+                elapsed = now - state['updated_at']
+                wait_time = max(wait_time, state[f'reset_{kind}'] - elapsed)
+        
+        # Sliding window: không gửi quá limit_requests trong 60s kể cả khi headers đã cũ
+        limit_requests = state.get('limit_requests')
+        if limit_requests and len(self.request_timestamps) >= limit_requests:
+            wait_time = max(wait_time, RATE_LIMIT_WINDOW_SECONDS - (now - self.request_timestamps[0]))
+        
+        if wait_time > 0:
+            print(f"⏳ Rate limit headroom thấp - chờ {wait_time:.1f}s")
+            time.sleep(wait_time)
+        
+        self.request_timestamps.append(time.monotonic())
+    
+    def _backoff_seconds(self, error: Exception, attempt: int) -> float:
+        """
+        Ưu tiên retry-after từ server (cộng thêm tối đa 1s jitter), fallback exponential backoff
+        5, 10, 20s nhân jitter 0.5-1.5x để các request song song không retry đồng loạt
+        """
+        retry_after = self._retry_after_seconds(error)
+        if retry_after:
+            return retry_after + random.uniform(0, 1)
+        return (2 ** attempt) * 5 * random.uniform(0.5, 1.5)
+    
+    def _retry_after_seconds(self, error: Exception) -> float:
+        """Đọc header retry-after-ms / retry-after từ lỗi 429 (nếu có)"""
+        response = getattr(error, 'response', None)
+        if response is None:
+            return 0.0
+        for header, scale in (('retry-after-ms', 0.001), ('retry-after', 1.0)):
+            value = response.headers.get(header)
+            try:
+                if value:
+                    return float(value) * scale
+            except ValueError:
+                continue
+        return 0.0
+    
+    def track_references_from_response(self, content: str):
+        """Extract and track references from AI response"""
+        
+        for source in scan_references(content):
+            source = source.strip()
+            if source and len(source) > 3:  # Avoid very short matches
+                # Normalize source name
+                normalized_source = self.normalize_source_name(source)
+                
+                # Track frequency
+                self.reference_tracker[normalized_source] += 1
+    
+    def normalize_source_name(self, source: str) -> str:
+        """Normalize source names for consistent tracking"""
+        source = source.strip()
+        
+        # Mapping for common variations
+        mappings = {
+            'Tổng cục Thống kê': 'General Statistics Office (GSO)',
+            'General Statistics Office': 'General Statistics Office (GSO)',
+            'GSO': 'General Statistics Office (GSO)',
+            'Ngân hàng Thế giới': 'World Bank',
+            'World Bank': 'World Bank',
+            'IMF': 'International Monetary Fund (IMF)',
+            'International Monetary Fund': 'International Monetary Fund (IMF)',
+            'McKinsey': 'McKinsey & Company',
+            'Deloitte': 'Deloitte Consulting',
+            'PwC': 'PricewaterhouseCoopers (PwC)',
+            'KPMG': 'KPMG International',
+            'Nielsen': 'Nielsen Holdings',
+            'Euromonitor': 'Euromonitor International',
+            'Statista': 'Statista GmbH',
+            'VCCI': 'Vietnam Chamber of Commerce and Industry (VCCI)',
+            'Vietnam Chamber of Commerce': 'Vietnam Chamber of Commerce and Industry (VCCI)',
+        }
+        
+        return mappings.get(source, source)
+    
+    def get_top_references(self, limit: int = 10) -> list:
+        """Get top references sorted by frequency"""
+        return self.reference_tracker.most_common(limit)
+
+    def _ensure_prompt_fragments(self):
+        """Render các đoạn prompt bất biến một lần, chỉ render lại khi industry/market thay đổi"""
+        key = (self.industry, self.market)
+        if self._prompt_fragments_key == key:
+            return
+        vietnamese_market = self.get_vietnamese_market_name(self.market)
+        # Preamble vai trò gửi dưới dạng system message chung cho mọi prompt Layer 3/4
+        self._system_preamble = SYSTEM_PREAMBLE_TEMPLATE.format(industry=self.industry, market=self.market)
+        self._layer3_rules = LAYER3_RULES_TEMPLATE.format(market=self.market)
+        self._layer3_category_rules = LAYER3_CATEGORY_RULES_TEMPLATE.format(industry=self.industry, market=vietnamese_market)
+        self._layer4_enhancement_request = LAYER4_ENHANCEMENT_REQUEST_TEMPLATE.format(industry=self.industry, market=self.market)
+        self._layer4_report_rules = LAYER4_REPORT_RULES_TEMPLATE.format(market=vietnamese_market)
+        self._prompt_fragments_key = key
+
+    def create_layer3_prompt_request(self, layer1: str, layer2: str, main_question: str, purpose: str) -> str:
+        """Tạo request để lấy prompt Layer 3 (main question level) - DIRECT ANSWER FOCUSED"""
+        self._ensure_prompt_fragments()
+        return "".join([
+            self._layer3_rules,
+            "MỤC ĐÍCH NGHIÊN CỨU: ", purpose,
+            "\n\nNGỮ CẢNH PHÂN TÍCH:\n- Chủ đề chính: ", layer1,
+            "\n- Lĩnh vực: ", layer2,
+            "\n\nCÂU HỎI CẦN TRẢ LỜI: \"", main_question, "\""
+        ])
+
+    def create_layer3_batch_prompt(self, layer1: str, layer2: str, questions: list, purpose: str) -> str:
+        """Tạo một prompt Layer 3 cho nhiều main questions - preamble chỉ gửi một lần"""
+        self._ensure_prompt_fragments()
+        questions_text = "\n".join([f"{i}. {q}" for i, q in enumerate(questions, 1)])
+        answer_format = "\n".join([f"### ANSWER {i} ###\n<câu trả lời cho câu hỏi {i}>" for i in range(1, len(questions) + 1)])
+        
+        return "".join([
+            self._layer3_rules,
+            "MỤC ĐÍCH NGHIÊN CỨU: ", purpose,
+            "\n\nNGỮ CẢNH PHÂN TÍCH:\n- Chủ đề chính: ", layer1,
+            "\n- Lĩnh vực: ", layer2,
+            "\n\nCÁC CÂU HỎI CẦN TRẢ LỜI (trả lời riêng từng câu, áp dụng yêu cầu phía trên cho mỗi câu):\n",
+            questions_text,
+            "\n\n**FORMAT BẮT BUỘC:** Trả lời đủ ", str(len(questions)),
+            " câu hỏi theo đúng thứ tự, mỗi câu trả lời mở đầu bằng dòng delimiter:\n",
+            answer_format
+        ])
+
+    def create_layer3_comprehensive_category_prompt(self, layer1: str, layer2: str, all_questions: list, purpose: str) -> str:
+        """Tạo prompt để phân tích comprehensive cho toàn bộ category (Layer 3 mode)"""
+        self._ensure_prompt_fragments()
+        questions_text = "\n".join([f"- {q}" for q in all_questions])
+        
+        return "".join([
+            self._layer3_category_rules,
+            "MỤC ĐÍCH NGHIÊN CỨU: \"", purpose,
+            "\"\nNGỮ CẢNH: ", layer1, " > ", layer2,
+            "\nCATEGORY: \"", layer2,
+            "\"\n\nCÁC CÂU HỎI CẦN TRẢ LỜI TOÀN DIỆN:\n", questions_text
+        ])
+
+    def create_layer3_multi_category_prompt(self, layer1: str, categories: list, purpose: str) -> str:
+        """Tạo một prompt comprehensive cho nhiều category [(category_name, questions)] cùng layer - rules chỉ gửi một lần"""
+        self._ensure_prompt_fragments()
+        blocks = []
+        for i, (category_name, questions) in enumerate(categories, 1):
+            questions_text = "\n".join([f"- {q}" for q in questions])
+            blocks.append(f"CATEGORY {i}: \"{category_name}\" (NGỮ CẢNH: {layer1} > {category_name})\nCÁC CÂU HỎI CẦN TRẢ LỜI TOÀN DIỆN:\n{questions_text}")
+        answer_format = "\n".join([f"### ANSWER {i} ###\n<phân tích comprehensive cho category {i}>" for i in range(1, len(categories) + 1)])
+        
+        return "".join([
+            self._layer3_category_rules,
+            "MỤC ĐÍCH NGHIÊN CỨU: \"", purpose,
+            "\"\n\nCÁC CATEGORY CẦN PHÂN TÍCH (viết phân tích độc lập cho từng category, áp dụng yêu cầu phía trên cho mỗi category):\n\n",
+            "\n\n".join(blocks),
+            "\n\n**FORMAT BẮT BUỘC:** Viết đủ ", str(len(categories)),
+            " phân tích theo đúng thứ tự category, mỗi phân tích mở đầu bằng dòng delimiter:\n",
+            answer_format
+        ])
+
+    def create_layer4_enhancement_prompt(self, layer1: str, layer2: str, main_question: str, sub_question: str, layer3_content: str, purpose: str) -> str:
+        """Tạo prompt để enhance specific section từ Layer 3 lên Layer 4"""
+        self._ensure_prompt_fragments()
+        return "".join([
+            self._layer4_enhancement_request,
+            "The research purpose is: \"", purpose,
+            "\"\nStructure: layer 1: ", layer1, " | layer 2: ", layer2, " | layer 3: ", main_question,
+            "\n\nEXISTING LAYER 3 CONTENT TO ENHANCE:\n", layer3_content,
+            "\n\nSPECIFIC ENHANCEMENT REQUEST (Layer 4):\n", sub_question
+        ])
 
-**KẾT THÚC** với conclusion trả lời hoàn chỉnh câu hỏi chính.'''
+    def create_layer4_comprehensive_report_prompt(self, layer1: str, layer2: str, main_question: str, sub_questions: list, layer3_content: str, purpose: str) -> str:
+        """Tạo prompt để tạo báo cáo Layer 4 tổng hợp - DIRECT CONTENT, NO INTRO"""
         
-        return template
+        self._ensure_prompt_fragments()
+        sub_questions_text = "\n".join([f"- {sq}" for sq in sub_questions])
+        
+        return "".join([
+            self._layer4_report_rules,
+            "NGỮ CẢNH: ", layer1, " > ", layer2,
+            "\n\nPHÂN TÍCH SẴN CÓ (Layer 3):\n", layer3_content,
+            "\n\nCÁC KHÍA CẠNH CHI TIẾT CẦN PHÂN TÍCH:\n", sub_questions_text,
+            "\n\nCÂU HỎI CHÍNH CẦN TRẢ LỜI: \"", main_question, "\""
+        ])
 
-    def process_layer3_research(self, json_file: str = "market_research_structured.json", limit: int = None) -> Dict[str, Any]:
+    def process_layer3_research(self, json_file: str = "market_research_structured.json", limit: int = None, checkpoint_file: str = None, batch_size: int = 1, data: Dict[str, Any] = None) -> Dict[str, Any]:
         """
         Xử lý nghiên cứu thị trường ở Layer 3 standard (main questions only)
         
         Args:
             json_file (str): Đường dẫn file JSON chứa dữ liệu
             limit (int): Giới hạn số questions để test (None = unlimited)
+            checkpoint_file (str): File JSONL lưu từng question đã xong để resume khi bị gián đoạn
+            batch_size (int): Số main questions cùng category gửi chung một API call (1 = không batch), giới hạn bởi output limit của model
+            data (dict): Dữ liệu có cấu trúc đã có sẵn trong memory - nếu có thì bỏ qua json_file
             
         Returns:
             Dict: Kết quả nghiên cứu thị trường Layer 3
         """
         
-        # Đọc file JSON
-        with open(json_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        purpose, flat, completed, checkpoint, checkpoint_file = self._prepare_layer3_run(json_file, data, limit, checkpoint_file)
+        total_questions = len(flat)
+        processed_questions = 0
+        batch_size = self._batch_limit(batch_size, 1400)
+        
+        category_questions = defaultdict(list)  # (layer_name, category_name) -> question results
+        current_layer = None
+        
+        for (layer_name, category_name), group in groupby(flat, key=lambda item: item[:2]):
+            questions = [question for _, _, question in group]
+            if layer_name != current_layer:
+                logger.info(f"\n🔥 Đang xử lý Layer: {layer_name}")
+                current_layer = layer_name
+            logger.info(f"📋 Category: {category_name}")
+            
+            # Gom batch_size questions vào một API call (batch_size=1 giữ flow 2 bước cũ)
+            for start in range(0, len(questions), batch_size):
+                chunk = questions[start:start + batch_size]
+                pending = []
+                
+                for question in chunk:
+                    main_question = question.get('main_question', '')
+                    processed_questions += 1
+                    progress = (processed_questions / total_questions) * 100
+                    
+                    logger.info(f"  ❓ [{processed_questions}/{total_questions}] ({progress:.1f}%) Processing: {main_question[:50]}...")
+                    
+                    if (layer_name, category_name, main_question) in completed:
+                        logger.info(f"    ♻️ Dùng lại kết quả từ checkpoint")
+                    else:
+                        pending.append(main_question)
+                
+                answers = iter(self._research_layer3_questions(layer_name, category_name, pending, purpose))
+                
+                for question in chunk:
+                    main_question = question.get('main_question', '')
+                    checkpoint_key = (layer_name, category_name, main_question)
+                    if checkpoint_key in completed:
+                        category_questions[(layer_name, category_name)].append(completed[checkpoint_key])
+                        continue
+                    
+                    question_result = self._layer3_question_result(question, *next(answers))
+                    category_questions[(layer_name, category_name)].append(question_result)
+                    self._write_checkpoint(checkpoint, layer_name, category_name, question_result)
+                
+                if pending:
+                    logger.info(f"    ✅ Hoàn thành Layer 3!")
+        
+        return self._finish_layer3_run(purpose, category_questions, checkpoint, checkpoint_file, processed_questions)
+    
+    async def process_layer3_research_async(self, json_file: str = "market_research_structured.json", limit: int = None, checkpoint_file: str = None, data: Dict[str, Any] = None) -> Dict[str, Any]:
+        """
+        Bản async của process_layer3_research: chạy song song các questions trong cùng một category
+        
+        Mỗi "wave" chỉ gồm questions của một (layer, category) nên các request có chung preamble
+        đến server gần nhau, tăng tỉ lệ hit prompt cache phía OpenAI. Số request đồng thời trong
+        wave do AIMDController của call_openai_api_async điều chỉnh. Gọi aclose() sau khi chạy xong.
+        """
+        purpose, flat, completed, checkpoint, checkpoint_file = self._prepare_layer3_run(json_file, data, limit, checkpoint_file)
+        category_questions = defaultdict(list)
+        
+        async def run_question(layer_name, category_name, question):
+            main_question = question.get('main_question', '')
+            checkpoint_key = (layer_name, category_name, main_question)
+            if checkpoint_key in completed:
+                return completed[checkpoint_key]
+            question_result = self._layer3_question_result(
+                question, *await self._research_layer3_question_async(layer_name, category_name, main_question, purpose)
+            )
+            self._write_checkpoint(checkpoint, layer_name, category_name, question_result)
+            logger.info(f"    ✅ {main_question[:50]}...")
+            return question_result
+        
+        for (layer_name, category_name), group in groupby(flat, key=lambda item: item[:2]):
+            questions = [question for _, _, question in group]
+            logger.info(f"📋 {layer_name} > {category_name}: {len(questions)} questions song song")
+            category_questions[(layer_name, category_name)] = list(await asyncio.gather(
+                *[run_question(layer_name, category_name, question) for question in questions]
+            ))
+        
+        flush_progress_logging()
+        stats = self.prompt_cache_stats
+        if stats['prompt_tokens']:
+            print(f"🧊 OpenAI prompt cache: {stats['cached_tokens']}/{stats['prompt_tokens']} prompt tokens cached "
+                  f"({stats['cached_tokens'] / stats['prompt_tokens'] * 100:.1f}%)")
+        
+        return self._finish_layer3_run(purpose, category_questions, checkpoint, checkpoint_file, len(flat))
+    
+    def process_layer3_research_batch(self, json_file: str = "market_research_structured.json", limit: int = None, data: Dict[str, Any] = None, poll_interval: int = 60) -> Dict[str, Any]:
+        """
+        Chạy Layer 3 qua OpenAI Batch API: rẻ hơn 50% token và không bị giới hạn RPM,
+        đổi lại kết quả có thể mất tới 24h. Dùng cho các run offline không cần kết quả ngay.
         
+        Gồm 2 batch nối tiếp: batch 1 generate prompt (bỏ qua question đã có trong prompt cache),
+        batch 2 chạy research bằng các prompt đó. custom_id là vị trí question trong danh sách flatten.
+        """
+        if data is None:
+            with open(json_file, 'rb') as f:
+                data = orjson.loads(f.read())
         purpose = data.get('purpose', '')
-        layers = data.get('layers', [])
+        flat = flatten_questions(data)
+        if limit:
+            flat = flat[:limit]
         
-        results = {
-            "industry": self.industry,
-            "market": self.market,
-            "purpose": purpose,
-            "research_standard": "Layer 3",
-            "api_provider": "openai",
-            "model_used": self.model,
-            "research_results": []
-        }
+        print(f"📦 Batch API: {len(flat)} main questions cho {self.industry} - {self.market}")
         
-        total_questions = 0
-        processed_questions = 0
+        # Prompt đã có trong cache thì không cần gửi lại ở batch 1
+        cache_keys = [
+            self._layer3_prompt_cache_key(layer_name, category_name, question.get('main_question', ''), purpose)
+            for layer_name, category_name, question in flat
+        ]
+        generated_prompts = {i: cached for i, cached in enumerate(map(self.prompt_cache.get, cache_keys)) if cached}
+        print(f"♻️ {len(generated_prompts)}/{len(flat)} Layer 3 prompts lấy từ cache")
+        
+        def build_prompt_request(i, item, previous):
+            if i in generated_prompts:
+                return None
+            layer_name, category_name, question = item
+            return self.create_layer3_prompt_request(layer_name, category_name, question.get('main_question', ''), purpose), 600, self._system_preamble
+        
+        def build_research_request(i, item, previous):
+            if i not in generated_prompts:
+                generated_prompts[i] = previous.get(i, "API Error: batch request failed")
+                if not self.is_error_response(generated_prompts[i]):
+                    self.prompt_cache.set(cache_keys[i], generated_prompts[i])
+            if self.is_error_response(generated_prompts[i]):
+                return None
+            return generated_prompts[i], 1400, None
+        
+        _, research_results = self._run_batch_stages(flat, [("prompt", build_prompt_request), ("research", build_research_request)], poll_interval)
+        
+        category_questions = defaultdict(list)
+        for i, (layer_name, category_name, question) in enumerate(flat):
+            generated_prompt = generated_prompts[i]
+            research_result = research_results.get(i, generated_prompt if self.is_error_response(generated_prompt) else "API Error: batch request failed")
+            category_questions[(layer_name, category_name)].append(
+                self._layer3_question_result(question, generated_prompt, research_result)
+            )
+        
+        print(f"🎉 Hoàn thành Batch API Layer 3: {len(flat)} main questions")
+        return self._assemble_layer3_results(purpose, category_questions)
+    
+    def _run_batch_stages(self, items: list, stages: list, poll_interval: int = 60) -> list:
+        """
+        Core chung của các pipeline Batch API: stages là list (label, build), chạy nối tiếp qua _run_batch.
+        build(i, item, previous) trả về (prompt, max_tokens, system) hoặc None để bỏ qua item, với previous
+        là {i: content} của stage trước. Trả về list {i: content} theo từng stage (custom_id = "i:label")
+        """
+        stage_contents = []
+        previous = {}
+        for n, (label, build) in enumerate(stages, 1):
+            requests = []
+            for i, item in enumerate(items):
+                request = build(i, item, previous)
+                if request is not None:
+                    requests.append((f"{i}:{label}", *request))
+            print(f"📦 Batch {n}/{len(stages)}: {label} cho {len(requests)} requests")
+            contents = self._run_batch(requests, poll_interval) if requests else {}
+            previous = {int(custom_id.split(':')[0]): content for custom_id, content in contents.items()}
+            stage_contents.append(previous)
+        return stage_contents
+    
+    def _run_batch(self, requests: list, poll_interval: int = 60) -> Dict[str, str]:
+        """
+        Upload list (custom_id, prompt, max_tokens, system) thành một batch /v1/chat/completions, chờ xong
+        và trả về {custom_id: content}; request lỗi trả về chuỗi "API Error: ..." như call_openai_api
+        """
+        lines = [
+            orjson.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self._model_for(messages, max_tokens),
+                    "messages": messages,
+                    "max_tokens": max_tokens,
+                    "temperature": 0.7
+                }
+            })
+            for custom_id, messages, max_tokens in (
+                (custom_id, self._build_messages(prompt, system), max_tokens)
+                for custom_id, prompt, max_tokens, system in requests
+            )
+        ]
+        batch_input = self.client.files.create(file=("layer3_batch.jsonl", b"\n".join(lines)), purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=batch_input.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        print(f"    📤 Đã submit batch {batch.id} ({len(requests)} requests)")
+        
+        # Poll với khoảng chờ tăng dần 10s → poll_interval: batch nhỏ thường xong trong vài phút
+        delay = min(10, poll_interval)
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(delay)
+            delay = min(delay * 2, poll_interval)
+            batch = self.client.batches.retrieve(batch.id)
+            counts = batch.request_counts
+            print(f"    ⏳ Batch {batch.id}: {batch.status} ({counts.completed if counts else 0}/{len(requests)})")
+        
+        results = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id).content.splitlines():
+                if not line.strip():
+                    continue
+                record = orjson.loads(line)
+                response = record.get("response") or {}
+                body = response.get("body") or {}
+                try:
+                    content = body["choices"][0]["message"]["content"]
+                    self.track_references_from_response(content)
+                except (KeyError, IndexError, TypeError):
+                    content = f"API Error: {record.get('error') or body.get('error') or 'batch request failed'}"
+                results[record["custom_id"]] = content
+        
+        if batch.status != "completed":
+            print(f"❌ Batch {batch.id} kết thúc với trạng thái {batch.status}")
+        return results
+    
+    async def _research_layer3_question_async(self, layer_name: str, category_name: str, main_question: str, purpose: str) -> tuple:
+        """Flow 2 bước (generate prompt → research) cho một question, dùng chung prompt cache với bản sync"""
+        cache_key = self._layer3_prompt_cache_key(layer_name, category_name, main_question, purpose)
+        generated_prompt = self.prompt_cache.get(cache_key)
+        if not generated_prompt:
+            prompt_request = self.create_layer3_prompt_request(layer_name, category_name, main_question, purpose)
+            generated_prompt = await self.call_openai_api_async(prompt_request, max_tokens=600, system=self._system_preamble)
+            if not self.is_error_response(generated_prompt):
+                self.prompt_cache.set(cache_key, generated_prompt)
+        
+        research_result = await self.call_openai_api_async(generated_prompt, max_tokens=1400)
+        return generated_prompt, research_result
+    
+    def _layer3_prompt_cache_key(self, layer_name: str, category_name: str, main_question: str, purpose: str) -> str:
+        return PromptCache.make_key(self.model, self.industry, self.market, layer_name, category_name, main_question, purpose)
+    
+    def _research_layer3_questions(self, layer_name: str, category_name: str, main_questions: list, purpose: str) -> list:
+        """Trả về list (generated_prompt, research_result) theo thứ tự main_questions"""
+        if len(main_questions) > 1:
+            batch_prompt = self.create_layer3_batch_prompt(layer_name, category_name, main_questions, purpose)
+            logger.info(f"    🔍 Nghiên cứu Layer 3 (batch {len(main_questions)} questions)...")
+            response = self.call_openai_api(batch_prompt, max_tokens=1400 * len(main_questions), system=self._system_preamble)
+            answers = self.split_batch_answers(response, len(main_questions))
+            if answers:
+                return [(batch_prompt, answer) for answer in answers]
+            logger.info(f"    ⚠️ Không tách được batch response, fallback từng question")
+        
+        results = []
+        for main_question in main_questions:
+            # Bước 1: Tạo Layer 3 prompt request
+            prompt_request = self.create_layer3_prompt_request(
+                layer_name, category_name, main_question, purpose
+            )
+            
+            # Bước 2: Gửi request để lấy prompt (dùng lại từ cache nếu đã generate trước đó)
+            cache_key = self._layer3_prompt_cache_key(layer_name, category_name, main_question, purpose)
+            generated_prompt = self.prompt_cache.get(cache_key)
+            if generated_prompt:
+                logger.info(f"    ♻️ Dùng lại Layer 3 prompt từ cache")
+            else:
+                logger.info(f"    🔄 Tạo Layer 3 prompt...")
+                generated_prompt = self.call_openai_api(prompt_request, max_tokens=600, system=self._system_preamble)
+                if not self.is_error_response(generated_prompt):
+                    self.prompt_cache.set(cache_key, generated_prompt)
+            
+            # Bước 3: Sử dụng prompt để lấy kết quả Layer 3
+            logger.info(f"    🔍 Nghiên cứu Layer 3...")
+            research_result = self.call_openai_api(generated_prompt, max_tokens=1400)
+            results.append((generated_prompt, research_result))
+        return results
+    
+    def is_error_response(self, content: str) -> bool:
+        """True nếu content là chuỗi lỗi do call_openai_api trả về"""
+        return not content or content.startswith(API_ERROR_PREFIXES)
+    
+    def split_batch_answers(self, response: str, expected: int) -> list:
+        """Tách response batch theo delimiter ### ANSWER i ###, trả về None nếu sai format"""
+        parts = BATCH_ANSWER_RE.split(response or '')
+        numbers = parts[1::2]
+        answers = [part.strip() for part in parts[2::2]]
+        if numbers != [str(i) for i in range(1, expected + 1)] or not all(answers):
+            return None
+        return answers
+    
+    def _prepare_layer3_run(self, json_file: str, data: Dict[str, Any], limit: int, checkpoint_file: str) -> tuple:
+        """Load data, flatten questions theo limit và mở checkpoint - dùng chung cho bản sync và async"""
+        # Đọc file JSON (chỉ khi chưa có data trong memory)
+        if data is None:
+            with open(json_file, 'rb') as f:
+                data = orjson.loads(f.read())
         
-        # Đếm tổng số main questions (Layer 3)
-        for layer in layers:
-            for category in layer.get('categories', []):
-                total_questions += len(category.get('questions', []))
+        purpose = data.get('purpose', '')
         
-        # Apply limit if specified
+        # Flatten một lần: (layer_name, category_name, question) theo đúng thứ tự, cắt theo limit
+        flat = flatten_questions(data)
         if limit:
-            total_questions = min(total_questions, limit)
+            flat = flat[:limit]
             print(f"🚧 Testing mode: Giới hạn {limit} questions")
         
         print(f"🎯 Bắt đầu nghiên cứu thị trường Layer 3: {self.industry}")
         print(f"📊 Thị trường: {self.market}")
         print(f"🤖 API: OpenAI {self.model}")
-        print(f"❓ Tổng số main questions (Layer 3): {total_questions}")
+        print(f"❓ Tổng số main questions (Layer 3): {len(flat)}")
         print("="*60)
         
-        for layer in layers:
-            layer_name = layer.get('name', '')
-            layer_result = {
-                "layer_name": layer_name,
-                "categories": []
-            }
-            
-            print(f"\n🔥 Đang xử lý Layer: {layer_name}")
-            
-            for category in layer.get('categories', []):
-                category_name = category.get('name', '')
-                category_result = {
-                    "category_name": category_name,
-                    "questions": []
-                }
-                
-                print(f"📋 Category: {category_name}")
-                
-                for question in category.get('questions', []):
-                    # Check limit
-                    if limit and processed_questions >= limit:
-                        print(f"🚧 Đã đạt giới hạn {limit} questions, dừng lại.")
-                        break
-                        
-                    main_question = question.get('main_question', '')
-                    processed_questions += 1
-                    progress = (processed_questions / total_questions) * 100
-                    
-                    print(f"  ❓ [{processed_questions}/{total_questions}] ({progress:.1f}%) Processing: {main_question[:50]}...")
-                    
-                    # Bước 1: Tạo Layer 3 prompt request
-                    prompt_request = self.create_layer3_prompt_request(
-                        layer_name, category_name, main_question, purpose
-                    )
-                    
-                    # Bước 2: Gửi request để lấy prompt
-                    print(f"    🔄 Tạo Layer 3 prompt...")
-                    generated_prompt = self.call_openai_api(prompt_request)
-                    
-                    # Bước 3: Sử dụng prompt để lấy kết quả Layer 3
-                    print(f"    🔍 Nghiên cứu Layer 3...")
-                    research_result = self.call_openai_api(generated_prompt)
-                    
-                    # Lưu kết quả với cấu trúc mới cho Layer 3
-                    question_result = {
-                        "main_question": main_question,
-                        "research_standard": "Layer 3",
-                        "generated_prompt": generated_prompt,
-                        "layer3_content": research_result,
-                        "sub_questions": question.get('sub_questions', []),  # Lưu để có thể enhance sau
-                        "layer4_enhancements": {}  # Dict để lưu các enhancement
-                    }
-                    
-                    category_result["questions"].append(question_result)
-                    
-                    # Delay để tránh rate limit
-                    time.sleep(self.delay_seconds)
-                    
-                    print(f"    ✅ Hoàn thành Layer 3!")
-                
-                if category_result["questions"]:  # Only add if has questions
-                    layer_result["categories"].append(category_result)
-                    
-                # Check limit
-                if limit and processed_questions >= limit:
-                    break
-            
-            if layer_result["categories"]:  # Only add if has categories
-                results["research_results"].append(layer_result)
-                
-            # Check limit
-            if limit and processed_questions >= limit:
-                break
+        # Resume từ checkpoint JSONL nếu lần chạy trước bị gián đoạn
+        if checkpoint_file is None:
+            checkpoint_file = self.get_checkpoint_path()
+        completed = self.load_checkpoint(checkpoint_file)
+        if completed:
+            print(f"♻️ Resume: {len(completed)} questions đã có trong checkpoint {checkpoint_file}")
+        os.makedirs(os.path.dirname(checkpoint_file) or '.', exist_ok=True)
+        checkpoint = open(checkpoint_file, 'ab')
+        if completed:
+            checkpoint.write(b"\n")  # Tách khỏi dòng ghi dở (nếu có) trước khi append
+        
+        return purpose, flat, completed, checkpoint, checkpoint_file
+    
+    def _finish_layer3_run(self, purpose: str, category_questions: Dict[tuple, list], checkpoint, checkpoint_file: str, processed_questions: int) -> Dict[str, Any]:
+        """Dọn checkpoint và ghép kết quả cuối cùng"""
+        # Chạy xong toàn bộ → checkpoint không còn cần thiết
+        checkpoint.close()
+        os.remove(checkpoint_file)
         
+        flush_progress_logging()
         print("\n" + "="*60)
         print(f"🎉 Hoàn thành nghiên cứu thị trường Layer 3!")
         print(f"📊 Đã xử lý: {processed_questions} main questions")
         
-        return results
+        return self._assemble_layer3_results(purpose, category_questions)
+    
+    def _assemble_layer3_results(self, purpose: str, category_questions: Dict[tuple, list]) -> Dict[str, Any]:
+        """Ghép kết quả layer > category > questions (giữ thứ tự xuất hiện)"""
+        layer_results = {}
+        for (layer_name, category_name), questions in category_questions.items():
+            layer_result = layer_results.setdefault(layer_name, {"layer_name": layer_name, "categories": []})
+            layer_result["categories"].append({
+                "category_name": category_name,
+                "questions": questions
+            })
+        
+        return {
+            "industry": self.industry,
+            "market": self.market,
+            "purpose": purpose,
+            "research_standard": "Layer 3",
+            "api_provider": "openai",
+            "model_used": self.model,
+            "research_results": list(layer_results.values())
+        }
+    
+    def _layer3_question_result(self, question: Dict[str, Any], generated_prompt: str, research_result: str) -> Dict[str, Any]:
+        """Cấu trúc kết quả Layer 3 cho một main question"""
+        return {
+            "main_question": question.get('main_question', ''),
+            "research_standard": "Layer 3",
+            "generated_prompt": generated_prompt,
+            "layer3_content": research_result,
+            "sub_questions": question.get('sub_questions', []),  # Lưu để có thể enhance sau
+            "layer4_enhancements": {}  # Dict để lưu các enhancement
+        }
+    
+    def _write_checkpoint(self, checkpoint, layer_name: str, category_name: str, question_result: Dict[str, Any]):
+        """Ghi ngay question vừa xong ra checkpoint (1 dòng JSONL)"""
+        checkpoint.write(orjson.dumps({
+            "layer_name": layer_name,
+            "category_name": category_name,
+            "question_result": question_result
+        }) + b"\n")
+        checkpoint.flush()
+    
+    def get_checkpoint_path(self, output_dir: str = "output") -> str:
+        """Đường dẫn checkpoint JSONL mặc định, tách riêng theo industry và market"""
+        safe_name = re.sub(r'[^\w-]+', '_', f"{self.industry}_{self.market}").strip('_')
+        return os.path.join(output_dir, f"layer3_checkpoint_{safe_name}.jsonl")
+    
+    def load_checkpoint(self, checkpoint_file: str) -> Dict[tuple, Dict[str, Any]]:
+        """Đọc checkpoint JSONL → {(layer, category, main_question): question_result}"""
+        completed = {}
+        if not os.path.exists(checkpoint_file):
+            return completed
+        
+        with open(checkpoint_file, 'rb') as f:
+            for line in f:
+                try:
+                    record = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    continue  # Dòng cuối bị ghi dở khi crash
+                question_result = record['question_result']
+                completed[(record['layer_name'], record['category_name'], question_result['main_question'])] = question_result
+        return completed
 
-    def enhance_to_layer4(self, layer3_results: Dict[str, Any], layer_name: str, category_name: str, main_question: str, sub_question: str) -> str:
+    def _build_index(self, results: Dict[str, Any]) -> Dict[tuple, Dict[str, Any]]:
+        """
+        Index {(layer_name, category_name, main_question): question dict} trong một lần duyệt
+        Question dict là cùng object với trong results nên sửa trực tiếp sẽ cập nhật results
+        """
+        return index_research_results(results)
+
+    def enhance_to_layer4(self, layer3_results: Dict[str, Any], layer_name: str, category_name: str, main_question: str, sub_question: str, index: Dict[tuple, Dict[str, Any]] = None) -> str:
         """
         Enhance một section cụ thể từ Layer 3 lên Layer 4
         """
         
         # Tìm layer3_content tương ứng
-        layer3_content = ""
         purpose = layer3_results.get('purpose', '')
-        
-        for layer in layer3_results.get('research_results', []):
-            if layer.get('layer_name') == layer_name:
-                for category in layer.get('categories', []):
-                    if category.get('category_name') == category_name:
-                        for question in category.get('questions', []):
-                            if question.get('main_question') == main_question:
-                                layer3_content = question.get('layer3_content', '')
-                                break
+        if index is None:
+            index = self._build_index(layer3_results)
+        question = index.get((layer_name, category_name, main_question), {})
+        layer3_content = question.get('layer3_content', '')
         
         if not layer3_content:
             return "Không tìm thấy nội dung Layer 3 để enhance"
@@ -480,35 +1792,28 @@ Viết một phân tích dạng văn xuôi, liền mạch theo logic:
         
         # Bước 2: Lấy enhancement prompt
         print(f"    🔄 Tạo Layer 4 enhancement prompt...")
-        generated_prompt = self.call_openai_api(enhancement_prompt_request)
+        generated_prompt = self.call_openai_api(enhancement_prompt_request, max_tokens=600)
         
         # Bước 3: Chạy enhancement
         print(f"    🔍 Thực hiện Layer 4 enhancement...")
-        enhancement_result = self.call_openai_api(generated_prompt)
+        enhancement_result = self.call_openai_api(generated_prompt, max_tokens=1400)
         
         print(f"    ✅ Hoàn thành Layer 4 enhancement!")
         
         return enhancement_result
 
-    def enhance_to_layer4_comprehensive(self, layer3_results: Dict[str, Any], layer_name: str, category_name: str, main_question: str) -> str:
+    def enhance_to_layer4_comprehensive(self, layer3_results: Dict[str, Any], layer_name: str, category_name: str, main_question: str, index: Dict[tuple, Dict[str, Any]] = None) -> str:
         """
         Tạo báo cáo Layer 4 tổng hợp cho toàn bộ main question (tất cả sub-questions)
         """
         
         # Tìm layer3_content và sub_questions tương ứng
-        layer3_content = ""
-        sub_questions = []
         purpose = layer3_results.get('purpose', '')
-        
-        for layer in layer3_results.get('research_results', []):
-            if layer.get('layer_name') == layer_name:
-                for category in layer.get('categories', []):
-                    if category.get('category_name') == category_name:
-                        for question in category.get('questions', []):
-                            if question.get('main_question') == main_question:
-                                layer3_content = question.get('layer3_content', '')
-                                sub_questions = question.get('sub_questions', [])
-                                break
+        if index is None:
+            index = self._build_index(layer3_results)
+        question = index.get((layer_name, category_name, main_question), {})
+        layer3_content = question.get('layer3_content', '')
+        sub_questions = question.get('sub_questions', [])
         
         if not layer3_content:
             return "Không tìm thấy nội dung Layer 3 để enhance"
@@ -516,96 +1821,168 @@ Viết một phân tích dạng văn xuôi, liền mạch theo logic:
         if not sub_questions:
             return "Không tìm thấy sub-questions để tạo báo cáo tổng hợp"
         
-        print(f"🔄 Tạo báo cáo Layer 4 tổng hợp với {len(sub_questions)} sub-questions...")
-        
         # Tạo comprehensive report prompt
         comprehensive_prompt = self.create_layer4_comprehensive_report_prompt(
             layer_name, category_name, main_question, sub_questions, layer3_content, purpose
         )
         
-        # Gọi API để tạo comprehensive report
-        print(f"    🔍 Thực hiện Layer 4 comprehensive analysis...")
-        comprehensive_report = self.call_openai_api(comprehensive_prompt)
-        
-        print(f"    ✅ Hoàn thành Layer 4 comprehensive report!")
-        
-        return comprehensive_report
+        # Gọi API để tạo comprehensive report (progress do caller log, một dòng mỗi question)
+        return self.call_openai_api(comprehensive_prompt, max_tokens=LAYER4_REPORT_MAX_TOKENS, system=self._system_preamble)
 
-    def add_layer4_enhancement(self, results_file: str, layer_name: str, category_name: str, main_question: str, sub_question: str, output_file: str = None) -> str:
+    def add_layer4_enhancement(self, results_file: str, layer_name: str, category_name: str, main_question: str, sub_question: str, output_file: str = None, store: Layer3Store = None, force: bool = False) -> str:
         """
         Thêm Layer 4 enhancement vào kết quả hiện có và lưu file
+        
+        Truyền store (Layer3Store) khi thêm nhiều enhancement liên tiếp: file chỉ được ghi
+        khi gọi store.flush(), mỗi enhancement vẫn được lưu ngay vào sidecar delta.
+        Sub-question đã có enhancement sẽ được bỏ qua, trừ khi force=True.
         """
+        owns_store = store is None
+        if owns_store:
+            store = Layer3Store(results_file, output_file)
         
-        # Đọc kết quả hiện có
-        with open(results_file, 'r', encoding='utf-8') as f:
-            results = json.load(f)
+        question = store.index.get((layer_name, category_name, main_question), {})
+        if not force and sub_question in question.get('layer4_enhancements', {}):
+            print(f"⏭️ Đã có Layer 4 enhancement cho: {sub_question[:50]}... (bỏ qua)")
+            return self._finish_skipped(store, owns_store)
         
         # Thực hiện enhancement
-        enhancement_content = self.enhance_to_layer4(results, layer_name, category_name, main_question, sub_question)
+        enhancement_content = self.enhance_to_layer4(store.results, layer_name, category_name, main_question, sub_question, index=store.index)
         
         # Cập nhật kết quả
-        for layer in results.get('research_results', []):
-            if layer.get('layer_name') == layer_name:
-                for category in layer.get('categories', []):
-                    if category.get('category_name') == category_name:
-                        for question in category.get('questions', []):
-                            if question.get('main_question') == main_question:
-                                # Thêm enhancement vào dict
-                                question['layer4_enhancements'][sub_question] = {
-                                    "enhanced_content": enhancement_content,
-                                    "enhancement_timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
-                                }
-                                break
-        
-        # Lưu file
-        if output_file is None:
-            output_file = results_file  # Ghi đè file gốc
-        
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(results, f, ensure_ascii=False, indent=2)
-        
-        print(f"💾 Đã cập nhật Layer 4 enhancement vào: {output_file}")
-        return output_file
-
-    def add_layer4_comprehensive_enhancement(self, results_file: str, layer_name: str, category_name: str, main_question: str, output_file: str = None) -> str:
+        store.add_enhancement(layer_name, category_name, main_question, sub_question, enhancement_content)
+        
+        if owns_store:
+            store.flush()
+            print(f"💾 Đã cập nhật Layer 4 enhancement vào: {store.output_file}")
+        return store.output_file
+
+    def add_layer4_comprehensive_enhancement(self, results_file: str, layer_name: str, category_name: str, main_question: str, output_file: str = None, store: Layer3Store = None, force: bool = False) -> str:
         """
         Thêm Layer 4 comprehensive enhancement vào kết quả hiện có và lưu file
+        
+        Truyền store (Layer3Store) khi chạy theo batch, gọi store.flush() một lần ở cuối.
+        Question đã có comprehensive report sẽ được bỏ qua, trừ khi force=True.
         """
+        owns_store = store is None
+        if owns_store:
+            store = Layer3Store(results_file, output_file)
         
-        # Đọc kết quả hiện có
-        with open(results_file, 'r', encoding='utf-8') as f:
-            results = json.load(f)
+        question = store.index.get((layer_name, category_name, main_question), {})
+        if not force and question.get('layer4_comprehensive_report'):
+            logger.info(f"⏭️ Đã có Layer 4 comprehensive report cho: {main_question[:50]}... (bỏ qua)")
+            return self._finish_skipped(store, owns_store)
         
         # Thực hiện comprehensive enhancement
-        comprehensive_content = self.enhance_to_layer4_comprehensive(results, layer_name, category_name, main_question)
+        comprehensive_content = self.enhance_to_layer4_comprehensive(store.results, layer_name, category_name, main_question, index=store.index)
         
         # Cập nhật kết quả với comprehensive report
-        for layer in results.get('research_results', []):
-            if layer.get('layer_name') == layer_name:
-                for category in layer.get('categories', []):
-                    if category.get('category_name') == category_name:
-                        for question in category.get('questions', []):
-                            if question.get('main_question') == main_question:
-                                # Thêm comprehensive enhancement
-                                question['layer4_comprehensive_report'] = {
-                                    "comprehensive_content": comprehensive_content,
-                                    "enhancement_timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-                                    "sub_questions_integrated": question.get('sub_questions', [])
-                                }
-                                break
-        
-        # Lưu file
-        if output_file is None:
-            output_file = results_file  # Ghi đè file gốc
-        
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(results, f, ensure_ascii=False, indent=2)
-        
-        print(f"💾 Đã cập nhật Layer 4 comprehensive report vào: {output_file}")
-        return output_file
-
-    def run_layer3_research(self, structured_data: dict, topic: str, testing_mode: bool = False, analysis_level: str = "Layer 4 Analysis") -> dict:
-        """Main research execution with comprehensive error handling and reference tracking"""
+        store.add_comprehensive(layer_name, category_name, main_question, comprehensive_content)
+        
+        if owns_store:
+            store.flush()
+            print(f"💾 Đã cập nhật Layer 4 comprehensive report vào: {store.output_file}")
+        return store.output_file
+
+    def add_layer4_comprehensive_enhancements(self, store: Layer3Store, questions: list, force: bool = False) -> int:
+        """
+        Tạo Layer 4 comprehensive report song song cho nhiều question [(layer_name, category_name, main_question)] trong store
+        
+        Các API call chạy đồng thời qua asyncio.gather (giới hạn bởi AIMDController / token bucket) thay vì
+        lần lượt từng question. Question đã có report (trừ khi force=True), thiếu Layer 3 hoặc không có
+        sub-questions sẽ được bỏ qua. Trả về số report đã tạo; caller gọi store.flush() một lần sau đó.
+        """
+        purpose = store.results.get('purpose', '')
+        total = len(questions)
+        completed = 0
+        
+        async def enhance(layer_name, category_name, main_question):
+            nonlocal completed
+            question = store.index.get((layer_name, category_name, main_question), {})
+            layer3_content = question.get('layer3_content', '')
+            sub_questions = question.get('sub_questions', [])
+            if (not force and question.get('layer4_comprehensive_report')) or not layer3_content or not sub_questions:
+                created = False
+            else:
+                comprehensive_prompt = self.create_layer4_comprehensive_report_prompt(
+                    layer_name, category_name, main_question, sub_questions, layer3_content, purpose
+                )
+                content = await self.call_openai_api_async(comprehensive_prompt, max_tokens=LAYER4_REPORT_MAX_TOKENS, system=self._system_preamble)
+                store.add_comprehensive(layer_name, category_name, main_question, content)
+                created = True
+            
+            completed += 1
+            logger.info(f"  [{completed}/{total}] {completed / total * 100:.1f}% | L3✓ L4{'✓' if created else '-'} | {main_question[:50]}")
+            return created
+        
+        async def enhance_all():
+            return await asyncio.gather(*[enhance(*item) for item in questions])
+        
+        created = self._run_async(enhance_all()) if questions else []
+        flush_progress_logging()
+        return sum(created)
+
+    async def enhance_all_subquestions(self, results_file: str, layer_name: str, category_name: str, main_question: str, output_file: str = None, store: Layer3Store = None, force: bool = False) -> str:
+        """
+        Enhance song song tất cả sub-questions của một main question lên Layer 4
+        
+        Mỗi sub-question là 2 API call nối tiếp (tạo prompt → enhancement), các sub-question chạy
+        đồng thời qua asyncio.gather (giới hạn bởi AIMDController). Kết quả được cập nhật vào store
+        sau khi tất cả hoàn thành và file chỉ ghi một lần. Gọi aclose() sau khi chạy xong.
+        """
+        owns_store = store is None
+        if owns_store:
+            store = Layer3Store(results_file, output_file)
+        
+        question = store.index.get((layer_name, category_name, main_question), {})
+        layer3_content = question.get('layer3_content', '')
+        existing = question.get('layer4_enhancements', {})
+        pending = [sq for sq in question.get('sub_questions', []) if force or sq not in existing]
+        
+        if not layer3_content or not pending:
+            print(f"⏭️ Không có sub-question cần enhance cho: {main_question[:50]}... (bỏ qua)")
+            return self._finish_skipped(store, owns_store)
+        
+        purpose = store.results.get('purpose', '')
+        
+        async def enhance(sub_question: str) -> str:
+            enhancement_prompt_request = self.create_layer4_enhancement_prompt(
+                layer_name, category_name, main_question, sub_question, layer3_content, purpose
+            )
+            generated_prompt = await self.call_openai_api_async(enhancement_prompt_request, max_tokens=600)
+            if self.is_error_response(generated_prompt):
+                return generated_prompt
+            return await self.call_openai_api_async(generated_prompt, max_tokens=1400)
+        
+        print(f"🔄 Enhancing {len(pending)} sub-questions lên Layer 4 (song song): {main_question[:50]}...")
+        contents = await asyncio.gather(*[enhance(sq) for sq in pending], return_exceptions=True)
+        
+        for sub_question, content in zip(pending, contents):
+            if isinstance(content, Exception):
+                print(f"    ❌ Lỗi enhancement '{sub_question[:50]}': {content}")
+                content = f"API Error: {content}"
+            store.add_enhancement(layer_name, category_name, main_question, sub_question, content)
+        
+        print(f"    ✅ Hoàn thành {len(pending)} Layer 4 enhancements!")
+        if owns_store:
+            store.flush()
+            print(f"💾 Đã cập nhật Layer 4 enhancements vào: {store.output_file}")
+        return store.output_file
+
+    def _finish_skipped(self, store: Layer3Store, owns_store: bool) -> str:
+        """Không gọi API; chỉ ghi file khi output khác file gốc để output_file luôn tồn tại"""
+        if owns_store and store.output_file != store.results_file:
+            store.flush()
+        return store.output_file
+
+    def run_layer3_research(self, structured_data: dict, topic: str, testing_mode: bool = False, analysis_level: str = "Layer 4 Analysis", category_batch_size: int = 1) -> dict:
+        """
+        Main research execution with comprehensive error handling and reference tracking
+        
+        category_batch_size (Layer 3 Analysis): gom tối đa N category cùng layer vào một request,
+        giảm N lần số request (RPM); response không tách được sẽ fallback từng category.
+        N bị giới hạn bởi output limit của model (mỗi category cần LAYER3_CATEGORY_MAX_TOKENS).
+        """
         
         print(f"🎯 Bắt đầu nghiên cứu thị trường Layer 3: {topic}")
         print(f"📊 Thị trường: {self.market}")
@@ -613,14 +1990,22 @@ Viết một phân tích dạng văn xuôi, liền mạch theo logic:
         print(f"🔬 Analysis Level: {analysis_level}")
         
         # Reset reference tracking for new research
-        self.reference_tracker = {}
-        self.tracked_sources = set()
+        self.reference_tracker = Counter()
         
         # Get purpose from structured data
         purpose = structured_data.get('purpose', 'Nghiên cứu thị trường và phân tích cơ hội kinh doanh')
         
         # Create result structure
-        result = {
+        result = self._new_research_result(topic, purpose, analysis_level, testing_mode)
+        
+        # Branch logic based on analysis level
+        if analysis_level == "Layer 3 Analysis":
+            return self._run_layer3_category_analysis(structured_data, purpose, result, testing_mode, category_batch_size)
+        else:
+            return self._run_layer4_detailed_analysis(structured_data, purpose, result, testing_mode)
+    
+    def _new_research_result(self, topic: str, purpose: str, analysis_level: str, testing_mode: bool) -> dict:
+        return {
             'research_metadata': {
                 'industry': topic,
                 'market': self.market,
@@ -628,150 +2013,253 @@ Viết một phân tích dạng văn xuôi, liền mạch theo logic:
                 'api_provider': 'OpenAI',
                 'purpose': purpose,
                 'analysis_level': analysis_level,
-                'research_timestamp': time.strftime("%Y-%m-%d %H:%M:%S"),
+                'research_timestamp': current_timestamp(),
                 'testing_mode': testing_mode
             },
             'research_results': [],
             'research_statistics': {},
             'tracked_references': []  # Will be populated at the end
         }
-        
-        # Count total questions for progress tracking
-        total_questions = 0
-        total_questions_available = 0
-        
-        # First pass: count all available questions
-        for layer in structured_data.get('layers', []):
-            for category in layer.get('categories', []):
-                questions = category.get('questions', [])
-                total_questions_available += len(questions)
-        
+    
+    def _select_category_jobs(self, structured_data: dict, testing_mode: bool) -> tuple:
+        """Gom các question đã chọn thành (layer_name, category_name, questions) theo thứ tự; testing mode: tối đa 5 questions"""
+        flat = self._select_question_items(structured_data, testing_mode)
+        jobs = [
+            (layer_name, category_name, [question_data for _, _, question_data in group])
+            for (layer_name, category_name), group in groupby(flat, key=lambda item: item[:2])
+        ]
+        return jobs, len(flat)
+    
+    def _select_question_items(self, structured_data: dict, testing_mode: bool) -> list:
+        """Flatten (layer, category, question) theo thứ tự; testing mode chỉ lấy 5 questions đầu"""
+        flat = flatten_questions(structured_data)
         if testing_mode:
-            total_questions = min(5, total_questions_available)  # Limit to exactly 5 questions
-            print(f"🧪 Testing mode: Limiting to {total_questions} questions out of {total_questions_available} available")
-        else:
-            total_questions = total_questions_available
-        
-        print(f"❓ Tổng số main questions (Layer 3): {total_questions}")
+            print(f"🧪 Testing mode: Limiting to {min(5, len(flat))} questions out of {len(flat)} available")
+            flat = flat[:5]
+        print(f"❓ Tổng số main questions (Layer 3): {len(flat)}")
         print("=" * 60)
+        return flat
+    
+    def _layer3_category_result(self, category_name: str, questions: list, comprehensive_content: str) -> dict:
+        all_main_questions = [q.get('main_question', '') for q in questions]
+        
+        # Store individual questions for reference (minimal processing)
+        category_questions = [{
+            'main_question': question_data.get('main_question', ''),
+            'sub_questions': question_data.get('sub_questions', []),
+            'layer3_content': None  # Not processed individually in Layer 3 mode
+        } for question_data in questions]
+        
+        # Create category result with comprehensive analysis
+        return {
+            'category_name': category_name,
+            'questions': category_questions,
+            'layer3_comprehensive_category': {
+                'comprehensive_content': comprehensive_content,
+                'analysis_timestamp': current_timestamp(),
+                'questions_analyzed': all_main_questions,
+                'analysis_mode': 'Layer 3 Category Comprehensive'
+            }
+        }
+    
+    def _layer4_question_result(self, question_data: dict, layer3_content: str, comprehensive_content: str = None) -> dict:
+        sub_questions = question_data.get('sub_questions', [])
+        question_result = {
+            'main_question': question_data.get('main_question', ''),
+            'sub_questions': sub_questions,
+            'layer3_content': layer3_content
+        }
+        if comprehensive_content is not None:
+            question_result['layer4_comprehensive_report'] = {
+                "comprehensive_content": comprehensive_content,
+                "enhancement_timestamp": current_timestamp(),
+                "sub_questions_integrated": sub_questions
+            }
+        return question_result
+    
+    def _group_category_results(self, jobs: list, category_results: list) -> list:
+        """Ghép lại theo đúng thứ tự layer > category ban đầu"""
+        layer_results = {}
+        for (layer_name, _, _), category_result in zip(jobs, category_results):
+            layer_results.setdefault(layer_name, {'layer_name': layer_name, 'categories': []})['categories'].append(category_result)
+        return list(layer_results.values())
+    
+    def _group_question_results(self, flat: list, question_results: list) -> list:
+        """Ghép lại layer > category > questions theo thứ tự ban đầu"""
+        layer_results = {}
+        for (layer_name, category_name, _), question_result in zip(flat, question_results):
+            layer_result = layer_results.setdefault(layer_name, {'layer_name': layer_name, 'categories': []})
+            if not layer_result['categories'] or layer_result['categories'][-1]['category_name'] != category_name:
+                layer_result['categories'].append({'category_name': category_name, 'questions': []})
+            layer_result['categories'][-1]['questions'].append(question_result)
+        return list(layer_results.values())
+    
+    def _attach_tracked_references(self, result: dict):
+        """Add tracked references to result"""
+        top_references = self.get_top_references(10)
+        result['tracked_references'] = top_references
         
-        processed_questions = 0
+        print(f"📚 Tracked {len(self.reference_tracker)} unique sources")
+        if top_references:
+            print("🔝 Top references:")
+            for source, count in top_references[:5]:
+                print(f"   • {source} ({count}x)")
+    
+    def run_layer3_research_batch(self, structured_data: dict, topic: str, testing_mode: bool = False, analysis_level: str = "Layer 4 Analysis", poll_interval: int = 60) -> dict:
+        """
+        Bản Batch API của run_layer3_research cho lần chạy không cần tương tác
+        
+        Giá rẻ hơn ~50% so với gọi trực tiếp nhưng có thể mất tới 24h. Layer 3 Analysis gửi một batch
+        (mỗi category một request); Layer 4 Analysis gửi batch Layer 3 rồi batch comprehensive report
+        cho các question có sub-questions. Kết quả có cùng cấu trúc với run_layer3_research.
+        """
+        print(f"🎯 Bắt đầu nghiên cứu thị trường Layer 3 (Batch API): {topic}")
+        print(f"📊 Thị trường: {self.market}")
+        print(f"🔬 Analysis Level: {analysis_level}")
+        start_time = time.monotonic()
+        self.reference_tracker = Counter()
+        self._ensure_prompt_fragments()
+        
+        purpose = structured_data.get('purpose', 'Nghiên cứu thị trường và phân tích cơ hội kinh doanh')
+        result = self._new_research_result(topic, purpose, analysis_level, testing_mode)
         
-        # Branch logic based on analysis level
         if analysis_level == "Layer 3 Analysis":
-            return self._run_layer3_category_analysis(structured_data, purpose, result, testing_mode)
+            jobs, total_questions = self._select_category_jobs(structured_data, testing_mode)
+            
+            def build_category_request(i, job, previous):
+                layer_name, category_name, questions = job
+                return self.create_layer3_comprehensive_category_prompt(
+                    layer_name, category_name, [q.get('main_question', '') for q in questions], purpose
+                ), LAYER3_CATEGORY_MAX_TOKENS, self._system_preamble
+            
+            (contents,) = self._run_batch_stages(jobs, [("category", build_category_request)], poll_interval)
+            category_results = [
+                self._layer3_category_result(category_name, questions, contents.get(i, "API Error: batch request failed"))
+                for i, (layer_name, category_name, questions) in enumerate(jobs)
+            ]
+            result['research_results'].extend(self._group_category_results(jobs, category_results))
+            result['research_statistics'] = {
+                'total_categories_processed': len(jobs),
+                'total_questions_processed': total_questions,
+                'total_api_calls': len(jobs),
+                'analysis_mode': 'Layer 3 Category Comprehensive'
+            }
         else:
-            return self._run_layer4_detailed_analysis(structured_data, purpose, result, testing_mode)
+            flat = self._select_question_items(structured_data, testing_mode)
+            
+            def build_layer3_request(i, item, previous):
+                layer_name, category_name, question_data = item
+                return self.create_layer3_prompt_request(layer_name, category_name, question_data.get('main_question', ''), purpose), 1400, self._system_preamble
+            
+            def build_layer4_request(i, item, previous):
+                layer_name, category_name, question_data = item
+                layer3_content = previous.get(i)
+                sub_questions = question_data.get('sub_questions', [])
+                if not sub_questions or self.is_error_response(layer3_content):
+                    return None
+                return self.create_layer4_comprehensive_report_prompt(
+                    layer_name, category_name, question_data.get('main_question', ''), sub_questions, layer3_content, purpose
+                ), LAYER4_REPORT_MAX_TOKENS, self._system_preamble
+            
+            layer3_contents, layer4_contents = self._run_batch_stages(flat, [("layer3", build_layer3_request), ("layer4", build_layer4_request)], poll_interval)
+            
+            question_results = [
+                self._layer4_question_result(
+                    question_data,
+                    layer3_contents.get(i, "API Error: batch request failed"),
+                    layer4_contents.get(i)
+                )
+                for i, (_, _, question_data) in enumerate(flat)
+            ]
+            result['research_results'].extend(self._group_question_results(flat, question_results))
+            result['research_statistics'] = {
+                'total_questions_processed': len(flat),
+                'total_api_calls': len(flat) + len(layer4_contents),
+                'analysis_mode': 'Layer 4 Detailed per Question'
+            }
+        
+        print("=" * 60)
+        print("🎉 Hoàn thành nghiên cứu (Batch API)!")
+        self._attach_tracked_references(result)
+        result['research_statistics']['total_sources_tracked'] = len(self.reference_tracker)
+        result['research_statistics']['processing_time_estimate'] = f"{(time.monotonic() - start_time) / 60:.1f} minutes"
+        return result
     
-    def _run_layer3_category_analysis(self, structured_data: dict, purpose: str, result: dict, testing_mode: bool) -> dict:
+    def _run_layer3_category_analysis(self, structured_data: dict, purpose: str, result: dict, testing_mode: bool, category_batch_size: int = 1) -> dict:
         """Layer 3 Analysis Mode: Comprehensive analysis per category"""
         
         print("🎯 Chế độ Layer 3: Phân tích comprehensive theo category")
-        processed_categories = 0
-        total_questions_processed = 0
-        
-        for layer in structured_data.get('layers', []):
-            layer_name = layer.get('name', '')
-            layer_result = {
-                'layer_name': layer_name,
-                'categories': []
-            }
-            
-            print(f"🔥 Đang xử lý Layer: {layer_name}")
+        start_time = time.monotonic()
+        
+        jobs, total_questions_processed = self._select_category_jobs(structured_data, testing_mode)
+        processed_categories = len(jobs)
+        
+        print(f"🚀 Chạy song song {processed_categories} categories (tối đa {self.concurrency.max_concurrency} request đồng thời)")
+        
+        api_calls = 0
+        
+        async def analyze_category(layer_name, category_name, questions):
+            nonlocal api_calls
+            # Collect all main questions for this category
+            all_main_questions = [q.get('main_question', '') for q in questions]
             
-            for category in layer.get('categories', []):
-                category_name = category.get('name', '')
-                processed_categories += 1
-                
-                print(f"📋 Category [{processed_categories}]: {category_name}")
-                
-                questions = category.get('questions', [])
-                
-                # In testing mode, limit questions for this category
-                if testing_mode:
-                    questions_remaining = 5 - total_questions_processed
-                    if questions_remaining <= 0:
-                        print(f"    🧪 Testing mode: Reached 5 question limit, skipping remaining categories")
-                        break
-                    questions = questions[:min(len(questions), questions_remaining)]
-                
-                # Collect all main questions for this category
-                all_main_questions = [q.get('main_question', '') for q in questions]
-                total_questions_processed += len(all_main_questions)
-                
-                print(f"    🔄 Gom {len(all_main_questions)} questions cho comprehensive analysis...")
-                
-                # Create Layer 3 comprehensive analysis for entire category
-                comprehensive_prompt = self.create_layer3_comprehensive_category_prompt(
-                    layer_name, category_name, all_main_questions, purpose
+            # Create Layer 3 comprehensive analysis for entire category
+            comprehensive_prompt = self.create_layer3_comprehensive_category_prompt(
+                layer_name, category_name, all_main_questions, purpose
+            )
+            api_calls += 1
+            comprehensive_content = await self.call_openai_api_async(comprehensive_prompt, max_tokens=LAYER3_CATEGORY_MAX_TOKENS, system=self._system_preamble)
+            logger.info(f"    ✅ Hoàn thành comprehensive analysis cho {category_name}!")
+            return self._layer3_category_result(category_name, questions, comprehensive_content)
+        
+        async def analyze_categories(layer_name, chunk):
+            """Một request cho cả chunk [(category_name, questions)]; fallback từng category nếu không tách được response"""
+            nonlocal api_calls
+            if len(chunk) > 1:
+                multi_prompt = self.create_layer3_multi_category_prompt(
+                    layer_name, [(category_name, [q.get('main_question', '') for q in questions]) for category_name, questions in chunk], purpose
                 )
-                
-                print(f"    🔍 Phân tích comprehensive cho category {category_name}...")
-                comprehensive_content = self.call_openai_api(comprehensive_prompt)
-                
-                # Store individual questions for reference (minimal processing)
-                category_questions = []
-                for question_data in questions:
-                    question_result = {
-                        'main_question': question_data.get('main_question', ''),
-                        'sub_questions': question_data.get('sub_questions', []),
-                        'layer3_content': None  # Not processed individually in Layer 3 mode
-                    }
-                    category_questions.append(question_result)
-                
-                # Create category result with comprehensive analysis
-                category_result = {
-                    'category_name': category_name,
-                    'questions': category_questions,
-                    'layer3_comprehensive_category': {
-                        'comprehensive_content': comprehensive_content,
-                        'analysis_timestamp': time.strftime("%Y-%m-%d %H:%M:%S"),
-                        'questions_analyzed': all_main_questions,
-                        'analysis_mode': 'Layer 3 Category Comprehensive'
-                    }
-                }
-                
-                layer_result['categories'].append(category_result)
-                print(f"    ✅ Hoàn thành comprehensive analysis cho {category_name}!")
-                
-                # Add delay to avoid rate limiting
-                time.sleep(self.delay_seconds)
-                
-                # Break if we've reached the testing limit
-                if testing_mode and total_questions_processed >= 5:
-                    print(f"    🧪 Testing mode: Reached 5 question limit")
-                    break
-                
-            result['research_results'].append(layer_result)
-            
-            # Break if we've reached the testing limit
-            if testing_mode and total_questions_processed >= 5:
-                break
+                api_calls += 1
+                response = await self.call_openai_api_async(multi_prompt, max_tokens=LAYER3_CATEGORY_MAX_TOKENS * len(chunk), system=self._system_preamble)
+                answers = self.split_batch_answers(response, len(chunk))
+                if answers:
+                    logger.info(f"    ✅ Hoàn thành comprehensive analysis cho {len(chunk)} categories: {', '.join(name for name, _ in chunk)}")
+                    return [self._layer3_category_result(category_name, questions, answer) for (category_name, questions), answer in zip(chunk, answers)]
+                logger.info(f"    ⚠️ Không tách được response của {len(chunk)} categories, fallback từng category")
+            return list(await asyncio.gather(*[analyze_category(layer_name, category_name, questions) for category_name, questions in chunk]))
+        
+        # Chia category theo layer thành các chunk category_batch_size (giữ thứ tự ban đầu)
+        category_batch_size = self._batch_limit(max(1, category_batch_size), LAYER3_CATEGORY_MAX_TOKENS)
+        chunks = []
+        for layer_name, group in groupby(jobs, key=lambda job: job[0]):
+            layer_jobs = [(category_name, questions) for _, category_name, questions in group]
+            for start in range(0, len(layer_jobs), category_batch_size):
+                chunks.append((layer_name, layer_jobs[start:start + category_batch_size]))
+        
+        async def analyze_all():
+            chunk_results = await asyncio.gather(*[analyze_categories(*chunk) for chunk in chunks])
+            return [category_result for results in chunk_results for category_result in results]
+        
+        category_results = self._run_async(analyze_all())
+        result['research_results'].extend(self._group_category_results(jobs, category_results))
         
         # Final statistics
+        flush_progress_logging()
         print("=" * 60)
         print("🎉 Hoàn thành Layer 3 Category Analysis!")
         print(f"📊 Đã phân tích: {processed_categories} categories")
         if testing_mode:
             print(f"🧪 Testing mode: Processed {total_questions_processed} questions")
         
-        # Add tracked references to result
-        top_references = self.get_top_references(10)
-        result['tracked_references'] = top_references
-        
-        print(f"📚 Tracked {len(self.tracked_sources)} unique sources")
-        if top_references:
-            print("🔝 Top references:")
-            for source, count in top_references[:5]:
-                print(f"   • {source} ({count}x)")
+        self._attach_tracked_references(result)
         
         # Add research statistics
         result['research_statistics'] = {
             'total_categories_processed': processed_categories,
             'total_questions_processed': total_questions_processed,
-            'total_sources_tracked': len(self.tracked_sources),
-            'total_api_calls': processed_categories,  # One call per category
-            'processing_time_estimate': f"{processed_categories * self.delay_seconds / 60:.1f} minutes",
+            'total_sources_tracked': len(self.reference_tracker),
+            'total_api_calls': api_calls,
+            'processing_time_estimate': f"{(time.monotonic() - start_time) / 60:.1f} minutes",
             'analysis_mode': 'Layer 3 Category Comprehensive'
         }
         
@@ -781,147 +2269,61 @@ Viết một phân tích dạng văn xuôi, liền mạch theo logic:
         """Layer 4 Analysis Mode: Detailed analysis per main question (current behavior)"""
         
         print("🎯 Chế độ Layer 4: Phân tích chi tiết theo main question")
-        processed_questions = 0
-        total_questions = 0
-        total_questions_available = 0
-        
-        # Count total questions available
-        for layer in structured_data.get('layers', []):
-            for category in layer.get('categories', []):
-                questions = category.get('questions', [])
-                total_questions_available += len(questions)
+        start_time = time.monotonic()
         
-        if testing_mode:
-            total_questions = min(5, total_questions_available)  # Limit to exactly 5 questions
-            print(f"🧪 Testing mode: Limiting to {total_questions} questions out of {total_questions_available} available")
-        else:
-            total_questions = total_questions_available
+        flat = self._select_question_items(structured_data, testing_mode)
+        total_questions = len(flat)
+        completed_questions = 0
         
-        questions_remaining = total_questions if testing_mode else float('inf')
+        print(f"🚀 Chạy song song {total_questions} questions (tối đa {self.concurrency.max_concurrency} request đồng thời)")
         
-        for layer in structured_data.get('layers', []):
-            layer_name = layer.get('name', '')
-            layer_result = {
-                'layer_name': layer_name,
-                'categories': []
-            }
+        async def analyze_question(layer_name, category_name, question_data):
+            nonlocal completed_questions
+            main_question = question_data.get('main_question', '')
+            sub_questions = question_data.get('sub_questions', [])
             
-            print(f"🔥 Đang xử lý Layer: {layer_name}")
+            # Create Layer 3 analysis
+            layer3_prompt = self.create_layer3_prompt_request(
+                layer_name, category_name, main_question, purpose
+            )
+            layer3_content = await self.call_openai_api_async(layer3_prompt, max_tokens=1400, system=self._system_preamble)
             
-            for category in layer.get('categories', []):
-                category_name = category.get('name', '')
-                category_result = {
-                    'category_name': category_name,
-                    'questions': []
-                }
-                
-                print(f"📋 Category: {category_name}")
-                
-                questions = category.get('questions', [])
-                
-                # In testing mode, limit questions to remaining count
-                if testing_mode:
-                    questions_to_process = min(len(questions), questions_remaining)
-                    questions = questions[:questions_to_process]
-                    questions_remaining -= questions_to_process
-                
-                for question_data in questions:
-                    if testing_mode and processed_questions >= total_questions:
-                        break  # Stop if we've reached the limit
-                        
-                    processed_questions += 1
-                    progress_percent = (processed_questions / total_questions) * 100
-                    
-                    main_question = question_data.get('main_question', '')
-                    sub_questions = question_data.get('sub_questions', [])
-                    
-                    print(f"  ❓ [{processed_questions}/{total_questions}] ({progress_percent:.1f}%) Processing: {main_question[:50]}...")
-                    
-                    # Create Layer 3 analysis
-                    print("    🔄 Tạo Layer 3 prompt...")
-                    layer3_prompt = self.create_layer3_prompt_request(
-                        layer_name, category_name, main_question, purpose
-                    )
-                    
-                    print("    🔍 Nghiên cứu Layer 3...")
-                    layer3_content = self.call_openai_api(layer3_prompt)
-                    
-                    # Create question result
-                    question_result = {
-                        'main_question': main_question,
-                        'sub_questions': sub_questions,
-                        'layer3_content': layer3_content
-                    }
-                    
-                    # Auto Layer 4 comprehensive if has sub-questions
-                    if sub_questions and len(sub_questions) > 0:
-                        print(f"🔄 Tạo báo cáo Layer 4 tổng hợp với {len(sub_questions)} sub-questions...")
-                        
-                        # Create temporary structure with current question data for Layer 4 enhancement
-                        temp_structure = {
-                            'research_results': [{
-                                'layer_name': layer_name,
-                                'categories': [{
-                                    'category_name': category_name,
-                                    'questions': [question_result]  # Include current question with layer3_content
-                                }]
-                            }],
-                            'purpose': purpose
-                        }
-                        
-                        comprehensive_content = self.enhance_to_layer4_comprehensive(
-                            temp_structure, 
-                            layer_name, 
-                            category_name, 
-                            main_question
-                        )
-                        
-                        question_result['layer4_comprehensive_report'] = {
-                            "comprehensive_content": comprehensive_content,
-                            "enhancement_timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-                            "sub_questions_integrated": sub_questions
-                        }
-                    
-                    category_result['questions'].append(question_result)
-                    print("    ✅ Hoàn thành Layer 3!")
-                    
-                    # Add delay to avoid rate limiting
-                    time.sleep(self.delay_seconds)
-                
-                if category_result['questions']:  # Only add category if it has questions
-                    layer_result['categories'].append(category_result)
-                
-                # Break early if we've reached the testing limit
-                if testing_mode and processed_questions >= total_questions:
-                    break
-                    
-            if layer_result['categories']:  # Only add layer if it has categories
-                result['research_results'].append(layer_result)
-                
-            # Break early if we've reached the testing limit
-            if testing_mode and processed_questions >= total_questions:
-                break
+            # Auto Layer 4 comprehensive if has sub-questions
+            comprehensive_content = None
+            if sub_questions and layer3_content:
+                comprehensive_prompt = self.create_layer4_comprehensive_report_prompt(
+                    layer_name, category_name, main_question, sub_questions, layer3_content, purpose
+                )
+                comprehensive_content = await self.call_openai_api_async(comprehensive_prompt, max_tokens=LAYER4_REPORT_MAX_TOKENS, system=self._system_preamble)
+            
+            question_result = self._layer4_question_result(question_data, layer3_content, comprehensive_content)
+            
+            completed_questions += 1
+            progress_percent = (completed_questions / total_questions) * 100
+            logger.info(f"  ✅ [{completed_questions}/{total_questions}] ({progress_percent:.1f}%) {main_question[:50]}...")
+            return question_result
+        
+        async def analyze_all():
+            # Task được tạo theo thứ tự category nên các request cùng preamble vẫn đến server gần nhau
+            return await asyncio.gather(*[analyze_question(*item) for item in flat])
         
+        question_results = self._run_async(analyze_all())
+        result['research_results'].extend(self._group_question_results(flat, question_results))
+        processed_questions = len(question_results)
+        
+        flush_progress_logging()
         print("=" * 60)
         print("🎉 Hoàn thành nghiên cứu thị trường Layer 4!")
         print(f"📊 Đã xử lý: {processed_questions} main questions")
         
-        # Add tracked references to result
-        top_references = self.get_top_references(10)
-        result['tracked_references'] = top_references
-        
-        print(f"📚 Tracked {len(self.tracked_sources)} unique sources")
-        if top_references:
-            print("🔝 Top references:")
-            for source, count in top_references[:5]:
-                print(f"   • {source} ({count}x)")
+        self._attach_tracked_references(result)
         
         # Add research statistics
         result['research_statistics'] = {
             'total_questions_processed': processed_questions,
-            'total_sources_tracked': len(self.tracked_sources),
+            'total_sources_tracked': len(self.reference_tracker),
             'total_api_calls': processed_questions * 2,  # Estimate including Layer 4
-            'processing_time_estimate': f"{processed_questions * self.delay_seconds / 60:.1f} minutes",
+            'processing_time_estimate': f"{(time.monotonic() - start_time) / 60:.1f} minutes",
             'analysis_mode': 'Layer 4 Detailed per Question'
         }
         
@@ -929,69 +2331,4 @@ Viết một phân tích dạng văn xuôi, liền mạch theo logic:
 
     def get_vietnamese_market_name(self, market: str) -> str:
         """Translate market name to Vietnamese for consistent Vietnamese reports"""
-        market_translations = {
-            "🇺🇸 United States": "🇺🇸 Hoa Kỳ",
-            "🇨🇳 China": "🇨🇳 Trung Quốc", 
-            "🇯🇵 Japan": "🇯🇵 Nhật Bản",
-            "🇰🇷 South Korea": "🇰🇷 Hàn Quốc",
-            "🇹🇭 Thailand": "🇹🇭 Thái Lan",
-            "🇸🇬 Singapore": "🇸🇬 Singapore",
-            "🇲🇾 Malaysia": "🇲🇾 Malaysia",
-            "🇮🇩 Indonesia": "🇮🇩 Indonesia",
-            "🇵🇭 Philippines": "🇵🇭 Philippines",
-            "🇬🇧 United Kingdom": "🇬🇧 Vương quốc Anh",
-            "🇩🇪 Germany": "🇩🇪 Đức",
-            "🇫🇷 France": "🇫🇷 Pháp",
-            "🇮🇹 Italy": "🇮🇹 Ý",
-            "🇪🇸 Spain": "🇪🇸 Tây Ban Nha",
-            "🇨🇦 Canada": "🇨🇦 Canada",
-            "🇦🇺 Australia": "🇦🇺 Úc",
-            "🇳🇿 New Zealand": "🇳🇿 New Zealand",
-            "🇧🇷 Brazil": "🇧🇷 Brazil",
-            "🇲🇽 Mexico": "🇲🇽 Mexico",
-            "🇮🇳 India": "🇮🇳 Ấn Độ",
-            "🇷🇺 Russia": "🇷🇺 Nga",
-            "🇿🇦 South Africa": "🇿🇦 Nam Phi",
-            "🇪🇬 Egypt": "🇪🇬 Ai Cập",
-            "🇦🇪 UAE": "🇦🇪 UAE",
-            "🇸🇦 Saudi Arabia": "🇸🇦 Ả Rập Saudi",
-            "🇹🇷 Turkey": "🇹🇷 Thổ Nhĩ Kỳ",
-            "🇳🇱 Netherlands": "🇳🇱 Hà Lan",
-            "🇸🇪 Sweden": "🇸🇪 Thụy Điển",
-            "🇳🇴 Norway": "🇳🇴 Na Uy",
-            "🇩🇰 Denmark": "🇩🇰 Đan Mạch",
-            "🇫🇮 Finland": "🇫🇮 Phần Lan",
-            "🇨🇭 Switzerland": "🇨🇭 Thụy Sĩ",
-            "🇦🇹 Austria": "🇦🇹 Áo",
-            "🇧🇪 Belgium": "🇧🇪 Bỉ",
-            "🇵🇱 Poland": "🇵🇱 Ba Lan",
-            "🇨🇿 Czech Republic": "🇨🇿 Cộng hòa Séc",
-            "🇭🇺 Hungary": "🇭🇺 Hungary",
-            "🇬🇷 Greece": "🇬🇷 Hy Lạp",
-            "🇵🇹 Portugal": "🇵🇹 Bồ Đào Nha",
-            "🇮🇪 Ireland": "🇮🇪 Ireland",
-            "🇮🇱 Israel": "🇮🇱 Israel",
-            "🇭🇰 Hong Kong": "🇭🇰 Hồng Kông",
-            "🇹🇼 Taiwan": "🇹🇼 Đài Loan",
-            "🇦🇷 Argentina": "🇦🇷 Argentina",
-            "🇨🇱 Chile": "🇨🇱 Chile",
-            "🇨🇴 Colombia": "🇨🇴 Colombia",
-            "🇵🇪 Peru": "🇵🇪 Peru",
-            "🇻🇪 Venezuela": "🇻🇪 Venezuela",
-            "🇪🇨 Ecuador": "🇪🇨 Ecuador",
-            "🇺🇾 Uruguay": "🇺🇾 Uruguay",
-            "🇧🇴 Bolivia": "🇧🇴 Bolivia",
-            "🇵🇾 Paraguay": "🇵🇾 Paraguay",
-            "🇳🇬 Nigeria": "🇳🇬 Nigeria",
-            "🇰🇪 Kenya": "🇰🇪 Kenya",
-            "🇬🇭 Ghana": "🇬🇭 Ghana",
-            "🇪🇹 Ethiopia": "🇪🇹 Ethiopia",
-            "🇺🇬 Uganda": "🇺🇬 Uganda",
-            "🇹🇿 Tanzania": "🇹🇿 Tanzania",
-            "🇿🇼 Zimbabwe": "🇿🇼 Zimbabwe",
-            "🌏 Southeast Asia": "🌏 Đông Nam Á",
-            "🌍 Asia-Pacific": "🌍 Châu Á - Thái Bình Dương",
-            "🌎 Global Market": "🌎 Thị trường Toàn cầu"
-        }
-        
-        return market_translations.get(market, market) 
\ No newline at end of file
+        return MARKET_TRANSLATIONS.get(market, market)
\ No newline at end of file
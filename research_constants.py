@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Hằng số dùng chung giữa engine nghiên cứu, báo cáo Word và Streamlit UI
+Chỉ dùng thư viện chuẩn để module export báo cáo không phải import OpenAI/httpx
+"""
+
+import re
+
+# Tên thị trường (market selector) → tiếng Việt cho prompt (openai_market_research) và báo cáo Word
+MARKET_TRANSLATIONS = {
+    "🇺🇸 United States": "🇺🇸 Hoa Kỳ",
+    "🇨🇳 China": "🇨🇳 Trung Quốc", 
+    "🇯🇵 Japan": "🇯🇵 Nhật Bản",
+    "🇰🇷 South Korea": "🇰🇷 Hàn Quốc",
+    "🇹🇭 Thailand": "🇹🇭 Thái Lan",
+    "🇸🇬 Singapore": "🇸🇬 Singapore",
+    "🇲🇾 Malaysia": "🇲🇾 Malaysia",
+    "🇮🇩 Indonesia": "🇮🇩 Indonesia",
+    "🇵🇭 Philippines": "🇵🇭 Philippines",
+    "🇬🇧 United Kingdom": "🇬🇧 Vương quốc Anh",
+    "🇩🇪 Germany": "🇩🇪 Đức",
+    "🇫🇷 France": "🇫🇷 Pháp",
+    "🇮🇹 Italy": "🇮🇹 Ý",
+    "🇪🇸 Spain": "🇪🇸 Tây Ban Nha",
+    "🇨🇦 Canada": "🇨🇦 Canada",
+    "🇦🇺 Australia": "🇦🇺 Úc",
+    "🇳🇿 New Zealand": "🇳🇿 New Zealand",
+    "🇧🇷 Brazil": "🇧🇷 Brazil",
+    "🇲🇽 Mexico": "🇲🇽 Mexico",
+    "🇮🇳 India": "🇮🇳 Ấn Độ",
+    "🇷🇺 Russia": "🇷🇺 Nga",
+    "🇿🇦 South Africa": "🇿🇦 Nam Phi",
+    "🇪🇬 Egypt": "🇪🇬 Ai Cập",
+    "🇦🇪 UAE": "🇦🇪 UAE",
+    "🇸🇦 Saudi Arabia": "🇸🇦 Ả Rập Saudi",
+    "🇹🇷 Turkey": "🇹🇷 Thổ Nhĩ Kỳ",
+    "🇳🇱 Netherlands": "🇳🇱 Hà Lan",
+    "🇸🇪 Sweden": "🇸🇪 Thụy Điển",
+    "🇳🇴 Norway": "🇳🇴 Na Uy",
+    "🇩🇰 Denmark": "🇩🇰 Đan Mạch",
+    "🇫🇮 Finland": "🇫🇮 Phần Lan",
+    "🇨🇭 Switzerland": "🇨🇭 Thụy Sĩ",
+    "🇦🇹 Austria": "🇦🇹 Áo",
+    "🇧🇪 Belgium": "🇧🇪 Bỉ",
+    "🇵🇱 Poland": "🇵🇱 Ba Lan",
+    "🇨🇿 Czech Republic": "🇨🇿 Cộng hòa Séc",
+    "🇭🇺 Hungary": "🇭🇺 Hungary",
+    "🇬🇷 Greece": "🇬🇷 Hy Lạp",
+    "🇵🇹 Portugal": "🇵🇹 Bồ Đào Nha",
+    "🇮🇪 Ireland": "🇮🇪 Ireland",
+    "🇮🇱 Israel": "🇮🇱 Israel",
+    "🇭🇰 Hong Kong": "🇭🇰 Hồng Kông",
+    "🇹🇼 Taiwan": "🇹🇼 Đài Loan",
+    "🇦🇷 Argentina": "🇦🇷 Argentina",
+    "🇨🇱 Chile": "🇨🇱 Chile",
+    "🇨🇴 Colombia": "🇨🇴 Colombia",
+    "🇵🇪 Peru": "🇵🇪 Peru",
+    "🇻🇪 Venezuela": "🇻🇪 Venezuela",
+    "🇪🇨 Ecuador": "🇪🇨 Ecuador",
+    "🇺🇾 Uruguay": "🇺🇾 Uruguay",
+    "🇧🇴 Bolivia": "🇧🇴 Bolivia",
+    "🇵🇾 Paraguay": "🇵🇾 Paraguay",
+    "🇳🇬 Nigeria": "🇳🇬 Nigeria",
+    "🇰🇪 Kenya": "🇰🇪 Kenya",
+    "🇬🇭 Ghana": "🇬🇭 Ghana",
+    "🇪🇹 Ethiopia": "🇪🇹 Ethiopia",
+    "🇺🇬 Uganda": "🇺🇬 Uganda",
+    "🇹🇿 Tanzania": "🇹🇿 Tanzania",
+    "🇿🇼 Zimbabwe": "🇿🇼 Zimbabwe",
+    "🌏 Southeast Asia": "🌏 Đông Nam Á",
+    "🌍 Asia-Pacific": "🌍 Châu Á - Thái Bình Dương",
+    "🌎 Global Market": "🌎 Thị trường Toàn cầu"
+}
+
+# Tiếng Việt tốn ~2-3 token/từ: budget của các output có số từ mục tiêu = số từ tối đa × hệ số cận trên,
+# đặt thấp hơn sẽ cắt báo cáo giữa section
+TOKENS_PER_VIETNAMESE_WORD = 3
+
+
+def max_tokens_for_words(max_words: int) -> int:
+    """max_tokens cho output tiếng Việt dài tối đa max_words từ"""
+    return max_words * TOKENS_PER_VIETNAMESE_WORD
+
+
+# Tên file: bỏ ký tự đặc biệt rồi thay khoảng trắng bằng '_' (compile một lần)
+FILENAME_UNSAFE_RE = re.compile(r'[^\w\s-]')
+WHITESPACE_RE = re.compile(r'\s+')
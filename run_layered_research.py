@@ -6,15 +6,19 @@ Hỗ trợ nghiên cứu thị trường với cấp độ Layer 3 và enhanceme
 Updated to use OpenAI GPT-3.5-turbo
 """
 
-import json
+import orjson
 import os
+import traceback
 from typing import List
-from openai_market_research import OpenAIMarketResearch
+from openai_market_research import OpenAIMarketResearch, Layer3Store
 from config import OPENAI_API_KEY, RESEARCH_CONFIG, MODEL
 from excel_to_structured_json import convert_market_research_to_json
 
-def run_complete_research_workflow():
-    """Chạy workflow hoàn chỉnh: Excel → JSON → Research → Ready for Export"""
+def run_complete_research_workflow(use_batch=False):
+    """Chạy workflow hoàn chỉnh: Excel → JSON → Research → Ready for Export
+    
+    use_batch=True gửi toàn bộ request qua OpenAI Batch API (rẻ hơn ~50%, kết quả có thể mất tới 24h)
+    """
     print("\n🚀 COMPLETE RESEARCH WORKFLOW")
     print("="*60)
     
@@ -44,42 +48,20 @@ def run_complete_research_workflow():
     print(f"\n📊 BƯỚC 2: CONVERT EXCEL → JSON")
     print("-" * 30)
     
-    # Temporarily update the excel path in the converter
-    import excel_to_structured_json
-    original_convert = excel_to_structured_json.convert_market_research_to_json
-    
-    def convert_with_custom_path():
-        # Temporarily modify the excel file path
-        temp_excel_file = excel_to_structured_json.convert_market_research_to_json.__code__.co_filename
-        # Read the file content and replace the path
-        with open("excel_to_structured_json.py", 'r') as f:
-            content = f.read()
-        
-        # For simplicity, we'll just call the original function but inform user about path
-        print(f"🔄 Converting: {excel_path}")
-        
-        if excel_path != default_excel:
-            print("⚠️ Đang sử dụng file tùy chỉnh. Hãy đảm bảo file có cấu trúc giống file mặc định.")
-            
-        # If using custom path, temporarily copy to expected location
-        if excel_path != default_excel:
-            import shutil
-            os.makedirs("input", exist_ok=True)
-            shutil.copy2(excel_path, default_excel)
-            print(f"📋 Đã copy file vào: {default_excel}")
-        
-        return original_convert()
+    print(f"🔄 Converting: {excel_path}")
+    if excel_path != default_excel:
+        print("⚠️ Đang sử dụng file tùy chỉnh. Hãy đảm bảo file có cấu trúc giống file mặc định.")
     
-    result = convert_with_custom_path()
+    structured_data = convert_market_research_to_json(excel_path)
     
-    if not result:
+    if not structured_data:
         print("❌ Convert Excel thất bại!")
         return False
     
     print(f"✅ Convert thành công!")
-    print(f"📊 Đã tạo {len(result.get('layers', []))} layers")
+    print(f"📊 Đã tạo {len(structured_data.get('layers', []))} layers")
     total_questions = 0
-    for layer in result.get('layers', []):
+    for layer in structured_data.get('layers', []):
         for category in layer.get('categories', []):
             total_questions += len(category.get('questions', []))
     print(f"❓ Tổng {total_questions} questions")
@@ -95,9 +77,9 @@ def run_complete_research_workflow():
     
     print(f"\n🎯 Topic: {topic}")
     print(f"🌍 Market: Việt Nam")
-    print(f"💰 Estimated cost: ~$0.15-0.25")
+    print(f"💰 Estimated cost: {'~$0.08-0.13 (Batch API)' if use_batch else '~$0.15-0.25'}")
     print(f"🤖 Auto Layer 4: Questions có sub-questions sẽ tự động được enhance")
-    print(f"⏱️ Estimated time: ~15-25 minutes")
+    print(f"⏱️ Estimated time: {'vài phút đến 24h (Batch API)' if use_batch else '~15-25 minutes'}")
     
     if input("\n▶️ Bắt đầu nghiên cứu? (Y/n): ").strip().lower() not in ['', 'y', 'yes']:
         return False
@@ -110,11 +92,6 @@ def run_complete_research_workflow():
     output_dir = 'output'
     os.makedirs(output_dir, exist_ok=True)
     
-    # Load structured data
-    structured_file = os.path.join(output_dir, 'market_research_structured.json')
-    with open(structured_file, 'r', encoding='utf-8') as f:
-        structured_data = json.load(f)
-
     # Process research (always full mode)
     researcher = OpenAIMarketResearch(
         api_key=OPENAI_API_KEY,
@@ -123,46 +100,52 @@ def run_complete_research_workflow():
         model=MODEL
     )
     
-    print("🔄 Đang chạy Layer 3 Research...")
-    result = researcher.run_layer3_research(structured_data, topic, testing_mode=False)
+    if use_batch:
+        print("🔄 Đang chạy Layer 3 Research qua Batch API...")
+        result = researcher.run_layer3_research_batch(structured_data, topic, testing_mode=False)
+    else:
+        print("🔄 Đang chạy Layer 3 Research...")
+        result = researcher.run_layer3_research(structured_data, topic, testing_mode=False)
     
     if not result:
         print("❌ Nghiên cứu thất bại!")
         return False
     
-    # Save research results
+    # Save research results - bản compact làm checkpoint Layer 3 (sidecar Layer 4 replay lên file này nếu bị ngắt),
+    # store.flush() ghi lại bản indent đầy đủ ở cuối
     output_file = os.path.join(output_dir, f"layer3_research_{topic.replace(' ', '_')}_openai.json")
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(result, f, ensure_ascii=False, indent=2)
+    with open(output_file, 'wb') as f:
+        f.write(orjson.dumps(result, option=orjson.OPT_NON_STR_KEYS))
     
     print(f"✅ Hoàn thành Layer 3!")
     
     # Auto-generate comprehensive Layer 4 reports
     print(f"\n🚀 TỰ ĐỘNG TẠO BÁO CÁO LAYER 4...")
     
-    comprehensive_count = 0
-    total_questions = 0
+    store = Layer3Store(output_file, results=result)  # Dùng result trong memory, ghi file một lần sau khi tạo xong tất cả reports
+    
+    questions = [
+        (layer.get('layer_name'), category.get('category_name'), question)
+        for layer in result.get('research_results', [])
+        for category in layer.get('categories', [])
+        for question in category.get('questions', [])
+    ]
+    total_questions = len(questions)
+    # Có sub-questions mà chưa có report từ Layer 4 Analysis → tạo comprehensive report (song song)
+    pending = [
+        (layer_name, category_name, question.get('main_question'))
+        for layer_name, category_name, question in questions
+        if question.get('sub_questions') and not question.get('layer4_comprehensive_report')
+    ]
+    comprehensive_count = sum('layer4_comprehensive_report' in question for _, _, question in questions)
     
-    for layer in result.get('research_results', []):
-        for category in layer.get('categories', []):
-            for question in category.get('questions', []):
-                total_questions += 1
-                sub_questions = question.get('sub_questions', [])
-                
-                if sub_questions:  # Có sub-questions → tạo comprehensive report
-                    print(f"  🔄 Tạo comprehensive report: {question.get('main_question', '')[:50]}...")
-                    
-                    try:
-                        researcher.add_layer4_comprehensive_enhancement(
-                            results_file=output_file,
-                            layer_name=layer.get('layer_name'),
-                            category_name=category.get('category_name'),
-                            main_question=question.get('main_question')
-                        )
-                        comprehensive_count += 1
-                        print(f"    ✅ Hoàn thành!")
-                    except Exception as e:
-                        print(f"    ❌ Lỗi: {e}")
+    try:
+        comprehensive_count += researcher.add_layer4_comprehensive_enhancements(store, pending)
+    except Exception as e:
+        print(f"    ❌ Lỗi: {e}")
+    
+    store.flush()
+    researcher.close()
     
     print(f"\n🎉 HOÀN THÀNH TẤT CẢ!")
     print(f"📊 Tổng questions: {total_questions}")
@@ -178,29 +161,23 @@ def export_word_document():
     print("\n📄 EXPORT WORD DOCUMENT")
     print("="*50)
     
+    # Export chạy trong cùng process (python-docx import lazy khi cần)
+    from export_comprehensive_report import export_report, latest_research_file_in
+    
     # Find latest research file
     output_dir = 'output'
-    files = []
-    
-    if os.path.exists(output_dir):
-        for file in os.listdir(output_dir):
-            if file.startswith('layer3_research_') and file.endswith('.json'):
-                files.append(os.path.join(output_dir, file))
+    latest_file = latest_research_file_in(output_dir) if os.path.exists(output_dir) else None
     
-    if not files:
+    if not latest_file:
         print("❌ Không tìm thấy file research results!")
         print("💡 Hãy chạy Complete Research Workflow trước (Option 1).")
         return False
     
-    # Get the latest file
-    files.sort(key=lambda x: os.path.getmtime(x), reverse=True)
-    latest_file = files[0]
-    
     print(f"📁 Sử dụng file: {latest_file}")
     
     # Show basic info
-    with open(latest_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    with open(latest_file, 'rb') as f:
+        data = orjson.loads(f.read())
     
     print(f"🎯 Topic: {data.get('industry', 'N/A')}")
     print(f"🌍 Market: {data.get('market', 'N/A')}")
@@ -223,19 +200,19 @@ def export_word_document():
     
     print(f"\n🔄 Đang export Word document...")
     
-    # Run export script
-    import subprocess
     try:
-        result = subprocess.run(["python", "export_comprehensive_report.py"], 
-                              capture_output=True, text=True, check=True)
-        print("✅ Export thành công!")
-        print(f"📄 File Word đã được tạo trong folder output/")
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Lỗi export: {e}")
-        print(f"Output: {e.stdout}")
-        print(f"Error: {e.stderr}")
+        word_file = export_report(latest_file, output_dir)
+    except Exception:
+        print("❌ Lỗi export:")
+        traceback.print_exc()
+        return False
+    
+    if not word_file:
+        print("❌ Export thất bại!")
         return False
+    print("✅ Export thành công!")
+    print(f"📄 File Word: {word_file}")
+    return True
 
 def main():
     """Hàm main với menu đơn giản 3 options"""
@@ -250,6 +227,7 @@ def main():
     while True:
         print("\n📋 MENU:")
         print("1. 🚀 Complete Research Workflow (Excel → JSON → Research → Ready)")
+        print("1b. 💸 Complete Research Workflow qua Batch API (rẻ hơn ~50%, chậm hơn)")
         print("2. 📄 Export Word Document")
         print("3. 👋 Thoát")
         
@@ -258,6 +236,9 @@ def main():
         if choice == "1":
             run_complete_research_workflow()
             
+        elif choice.lower() == "1b":
+            run_complete_research_workflow(use_batch=True)
+            
         elif choice == "2":
             export_word_document()
             
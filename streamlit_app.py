@@ -7,22 +7,25 @@ Beautiful Streamlit interface for marketing teams
 
 import streamlit as st
 import pandas as pd
-import json
+import orjson
 import os
 import time
+import threading
 from datetime import datetime
-import plotly.express as px
-import plotly.graph_objects as go
 from streamlit_option_menu import option_menu
-import re
-import glob
+import io
+from bisect import bisect_left
+from research_constants import FILENAME_UNSAFE_RE, WHITESPACE_RE  # Filename cleaning (market suffixes, industry part of result filenames)
 
 # Get OpenAI API key from multiple sources (deployment-friendly)
+# Resolved once per process: Streamlit re-executes this module on every rerun, so a plain
+# lru_cache would be rebuilt each time - st.cache_resource survives reruns
+@st.cache_resource(show_spinner=False)
 def get_openai_api_key():
     # 1. Try Streamlit secrets (for Streamlit Cloud deployment)
     try:
         return st.secrets["OPENAI_API_KEY"]
-    except:
+    except (KeyError, FileNotFoundError):  # No secrets.toml (StreamlitSecretNotFoundError) or key missing
         pass
     
     # 2. Try environment variable
@@ -42,13 +45,12 @@ def get_openai_api_key():
 
 OPENAI_API_KEY = get_openai_api_key()
 
-# Import our core modules
-from excel_to_structured_json import ExcelToStructuredJSON
-from openai_market_research import OpenAIMarketResearch
-from export_comprehensive_report import create_comprehensive_word_report, find_latest_research_file
+def current_api_key():
+    """API key for this session: the one saved in Settings, else the configured OPENAI_API_KEY"""
+    return st.session_state.get('openai_api_key', OPENAI_API_KEY)
 
 # World countries list for Target Market selection
-WORLD_COUNTRIES = [
+WORLD_COUNTRIES = (
     "🇻🇳 Việt Nam", "🇺🇸 United States", "🇨🇳 China", "🇯🇵 Japan", "🇰🇷 South Korea",
     "🇹🇭 Thailand", "🇸🇬 Singapore", "🇲🇾 Malaysia", "🇮🇩 Indonesia", "🇵🇭 Philippines",
     "🇬🇧 United Kingdom", "🇩🇪 Germany", "🇫🇷 France", "🇮🇹 Italy", "🇪🇸 Spain",
@@ -62,7 +64,21 @@ WORLD_COUNTRIES = [
     "🇺🇾 Uruguay", "🇧🇴 Bolivia", "🇵🇾 Paraguay", "🇳🇬 Nigeria", "🇰🇪 Kenya",
     "🇬🇭 Ghana", "🇪🇹 Ethiopia", "🇺🇬 Uganda", "🇹🇿 Tanzania", "🇿🇼 Zimbabwe",
     "🌏 Southeast Asia", "🌍 Asia-Pacific", "🌎 Global Market"
-]
+)
+
+def market_file_suffix(market):
+    """Filename suffix for a target market label (e.g. "_VN", "_United_States")"""
+    if not market or market.lower() == "global market":
+        return ""
+    if "việt nam" in market.lower() or "vietnam" in market.lower():
+        return "_VN"
+    # Clean market name for filename
+    clean_market = FILENAME_UNSAFE_RE.sub('', market).strip()
+    clean_market = WHITESPACE_RE.sub('_', clean_market)
+    return f"_{clean_market}"
+
+# Suffixes are fixed per selectbox option - computed once instead of on every submit
+MARKET_FILE_SUFFIXES = {country: market_file_suffix(country) for country in WORLD_COUNTRIES}
 
 # Page config
 st.set_page_config(
@@ -72,7 +88,8 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Custom CSS
+# Custom CSS - must be emitted on every rerun: Streamlit drops elements a rerun doesn't re-emit,
+# so a session_state "already injected" guard would strip the styles after the first interaction
 st.markdown("""
 <style>
     .main-header {
@@ -148,22 +165,110 @@ def main():
     elif selected == "⚙️ Settings":
         show_settings_page()
 
-def validate_excel_template(file_path):
+@st.cache_data(max_entries=32, show_spinner=False)
+def read_file_bytes(path, mtime):
+    """
+    File contents cached across reruns; mtime is part of the cache key so a rewritten file is re-read
+    max_entries bounds memory - every (path, mtime) pair of an MB-sized report would otherwise stay cached
+    """
+    with open(path, 'rb') as f:
+        return f.read()
+
+@st.cache_resource(show_spinner=False)
+def researcher_slot():
+    """Process-wide slot holding the current research engine (see get_researcher)"""
+    return {'lock': threading.Lock(), 'api_key': None, 'engine': None}
+
+def get_researcher(api_key):
+    """
+    Research engine shared across reruns and sessions, so its HTTP connection pool, SQLite caches and
+    learned rate-limit state are reused by the next run. Returns (researcher, run_lock): the instance
+    keeps per-run state (reference tracker, industry/market), so concurrent sessions must take turns on it.
+    
+    One engine per process, keyed on the API key: when the key changes the previous engine is closed
+    (sync/async HTTP pools, SQLite caches) instead of being dropped with its connections still open.
+    """
+    slot = researcher_slot()
+    with slot['lock']:
+        if slot['api_key'] != api_key:
+            if slot['engine'] is not None:
+                previous, previous_lock = slot['engine']
+                with previous_lock:  # Let a run still using the old key finish first
+                    previous.close()
+            from openai_market_research import OpenAIMarketResearch
+            slot['engine'] = (OpenAIMarketResearch(api_key=api_key), threading.Lock())
+            slot['api_key'] = api_key
+        return slot['engine']
+
+@st.cache_data(ttl=5, show_spinner=False)
+def file_mtime(path):
+    """mtime of path, or None if it does not exist - one stat per path, re-checked at most every 5s"""
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+@st.cache_data(ttl=5, show_spinner=False)
+def scan_output_dir(path='output'):
+    """(name, size, mtime) of every file in the output directory - one scandir pass, re-scanned at most every 5s"""
+    entries = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_file():
+                    stat = entry.stat()
+                    entries.append((entry.name, stat.st_size, stat.st_mtime))
+    except FileNotFoundError:
+        pass
+    return entries
+
+def read_excel_bytes(uploaded_file, default_path):
+    """Bytes of the uploaded Excel file, or of the default template when nothing was uploaded"""
+    if uploaded_file:
+        return uploaded_file.getvalue()
+    return read_file_bytes(default_path, file_mtime(default_path))
+
+# Template caches are keyed on the whole workbook bytes; max_entries keeps a stream of distinct uploads from growing memory
+@st.cache_data(show_spinner=False, max_entries=16)
+def parse_excel_template(file_bytes):
+    """
+    Parse the workbook once per file content (cached across Streamlit reruns, keyed on the bytes)
+    Returns: (sheet_names, template DataFrame or None if there is no 'template' sheet)
     """
-    Validate uploaded Excel file format
+    from excel_to_structured_json import EXCEL_ENGINE  # calamine if installed, else pandas default (openpyxl)
+    excel_file = pd.ExcelFile(io.BytesIO(file_bytes), engine=EXCEL_ENGINE)
+    if 'template' not in excel_file.sheet_names:
+        return excel_file.sheet_names, None
+    # dtype=object: the template is all text - keep raw cell values and skip per-column dtype inference
+    return excel_file.sheet_names, excel_file.parse("template", dtype=object)
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def convert_excel_template(file_bytes, excel_path):
+    """
+    Structured data (purpose + layers) of the workbook, converted once per file content
+    Returns None if there is no 'template' sheet or the conversion fails
+    """
+    _, template_df = parse_excel_template(file_bytes)
+    if template_df is None:
+        return None
+    # Core modules are imported on first use so Settings/Results reruns skip them
+    from excel_to_structured_json import ExcelToStructuredJSON
+    return ExcelToStructuredJSON().convert_excel_to_data(excel_path, df=template_df)
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def validate_excel_template(file_bytes):
+    """
+    Validate uploaded Excel file format (cached per file content - upload preview and submit share one result)
     Returns: (is_valid, error_message, main_question_count, sub_question_count, total_estimated_cost)
     """
     try:
-        # Try to read the Excel file
-        excel_file = pd.ExcelFile(file_path)
+        # Try to read the Excel file (cached parse)
+        sheet_names, df = parse_excel_template(file_bytes)
         
         # Check if 'template' sheet exists
-        if 'template' not in excel_file.sheet_names:
+        if df is None:
             return False, "❌ Sheet 'template' not found! Please use the correct template format or rename your sheet to 'template'.", 0, 0, 0
         
-        # Read template sheet
-        df = pd.read_excel(file_path, sheet_name="template")
-        
         # Check if dataframe is not empty
         if df.empty:
             return False, "❌ Sheet 'template' is empty! Please add data to your template.", 0, 0, 0
@@ -173,11 +278,8 @@ def validate_excel_template(file_path):
             return False, "❌ Template needs at least 3 columns! Please use the standard template format.", 0, 0, 0
         
         # Look for purpose row
-        purpose_found = False
-        for idx, row in df.iterrows():
-            if any("Mục đích" in str(cell) for cell in row if pd.notna(cell)):
-                purpose_found = True
-                break
+        # Single vectorized pass; na=False so missing cells never match (no separate notna mask)
+        purpose_found = bool(df.astype(str).apply(lambda col: col.str.contains("Mục đích", regex=False, na=False)).to_numpy().any())
         
         if not purpose_found:
             return False, "❌ 'Market Research Purpose' row not found! Please use the standard template format.", 0, 0, 0
@@ -195,102 +297,56 @@ def validate_excel_template(file_path):
     except Exception as e:
         return False, f"❌ Error reading Excel file: {str(e)}. Please check if the file is corrupted.", 0, 0, 0
 
+def non_empty_cells(frame):
+    """Boolean mask of cells holding real text (not NaN, blank or the string 'None')"""
+    text = frame.astype(str).apply(lambda col: col.str.strip())
+    return frame.notna() & text.ne("") & text.ne("None")
+
 def count_questions_in_excel(df):
     """
     Count total number of questions (Layer 3) and sub-questions (Layer 4+) in Excel template
     Supports dynamic number of layers (Layer 5, 6, etc.)
     Returns: (main_question_count, sub_question_count)
     """
-    main_question_count = 0
-    sub_question_count = 0
-    
-    # Find layer header row
-    layer_header_row = None
-    layer_columns = []
-    
-    for idx, row in df.iterrows():
-        if any("Layer" in str(cell) for cell in row if pd.notna(cell)):
-            layer_header_row = idx
-            # Detect all layer columns dynamically
-            for col_idx, col_val in enumerate(row):
-                if pd.notna(col_val) and "Layer" in str(col_val):
-                    layer_columns.append(col_idx)
-            break
-    
-    if layer_header_row is None or len(layer_columns) < 3:
-        return 0, 0
-    
-    # Debug information
-    print(f"🔍 DEBUG: Found {len(layer_columns)} layers at columns {layer_columns}")
-    
-    # Map layer positions for counting
-    layer3_col = layer_columns[2] if len(layer_columns) > 2 else None  # Layer 3 (main questions)
-    layer4_plus_cols = layer_columns[3:] if len(layer_columns) > 3 else []  # Layer 4+ (sub-questions)
-    
-    print(f"🔍 DEBUG: Layer 3 column: {layer3_col}, Layer 4+ columns: {layer4_plus_cols}")
-    
-    # Count questions with more detailed logging
-    question_details = []
     try:
-        for idx in range(layer_header_row + 1, len(df)):
-            row = df.iloc[idx]
-            
-            # Skip empty rows
-            if row.isna().all():
-                continue
-            
-            # Check Layer 3 column (main questions)
-            if layer3_col is not None and layer3_col < len(row):
-                layer3_val = row.iloc[layer3_col] if pd.notna(row.iloc[layer3_col]) else None
-                if layer3_val and str(layer3_val).strip() and str(layer3_val) != 'None':
-                    main_question_count += 1
-                    
-                    # Check Layer 4+ columns for sub-questions
-                    has_sub_questions = False
-                    total_individual_sub_questions = 0
-                    sub_question_texts = []
-                    for layer_col in layer4_plus_cols:
-                        if layer_col < len(row):
-                            layer_val = row.iloc[layer_col] if pd.notna(row.iloc[layer_col]) else None
-                            if layer_val and str(layer_val).strip() and str(layer_val) != 'None':
-                                has_sub_questions = True
-                                
-                                # Count individual sub-questions for debugging
-                                sub_q_text = str(layer_val)
-                                # Split by common patterns: newlines, semicolons, bullet points
-                                import re
-                                sub_questions_list = re.split(r'[\n;•\-]\s*', sub_q_text)
-                                # Filter out empty strings and count actual sub-questions
-                                valid_sub_questions = [sq.strip() for sq in sub_questions_list if sq.strip()]
-                                individual_count = len(valid_sub_questions)
-                                total_individual_sub_questions += individual_count
-                                sub_question_texts.append(f"{individual_count} individual sub-questions")
-                    
-                    if has_sub_questions:
-                        sub_question_count += 1  # Count as 1 enhancement per main question with sub-questions
-                    
-                    # Store for debugging
-                    question_details.append({
-                        'row': idx,
-                        'main_question': str(layer3_val)[:50] + "...",
-                        'has_sub_questions': has_sub_questions,
-                        'individual_sub_question_count': total_individual_sub_questions,
-                        'sub_question_preview': sub_question_texts[:2]  # First 2 sub-questions preview
-                    })
+        # Find layer header row: first row with a "Layer ..." cell (vectorized, no iterrows)
+        layer_cells = df.notna() & df.astype(str).apply(lambda col: col.str.contains("Layer", regex=False))
+        header_rows = layer_cells.to_numpy().any(axis=1).nonzero()[0]
+        if len(header_rows) == 0:
+            return 0, 0
+        layer_header_row = header_rows[0]
+        
+        # Detect all layer columns dynamically
+        layer_columns = layer_cells.iloc[layer_header_row].to_numpy().nonzero()[0].tolist()
+        if len(layer_columns) < 3:
+            return 0, 0
+        
+        # Debug information
+        print(f"🔍 DEBUG: Found {len(layer_columns)} layers at columns {layer_columns}")
+        
+        # Map layer positions for counting
+        layer3_col = layer_columns[2]  # Layer 3 (main questions)
+        layer4_plus_cols = layer_columns[3:]  # Layer 4+ (sub-questions)
+        
+        print(f"🔍 DEBUG: Layer 3 column: {layer3_col}, Layer 4+ columns: {layer4_plus_cols}")
+        
+        rows = df.iloc[layer_header_row + 1:]
+        has_main_question = non_empty_cells(rows.iloc[:, [layer3_col]]).iloc[:, 0]
+        main_question_count = int(has_main_question.sum())
+        
+        # Count as 1 enhancement per main question with sub-questions
+        if layer4_plus_cols:
+            has_sub_questions = non_empty_cells(rows.iloc[:, layer4_plus_cols]).any(axis=1)
+            sub_question_count = int((has_main_question & has_sub_questions).sum())
+        else:
+            sub_question_count = 0
                         
     except Exception as e:
         print(f"Error counting questions: {e}")
         return 0, 0
     
     # Debug output
-    total_individual_sub_questions = sum(detail['individual_sub_question_count'] for detail in question_details)
     print(f"🔍 DEBUG: Final counts - Main questions: {main_question_count}, Layer 4 enhancements: {sub_question_count}")
-    print(f"🔍 DEBUG: Total individual sub-questions across all main questions: {total_individual_sub_questions}")
-    print(f"🔍 DEBUG: Sample questions:")
-    for i, detail in enumerate(question_details[:5]):  # Show first 5
-        print(f"  {i+1}. Row {detail['row']}: {detail['main_question']} | Has sub-questions: {detail['has_sub_questions']}")
-        if detail['sub_question_preview']:
-            print(f"     Sub-questions preview: {detail['sub_question_preview']} | Individual count: {detail['individual_sub_question_count']}")
     
     return main_question_count, sub_question_count
 
@@ -334,36 +390,33 @@ def calculate_dynamic_cost(question_count, sub_question_count, analysis_level="L
         
         return total_cost, layer3_cost, layer4_cost, 0
 
+# Cost tiers: a value <= LIMITS[i] falls in tier i, anything above the last limit in the final tier
+COST_RATE_LIMITS = (5, 25, 50, 100)
+COST_RATES = (0.03, 0.02, 0.025, 0.03, 0.04)  # $ per question (very large templates cost more per question)
+
+COST_WARNING_LIMITS = (0.15, 0.50, 1.25, 3.0)
+COST_WARNING_LEVELS = (
+    ("info", "💰 Total Cost: ${cost:.2f} ({count} questions)"),
+    ("info", "💰 Total Cost: ${cost:.2f} ({count} questions) - Standard Level"),
+    ("warning", "⚠️ Total Cost: ${cost:.2f} ({count} questions) - High Level"),
+    ("error", "🚨 Total Cost: ${cost:.2f} ({count} questions) - Very High!"),
+    ("error", "🔴 WARNING: Total Cost ${cost:.2f} ({count} questions) - Extremely Expensive!"),
+)
+
 def estimate_research_cost(question_count):
     """
     Estimate research cost based on number of questions
     Returns: float - estimated cost in USD
     """
-    if question_count <= 5:
-        return round(question_count * 0.03, 2)
-    elif question_count <= 25:
-        return round(question_count * 0.02, 2)
-    elif question_count <= 50:
-        return round(question_count * 0.025, 2)
-    elif question_count <= 100:
-        return round(question_count * 0.03, 2)
-    else:
-        # For very large templates, increase cost per question
-        return round(question_count * 0.04, 2)
+    return round(question_count * COST_RATES[bisect_left(COST_RATE_LIMITS, question_count)], 2)
 
 def display_cost_warning(question_count, total_estimated_cost, analysis_level="Layer 4 Analysis", layer3_cost=0, layer4_cost=0, category_count=0):
     """Display cost warning with analysis level breakdown"""
     
-    if total_estimated_cost <= 0.15:
-        st.info(f"💰 Total Cost: ${total_estimated_cost:.2f} ({question_count} questions)")
-    elif total_estimated_cost <= 0.50:
-        st.info(f"💰 Total Cost: ${total_estimated_cost:.2f} ({question_count} questions) - Standard Level")
-    elif total_estimated_cost <= 1.25:
-        st.warning(f"⚠️ Total Cost: ${total_estimated_cost:.2f} ({question_count} questions) - High Level")
-    elif total_estimated_cost <= 3.0:
-        st.error(f"🚨 Total Cost: ${total_estimated_cost:.2f} ({question_count} questions) - Very High!")
-    else:
-        st.error(f"🔴 WARNING: Total Cost ${total_estimated_cost:.2f} ({question_count} questions) - Extremely Expensive!")
+    tier = bisect_left(COST_WARNING_LIMITS, total_estimated_cost)
+    level, template = COST_WARNING_LEVELS[tier]
+    getattr(st, level)(template.format(cost=total_estimated_cost, count=question_count))
+    if tier == len(COST_WARNING_LIMITS):
         st.error("💡 Recommendation: Split into multiple smaller research projects")
     
     # Show breakdown based on analysis level
@@ -384,26 +437,66 @@ def proceed_with_research():
     st.session_state['start_research'] = True
     st.rerun()
 
+@st.fragment
+def show_report_download():
+    """Word report download - a fragment, so the download click reruns only this block"""
+    # Word download button
+    word_file = st.session_state.get('word_file')
+    word_mtime = file_mtime(word_file) if word_file else None
+    if word_mtime is not None:
+        st.download_button(
+            label="📄 Download Word Report",
+            data=read_file_bytes(word_file, word_mtime),
+            file_name=os.path.basename(word_file),
+            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+            use_container_width=True
+        )
+    else:
+        # Fallback: Try to find the most recent Word file
+        try:
+            word_files = [
+                (name, mtime) for name, _, mtime in scan_output_dir()
+                if name.startswith("Báo_cáo_nghiên_cứu_thị_trường_") and name.endswith(".docx")
+            ]
+            if word_files:
+                # Get the most recent file
+                latest_name, latest_mtime = max(word_files, key=lambda item: item[1])
+                st.info(f"🔍 Found recent Word file: {latest_name}")
+                
+                st.download_button(
+                    label="📄 Download Latest Word Report",
+                    data=read_file_bytes(os.path.join("output", latest_name), latest_mtime),
+                    file_name=latest_name,
+                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                    use_container_width=True
+                )
+            else:
+                st.error("❌ No Word files found in output directory.")
+                
+        except Exception as e:
+            st.error(f"❌ Error finding Word file: {str(e)}")
+
 def show_research_page():
     """New research creation page - simplified and streamlined"""
     st.header("🚀 Create Market Research Report")
     
     # Check API key
-    if not OPENAI_API_KEY or OPENAI_API_KEY == "your-openai-api-key-here":
+    api_key = current_api_key()
+    if not api_key or api_key == "your-openai-api-key-here":
         st.error("⚠️ Please configure your OpenAI API key in Settings first!")
         return
     
     # Simple template download
     template_path = 'input/market research template.xlsx'
-    if os.path.exists(template_path):
-        with open(template_path, 'rb') as template_file:
-            st.download_button(
-                label="📥 Download Excel Template",
-                data=template_file.read(),
-                file_name="market_research_template.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                use_container_width=True
-            )
+    template_mtime = file_mtime(template_path)
+    if template_mtime is not None:
+        st.download_button(
+            label="📥 Download Excel Template",
+            data=read_file_bytes(template_path, template_mtime),
+            file_name="market_research_template.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            use_container_width=True
+        )
     
     # Excel file upload with IMMEDIATE validation
     uploaded_file = st.file_uploader(
@@ -416,16 +509,9 @@ def show_research_page():
     if uploaded_file:
         st.markdown("#### 🔍 File Validation Results")
         
-        # Save temp file for validation
-        temp_path = os.path.join('output', 'temp_uploaded.xlsx')
-        os.makedirs('output', exist_ok=True)
-        
         try:
-            with open(temp_path, 'wb') as f:
-                f.write(uploaded_file.getbuffer())
-            
             # Validate file
-            is_valid, message, question_count, sub_question_count, total_estimated_cost = validate_excel_template(temp_path)
+            is_valid, message, question_count, sub_question_count, total_estimated_cost = validate_excel_template(uploaded_file.getvalue())
             
             if is_valid:
                 st.success(message)
@@ -453,20 +539,16 @@ def show_research_page():
                 if 'template_data' in st.session_state:
                     del st.session_state['template_data']
                 
-            # Clean up temp file
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-                
         except Exception as e:
             st.error(f"❌ Error processing file: {str(e)}")
     else:
         # Use default template - simple and clean
         default_template_path = 'input/market research template.xlsx'
         
-        if os.path.exists(default_template_path):
+        if file_mtime(default_template_path) is not None:
             try:
                 # Validate default template
-                is_valid, message, question_count, sub_question_count, total_estimated_cost = validate_excel_template(default_template_path)
+                is_valid, message, question_count, sub_question_count, total_estimated_cost = validate_excel_template(read_excel_bytes(None, default_template_path))
                 
                 if is_valid:
                     # Store default template data in session state
@@ -556,19 +638,11 @@ def show_research_page():
         final_estimated_cost = 0
         
         if uploaded_file:
-            temp_path = os.path.join('output', 'temp_validation.xlsx')
-            os.makedirs('output', exist_ok=True)
-            
             try:
-                with open(temp_path, 'wb') as f:
-                    f.write(uploaded_file.getbuffer())
-                
-                is_valid, error_msg, question_count, sub_question_count, _ = validate_excel_template(temp_path)
+                is_valid, error_msg, question_count, sub_question_count, _ = validate_excel_template(uploaded_file.getvalue())
                 
                 if not is_valid:
                     st.error(error_msg)
-                    if os.path.exists(temp_path):
-                        os.remove(temp_path)
                     return
                 
                 # Use dynamic cost calculation based on analysis level
@@ -577,10 +651,6 @@ def show_research_page():
                 )
                 final_question_count = question_count
                 final_sub_question_count = sub_question_count
-                
-                # Clean up validation file
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
                     
             except Exception as e:
                 st.error(f"❌ File validation error: {str(e)}")
@@ -588,9 +658,9 @@ def show_research_page():
         else:
             # Use default template question count - get actual values from default template
             default_template_path = 'input/market research template.xlsx'
-            if os.path.exists(default_template_path):
+            if file_mtime(default_template_path) is not None:
                 try:
-                    is_valid, _, question_count, sub_question_count, _ = validate_excel_template(default_template_path)
+                    is_valid, _, question_count, sub_question_count, _ = validate_excel_template(read_excel_bytes(None, default_template_path))
                     if is_valid:
                         # Use dynamic cost calculation for default template too
                         final_estimated_cost, layer3_cost, layer4_cost, category_count = calculate_dynamic_cost(
@@ -620,26 +690,12 @@ def show_research_page():
                     final_question_count, final_sub_question_count, analysis_level
                 )
         
-        # Handle file processing
-        if uploaded_file:
-            # Save uploaded file
-            excel_path = os.path.join('output', 'uploaded_framework.xlsx')
-            with open(excel_path, 'wb') as f:
-                f.write(uploaded_file.getbuffer())
-        else:
-            # Use default
-            excel_path = 'input/market research template.xlsx'
-        
-        # Convert Excel to structured data
+        # Convert Excel to structured data (in memory, cached per file content)
+        excel_path = uploaded_file.name if uploaded_file else 'input/market research template.xlsx'
         try:
-            converter = ExcelToStructuredJSON()
-            json_path = 'output/market_research_structured.json'
-            success = converter.convert_excel_to_json(excel_path, json_path)
+            structured_data = convert_excel_template(read_excel_bytes(uploaded_file, excel_path), excel_path)
             
-            if success:
-                with open(json_path, 'r', encoding='utf-8') as f:
-                    structured_data = json.load(f)
-            else:
+            if structured_data is None:
                 st.error("❌ Failed to convert Excel file!")
                 return
                 
@@ -654,7 +710,7 @@ def show_research_page():
             'market': market,
             'testing_mode': research_mode == "Quick Test (5 questions)",
             'analysis_level': analysis_level,
-            'api_key': OPENAI_API_KEY,
+            'api_key': api_key,
             'question_count': final_question_count,
             'estimated_cost': final_estimated_cost
         }
@@ -678,39 +734,7 @@ def show_research_page():
     if st.session_state.get('research_completed', False):
         st.success("🎉 Research completed successfully!")
         
-        # Word download button
-        word_file = st.session_state.get('word_file')
-        if word_file and os.path.exists(word_file):
-            with open(word_file, "rb") as file:
-                st.download_button(
-                    label="📄 Download Word Report",
-                    data=file.read(),
-                    file_name=os.path.basename(word_file),
-                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                    use_container_width=True
-                )
-        else:
-            # Fallback: Try to find the most recent Word file
-            try:
-                word_files = glob.glob("output/Báo_cáo_nghiên_cứu_thị_trường_*.docx")
-                if word_files:
-                    # Get the most recent file
-                    latest_word_file = max(word_files, key=os.path.getctime)
-                    st.info(f"🔍 Found recent Word file: {os.path.basename(latest_word_file)}")
-                    
-                    with open(latest_word_file, "rb") as file:
-                        st.download_button(
-                            label="📄 Download Latest Word Report",
-                            data=file.read(),
-                            file_name=os.path.basename(latest_word_file),
-                            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                            use_container_width=True
-                        )
-                else:
-                    st.error("❌ No Word files found in output directory.")
-                    
-            except Exception as e:
-                st.error(f"❌ Error finding Word file: {str(e)}")
+        show_report_download()
 
     # Cost confirmation dialog
     if st.session_state.get('show_cost_dialog', False) and not st.session_state.get('dialog_processed', False):
@@ -800,29 +824,27 @@ def show_research_page():
             analysis_level = research_params['analysis_level']
             api_key = research_params['api_key']
             
-            # Progress tracking - consistent with default file experience
-            progress_bar = st.progress(0)
-            status_text = st.empty()
+            # Progress tracking - one st.status container, updated only at phase boundaries
+            status = st.status("🤖 Initializing AI research engine...", expanded=True)
             
             try:
-                # Execute research with clean progress tracking
-                status_text.text("🤖 Initializing AI research engine...")
-                progress_bar.progress(10)
+                from export_comprehensive_report import create_comprehensive_word_report
                 
-                researcher = OpenAIMarketResearch(api_key=api_key, industry=industry, market=market)
+                # Cached engine - not closed after the run so the next research reuses its connections
+                researcher, run_lock = get_researcher(api_key)
                 
-                status_text.text("🔍 Starting market research analysis...")
-                progress_bar.progress(20)
+                status.update(label="🔍 Running market research analysis...")
                 
-                results = researcher.run_layer3_research(
-                    structured_data=structured_data,
-                    topic=industry,
-                    testing_mode=testing_mode,
-                    analysis_level=analysis_level
-                )
+                with run_lock:
+                    researcher.industry, researcher.market = industry, market
+                    results = researcher.run_layer3_research(
+                        structured_data=structured_data,
+                        topic=industry,
+                        testing_mode=testing_mode,
+                        analysis_level=analysis_level
+                    )
                 
-                status_text.text("💾 Saving research results...")
-                progress_bar.progress(80)
+                status.update(label="💾 Saving research results...")
                 
                 # Add API key to results for export function
                 results['api_key'] = api_key
@@ -831,18 +853,12 @@ def show_research_page():
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
                 
                 # Determine market suffix for filename
-                market_suffix = ""
-                if market and market.lower() != "global market":
-                    if "việt nam" in market.lower() or "vietnam" in market.lower():
-                        market_suffix = "_VN"
-                    else:
-                        # Clean market name for filename
-                        clean_market = re.sub(r'[^\w\s-]', '', market).strip()
-                        clean_market = re.sub(r'\s+', '_', clean_market)
-                        market_suffix = f"_{clean_market}"
+                market_suffix = MARKET_FILE_SUFFIXES.get(market)
+                if market_suffix is None:
+                    market_suffix = market_file_suffix(market)
                 
-                industry_clean = re.sub(r'[^\w\s-]', '', industry)
-                industry_clean = re.sub(r'\s+', '_', industry_clean)
+                industry_clean = FILENAME_UNSAFE_RE.sub('', industry)
+                industry_clean = WHITESPACE_RE.sub('_', industry_clean)
                 
                 filename = f"layer3_research_{industry_clean}{market_suffix}_{timestamp}.json"
                 output_path = os.path.join("output", filename)
@@ -851,17 +867,16 @@ def show_research_page():
                 os.makedirs("output", exist_ok=True)
                 
                 # Save with proper encoding
-                with open(output_path, 'w', encoding='utf-8') as f:
-                    json.dump(results, f, ensure_ascii=False, indent=2)
+                with open(output_path, 'wb') as f:
+                    f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
                 
-                progress_bar.progress(90)
-                status_text.text("📄 Generating comprehensive Word report...")
+                status.update(label="📄 Generating comprehensive Word report...")
                 
                 # Generate Word report automatically with Vietnamese filename
-                word_file = create_comprehensive_word_report(output_path, use_vietnamese_filename=True)
+                # Results are still in memory - the exporter doesn't need to re-read the JSON just written
+                word_file = create_comprehensive_word_report(output_path, use_vietnamese_filename=True, data=results)
                 
-                progress_bar.progress(100)
-                status_text.text("✅ Research completed successfully!")
+                status.update(label="✅ Research completed successfully!", state="complete")
                 
                 st.session_state['research_completed'] = True
                 st.session_state['research_results'] = results
@@ -877,8 +892,7 @@ def show_research_page():
                 st.rerun()
                 
             except Exception as e:
-                progress_bar.progress(0)
-                status_text.text("❌ Research failed")
+                status.update(label="❌ Research failed", state="error")
                 st.error(f"❌ Research failed: {str(e)}")
                 
                 # Clear session state on error
@@ -886,21 +900,24 @@ def show_research_page():
                     if key in st.session_state:
                         del st.session_state[key]
 
+@st.fragment
 def show_settings_page():
-    """Settings and configuration page"""
+    """Settings and configuration page (a fragment: saving the form reruns only this page, not the sidebar/header)"""
     st.header("⚙️ Settings & Configuration")
     
     # API Configuration
     st.subheader("🔑 API Configuration")
     
     # Check current API key status
-    current_key = OPENAI_API_KEY if OPENAI_API_KEY != "your-openai-api-key-here" else ""
+    current_key = current_api_key()
+    if current_key == "your-openai-api-key-here":
+        current_key = ""
     key_status = "✅ Configured" if current_key else "❌ Not configured"
     
     st.info(f"API Key Status: {key_status}")
     
     # For deployment, show instructions for Streamlit Cloud
-    if not os.path.exists('config.py'):
+    if file_mtime('config.py') is None:
         st.warning("🌐 **Deployment Mode Detected**")
         st.markdown("""
         **For Streamlit Cloud deployment:**
@@ -911,48 +928,32 @@ def show_settings_page():
         OPENAI_API_KEY = "your-actual-openai-api-key-here"
         ```
         4. Save and restart your app
+        
+        Or enter a key below to use it for this browser session only.
         """)
-    else:
-        # Local development mode
-        with st.form("api_settings"):
-            api_key = st.text_input(
-                "OpenAI API Key",
-                value=current_key,
-                type="password",
-                help="Enter your OpenAI API key from https://platform.openai.com/api-keys"
-            )
-            
-            model_choice = st.selectbox(
-                "AI Model",
-                ["gpt-3.5-turbo", "gpt-4"],
-                help="gpt-3.5-turbo is recommended for cost-effectiveness"
-            )
-            
-            if st.form_submit_button("💾 Save API Settings"):
-                if api_key:
-                    # Update config file (local development only)
-                    try:
-                        with open('config.py', 'r', encoding='utf-8') as f:
-                            content = f.read()
-                        
-                        # Replace API key
-                        import re
-                        new_content = re.sub(
-                            r'return ".*"  # Fallback',
-                            f'return "{api_key}"  # Fallback',
-                            content
-                        )
-                        
-                        with open('config.py', 'w', encoding='utf-8') as f:
-                            f.write(new_content)
-                        
-                        st.success("✅ API key saved successfully!")
-                        st.info("Please restart the application to apply changes.")
-                        
-                    except Exception as e:
-                        st.error(f"Error saving API key: {str(e)}")
-                else:
-                    st.error("Please enter a valid API key!")
+    
+    # Key is kept in session state and passed to the research engine directly -
+    # nothing is written back to config.py
+    with st.form("api_settings"):
+        api_key = st.text_input(
+            "OpenAI API Key",
+            value=current_key,
+            type="password",
+            help="Enter your OpenAI API key from https://platform.openai.com/api-keys"
+        )
+        
+        model_choice = st.selectbox(
+            "AI Model",
+            ["gpt-3.5-turbo", "gpt-4"],
+            help="gpt-3.5-turbo is recommended for cost-effectiveness"
+        )
+        
+        if st.form_submit_button("💾 Save API Settings"):
+            if api_key:
+                st.session_state['openai_api_key'] = api_key
+                st.success("✅ API key saved for this session!")
+            else:
+                st.error("Please enter a valid API key!")
     
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Các module nằm ở thư mục gốc repo (không phải package) - cho phép import khi chạy pytest từ bất kỳ đâu
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
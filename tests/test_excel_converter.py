@@ -0,0 +1,47 @@
+import json
+from pathlib import Path
+
+from excel_to_structured_json import ExcelToStructuredJSON, convert_market_research_to_json
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+TEMPLATE = REPO_ROOT / "input" / "market research template.xlsx"
+# Output của converter gốc (trước khi viết lại) trên file template
+BASELINE = Path(__file__).resolve().parent / "fixtures" / "market_research_structured.json"
+
+
+def test_template_matches_baseline():
+    baseline = json.loads(BASELINE.read_text(encoding="utf-8"))
+    assert ExcelToStructuredJSON().convert_excel_to_data(str(TEMPLATE)) == baseline
+
+
+def test_convert_excel_to_json_writes_baseline(tmp_path):
+    json_path = tmp_path / "structured.json"
+    ExcelToStructuredJSON().convert_excel_to_json(str(TEMPLATE), str(json_path))
+    assert json.loads(json_path.read_text(encoding="utf-8")) == json.loads(BASELINE.read_text(encoding="utf-8"))
+
+
+def test_reuses_structured_json_while_excel_is_unchanged(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "output").mkdir()
+    excel_file = tmp_path / "template.xlsx"
+    excel_file.write_bytes(TEMPLATE.read_bytes())
+
+    calls = []
+    convert = ExcelToStructuredJSON.convert_excel_to_data
+
+    def counting_convert(self, *args, **kwargs):
+        calls.append(args)
+        return convert(self, *args, **kwargs)
+
+    monkeypatch.setattr(ExcelToStructuredJSON, "convert_excel_to_data", counting_convert)
+    baseline = json.loads(BASELINE.read_text(encoding="utf-8"))
+
+    assert convert_market_research_to_json(str(excel_file)) == baseline
+    assert convert_market_research_to_json(str(excel_file)) == baseline
+    assert len(calls) == 1
+
+    # Nội dung Excel đổi (sha256 khác) thì phải convert lại
+    with open(excel_file, "ab") as f:
+        f.write(b"\0")
+    assert convert_market_research_to_json(str(excel_file)) == baseline
+    assert len(calls) == 2
@@ -0,0 +1,81 @@
+import orjson
+
+from openai_market_research import Layer3Store
+
+
+def make_results():
+    return {
+        "research_results": [{
+            "layer_name": "PESTEL",
+            "categories": [{
+                "category_name": "Political",
+                "questions": [
+                    {"main_question": "Q1?", "sub_questions": ["a", "b"], "layer3_content": "L3 Q1"},
+                    {"main_question": "Q2?", "sub_questions": [], "layer3_content": "L3 Q2"},
+                ]
+            }]
+        }]
+    }
+
+
+def write_results(path, results):
+    path.write_bytes(orjson.dumps(results))
+
+
+def first_question(results):
+    return results["research_results"][0]["categories"][0]["questions"][0]
+
+
+def test_interrupted_run_replays_deltas(tmp_path):
+    results_file = tmp_path / "layer3.json"
+    write_results(results_file, make_results())
+
+    store = Layer3Store(str(results_file))
+    assert store.add_enhancement("PESTEL", "Political", "Q1?", "a", "enhanced a")
+    assert store.add_comprehensive("PESTEL", "Political", "Q1?", "report Q1")
+    assert not store.add_comprehensive("PESTEL", "Political", "Unknown?", "x")
+    # Bị ngắt trước flush(): file kết quả chưa đổi, delta nằm trong sidecar
+    assert "layer4_comprehensive_report" not in first_question(orjson.loads(results_file.read_bytes()))
+    assert len((tmp_path / "layer3.layer4_deltas.jsonl").read_bytes().splitlines()) == 2
+
+    resumed = Layer3Store(str(results_file))
+    question = first_question(resumed.results)
+    assert question["layer4_enhancements"]["a"]["enhanced_content"] == "enhanced a"
+    assert question["layer4_comprehensive_report"]["comprehensive_content"] == "report Q1"
+    assert question["layer4_comprehensive_report"]["sub_questions_integrated"] == ["a", "b"]
+
+
+def test_flush_writes_results_and_removes_sidecar(tmp_path):
+    results_file = tmp_path / "layer3.json"
+    write_results(results_file, make_results())
+
+    store = Layer3Store(str(results_file))
+    store.add_comprehensive("PESTEL", "Political", "Q1?", "report Q1")
+    store.flush()
+
+    assert not (tmp_path / "layer3.layer4_deltas.jsonl").exists()
+    saved = orjson.loads(results_file.read_bytes())
+    assert first_question(saved)["layer4_comprehensive_report"]["comprehensive_content"] == "report Q1"
+
+
+def test_ignores_partially_written_delta_line(tmp_path):
+    results_file = tmp_path / "layer3.json"
+    write_results(results_file, make_results())
+
+    store = Layer3Store(str(results_file))
+    store.add_comprehensive("PESTEL", "Political", "Q1?", "report Q1")
+    with open(store.deltas_file, 'ab') as f:
+        f.write(b'{"layer_name": "PESTEL", "categ')
+
+    resumed = Layer3Store(str(results_file))
+    assert first_question(resumed.results)["layer4_comprehensive_report"]["comprehensive_content"] == "report Q1"
+
+
+def test_fresh_results_do_not_replay_stale_sidecar(tmp_path):
+    results_file = tmp_path / "layer3.json"
+    write_results(results_file, make_results())
+    Layer3Store(str(results_file)).add_comprehensive("PESTEL", "Political", "Q1?", "stale report")
+
+    store = Layer3Store(str(results_file), results=make_results())
+    assert "layer4_comprehensive_report" not in first_question(store.results)
+    assert not (tmp_path / "layer3.layer4_deltas.jsonl").exists()
@@ -0,0 +1,37 @@
+import re
+
+from openai_market_research import GENERIC_REFERENCE_PATTERNS, REFERENCE_PATTERNS, scan_references
+
+MULTI_SOURCE = (
+    "Theo Bộ Tài chính và Ngân hàng Thế giới, IMF cùng World Bank dự báo GDP tăng; "
+    "Chính phủ Việt Nam và World Bank đồng ý với McKinsey."
+)
+
+
+def scan_per_pattern(content):
+    """Cách quét cũ: finditer từng pattern một"""
+    return [
+        match.group()
+        for pattern in REFERENCE_PATTERNS + GENERIC_REFERENCE_PATTERNS
+        for match in re.finditer(pattern, content, re.IGNORECASE)
+    ]
+
+
+def test_multi_source_sentence_count():
+    sources = scan_references(MULTI_SOURCE)
+    assert len(sources) == 8
+    # Nguồn cụ thể đứng sau pattern tổng quát "Bộ ..." / "Chính phủ ..." vẫn được đếm riêng
+    assert sources.count("World Bank") == 2
+    assert "Ngân hàng Thế giới" in sources
+    assert "IMF" in sources
+    assert "McKinsey" in sources
+
+
+def test_matches_per_pattern_scan():
+    samples = [
+        MULTI_SOURCE,
+        "Số liệu từ GSO, Statista và Bloomberg; Ministry of Industry and Trade cũng xác nhận.",
+        "Không có nguồn nào ở đây.",
+    ]
+    for content in samples:
+        assert sorted(scan_references(content)) == sorted(scan_per_pattern(content))
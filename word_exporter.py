@@ -5,7 +5,7 @@ Word Exporter cho Market Research Results
 Chuyển đổi JSON results thành Word document có cấu trúc theo layers
 """
 
-import json
+import orjson
 from datetime import datetime
 from pathlib import Path
 from docx import Document
@@ -235,12 +235,14 @@ class MarketResearchWordExporter:
         
         # Layer summary
         categories = layer_data.get('categories', [])
-        total_questions = sum(len(cat.get('questions', [])) for cat in categories)
-        total_sub_questions = sum(
-            len(q.get('sub_answers', []))
-            for cat in categories
-            for q in cat.get('questions', [])
-        )
+        # Đếm main questions và sub-questions trong cùng một lượt duyệt
+        total_questions = 0
+        total_sub_questions = 0
+        for cat in categories:
+            questions = cat.get('questions', [])
+            total_questions += len(questions)
+            for q in questions:
+                total_sub_questions += len(q.get('sub_answers', []))
         
         summary_para = self.doc.add_paragraph(style='SummaryBox')
         summary_para.add_run(f"Tổng quan Layer {layer_name}:").bold = True
@@ -376,8 +378,8 @@ class MarketResearchWordExporter:
         """Export JSON results to Word document"""
         
         # Read JSON data
-        with open(json_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with open(json_file, 'rb') as f:
+            data = orjson.loads(f.read())
         
         # Generate output filename if not provided
         if output_file is None: